@@ -0,0 +1,143 @@
+import argparse
+import itertools
+import json
+import os
+import threading
+import time
+import torch
+from icp_weight_dataset import ICPWeightDataset
+from train_icp_weights import default_params, default_loc_pairs, form_iterator
+
+def process_rss(pid):
+    # Resident set size (bytes) of a process, 0 if it is gone
+    try:
+        with open('/proc/' + str(pid) + '/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (FileNotFoundError, ProcessLookupError, IndexError):
+        return 0
+
+def child_pids(pid):
+    # Direct children of a process, e.g. DataLoader workers
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat', 'r') as f:
+                # The parent pid follows the process name, which may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (FileNotFoundError, ProcessLookupError, IndexError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+class PeakRssMonitor():
+    # Samples the summed RSS of this process and its children on a background thread
+    # Pages shared between the workers and the main process are counted once per process
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        pid = os.getpid()
+        while not self.stop_event.is_set():
+            rss = process_rss(pid) + sum(process_rss(child) for child in child_pids(pid))
+            self.peak_rss = max(self.peak_rss, rss)
+            self.stop_event.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop_event.set()
+        self.thread.join()
+
+def time_loader_epochs(iterator, num_batches=20, num_epochs=2):
+    # Samples per second over num_epochs passes of num_batches batches
+    # Worker start up is included, so persistent workers only pay for it once
+    num_samples = 0
+    tic = time.time()
+    for epoch in range(num_epochs):
+        for i_batch, batch in enumerate(iterator):
+            num_samples += batch['transforms']['T_ml_gt'].shape[0]
+            if i_batch + 1 >= num_batches:
+                break
+    return num_samples / (time.time() - tic)
+
+def loader_settings_grid(args):
+    # All DataLoader settings to time, plus the thread loader settings if any
+    grid = []
+    for batch_size, num_workers, prefetch_factor, persistent, pin_memory in itertools.product(
+            args.batch_sizes, args.num_workers, args.prefetch_factors, args.persistent_workers, args.pin_memory):
+        # Prefetching and persistence only exist with worker processes
+        if num_workers == 0 and (prefetch_factor != args.prefetch_factors[0] or persistent):
+            continue
+        grid.append({"batch_size_train": batch_size, "loader": "process", "loader_workers": num_workers,
+                     "loader_prefetch_factor": prefetch_factor, "loader_persistent_workers": persistent,
+                     "loader_pin_memory": pin_memory})
+    for batch_size, num_threads, prefetch in itertools.product(args.batch_sizes, args.num_threads, args.prefetch_factors):
+        grid.append({"batch_size_train": batch_size, "loader": "thread", "loader_threads": num_threads,
+                     "loader_prefetch": prefetch})
+    return grid
+
+def main(args):
+    params = default_params()
+    params["num_train"] = args.num_samples
+    # Form the mask loss targets every sample, so that no config is timed on a warmer cache
+    params["target_cache_dir"] = None
+
+    train_loc_pairs, _ = default_loc_pairs()
+    dataset = ICPWeightDataset(loc_pairs=train_loc_pairs, params=params, dataset_type='train')
+
+    results = []
+    for settings in loader_settings_grid(args):
+        loader_params = dict(params, **settings)
+        iterator = form_iterator(dataset, loader_params, settings["batch_size_train"], shuffle=True, drop_last=True)
+        with PeakRssMonitor() as monitor:
+            samples_per_s = time_loader_epochs(iterator, num_batches=args.num_batches, num_epochs=args.num_epochs)
+        if settings["loader"] == "thread":
+            iterator.shutdown()
+        del iterator
+        results.append({"params": settings, "samples_per_s": samples_per_s, "peak_rss_mb": monitor.peak_rss / 1e6})
+        print("{:8.2f} samples/s, {:8.1f} MB peak RSS: {}".format(samples_per_s, monitor.peak_rss / 1e6, settings))
+
+    # Fastest settings within the memory budget
+    if args.max_rss_mb is not None:
+        candidates = [result for result in results if result["peak_rss_mb"] <= args.max_rss_mb]
+    else:
+        candidates = results
+    if len(candidates) == 0:
+        print("No loader settings stay below " + str(args.max_rss_mb) + " MB, nothing written")
+        return
+    best = max(candidates, key=lambda result: result["samples_per_s"])
+    print("Fastest: {:.2f} samples/s, {:.1f} MB peak RSS: {}".format(best["samples_per_s"], best["peak_rss_mb"], best["params"]))
+
+    with open(args.output, 'w') as f:
+        json.dump(best, f, indent=4)
+    print("Written to " + args.output + ", set the loader_config param to use it in train_icp_weights.py")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    int_list = lambda x: [int(v) for v in x.split(',')]
+    bool_list = lambda x: [v.strip().lower() == 'true' for v in x.split(',')]
+    parser.add_argument('--num_samples', default=1000, type=int, help='number of training samples to load the dataset with')
+    parser.add_argument('--num_batches', default=20, type=int, help='number of batches timed per epoch')
+    parser.add_argument('--num_epochs', default=2, type=int, help='number of timed epochs, includes worker start up')
+    parser.add_argument('--batch_sizes', default='16', type=int_list, help='comma separated training batch sizes')
+    parser.add_argument('--num_workers', default='0,2,4,8', type=int_list, help='comma separated DataLoader worker counts')
+    parser.add_argument('--prefetch_factors', default='2,4', type=int_list, help='comma separated batches loaded ahead per worker (per thread loader)')
+    parser.add_argument('--persistent_workers', default='false,true', type=bool_list, help='comma separated true/false')
+    parser.add_argument('--pin_memory', default=str(torch.cuda.is_available()).lower(), type=bool_list,
+                        help='comma separated true/false, only useful with a gpu')
+    parser.add_argument('--num_threads', default='', type=lambda x: int_list(x) if x else [],
+                        help='comma separated thread loader thread counts, empty to only tune the DataLoader')
+    parser.add_argument('--max_rss_mb', default=None, type=float, help='memory budget (MB) the chosen settings must stay below')
+    parser.add_argument('--output', default='loader_config.json', type=str, help='file to write the chosen settings to')
+
+    args = parser.parse_args()
+
+    main(args)
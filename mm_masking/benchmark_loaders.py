@@ -0,0 +1,70 @@
+import argparse
+import time
+import torch
+from torch.utils.data import DataLoader
+from icp_weight_dataset import ICPWeightDataset
+from thread_loader import ThreadPoolLoader
+from train_icp_weights import default_params, default_loc_pairs
+
+def time_loader(iterator, num_batches=20, num_warmup=2):
+    # Returns the number of samples per second iterator delivers and the time (s) to its first batch
+    # Warmup batches include starting workers and filling the prefetch queue
+    tic = time.time()
+    first_batch_time = None
+    num_samples = 0
+    for i_batch, batch in enumerate(iterator):
+        if i_batch == 0:
+            first_batch_time = time.time() - tic
+        if i_batch == num_warmup:
+            tic = time.time()
+        if i_batch >= num_warmup:
+            num_samples += batch['transforms']['T_ml_gt'].shape[0]
+        if i_batch + 1 >= num_warmup + num_batches:
+            break
+    toc = time.time()
+
+    return num_samples / (toc - tic), first_batch_time
+
+def main(args):
+    params = default_params()
+    params["num_train"] = args.num_samples
+    # Form the mask loss targets every sample, so that no config is timed on a warmer cache
+    params["target_cache_dir"] = None
+
+    train_loc_pairs, _ = default_loc_pairs()
+    dataset = ICPWeightDataset(loc_pairs=train_loc_pairs, params=params, dataset_type='train')
+
+    results = []
+    for num_workers in [int(x) for x in args.num_workers.split(',')]:
+        iterator = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=num_workers,
+                              drop_last=True, persistent_workers=num_workers > 0)
+        samples_per_s, first_batch_time = time_loader(iterator, num_batches=args.num_batches, num_warmup=args.num_warmup)
+        results.append(("process, " + str(num_workers) + " workers", samples_per_s, first_batch_time))
+        del iterator
+
+    for num_threads in [int(x) for x in args.num_threads.split(',')]:
+        for ordered in [True, False]:
+            iterator = ThreadPoolLoader(dataset, batch_size=args.batch_size, shuffle=True, drop_last=True,
+                                        num_threads=num_threads, prefetch_batches=args.prefetch, ordered=ordered)
+            samples_per_s, first_batch_time = time_loader(iterator, num_batches=args.num_batches, num_warmup=args.num_warmup)
+            results.append(("thread, " + str(num_threads) + " threads, " + ("ordered" if ordered else "unordered"),
+                            samples_per_s, first_batch_time))
+            iterator.shutdown()
+
+    print("Loader throughput, batch size " + str(args.batch_size) + ", " + str(args.num_batches) + " batches")
+    for name, samples_per_s, first_batch_time in results:
+        print("{:<40s} {:8.2f} samples/s, first batch after {:.2f} s".format(name, samples_per_s, first_batch_time))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_samples', default=1000, type=int, help='number of training samples to load the dataset with')
+    parser.add_argument('--batch_size', default=16, type=int, help='number of samples per batch')
+    parser.add_argument('--num_batches', default=20, type=int, help='number of timed batches')
+    parser.add_argument('--num_warmup', default=2, type=int, help='number of untimed batches')
+    parser.add_argument('--num_workers', default='0,4,8', type=str, help='comma separated DataLoader worker counts')
+    parser.add_argument('--num_threads', default='4,8,16', type=str, help='comma separated thread loader thread counts')
+    parser.add_argument('--prefetch', default=4, type=int, help='number of batches the thread loader loads ahead')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,193 @@
+import argparse
+import time
+import torch
+import torch.nn as nn
+from icp_weight_policy import LearnICPWeightPolicy
+from params import default_params
+
+def form_random_batch(params, batch_size, num_scan_pts=1000, num_map_pts=5000):
+    # Form a random batch with the shapes produced by ICPWeightDataset
+    # Only the mask network is timed, so the content of the data is irrelevant
+    if params["network_input_type"] == 'cartesian':
+        img_shape = (params["cart_pixel_width"], params["cart_pixel_width"])
+    else:
+        img_shape = (400, 3360)
+    fft_data = torch.rand((batch_size,) + img_shape, dtype=params["float_type"])
+    fft_cfar = torch.where(fft_data > 0.9, 1.0, 0.0).type(params["float_type"])
+    scan_pc = 50.0 * (2 * torch.rand((batch_size, num_scan_pts, 3), dtype=params["float_type"]) - 1)
+    scan_pc[:, :, 2] = 0.0
+    map_pc = 50.0 * (2 * torch.rand((batch_size, num_map_pts, 6), dtype=params["float_type"]) - 1)
+
+    batch_scan = {'fft_data': fft_data, 'fft_cfar': fft_cfar, 'raw_pc': scan_pc, 'filtered_pc': scan_pc}
+    batch_map = {'pc': map_pc}
+    T_init = torch.eye(4, dtype=params["float_type"]).unsqueeze(0).repeat(batch_size, 1, 1)
+
+    return batch_scan, batch_map, T_init
+
+def baseline_mask_forward(policy, batch_scan, batch_map, T_init, mask_only=True):
+    # Mask part of the policy forward as it was before the inference optimizations, run with
+    # the layers of policy: inputs stacked per sample, normalized in a loop over channels,
+    # UpsamplingBilinear2d modules built on every call and the cuda cache emptied
+    # The old forward normalized the caller's fft tensor in place, so a copy is normalized here
+    fft_data = batch_scan['fft_data'].to(policy.device).clone()
+    fft_cfar = batch_scan['fft_cfar'].to(policy.device)
+
+    input_data = None
+    if policy.network_inputs['fft']:
+        input_data = fft_data.unsqueeze(1)
+    if policy.network_inputs['cfar']:
+        input_data = torch.cat([input_data, fft_cfar.unsqueeze(1)], dim=1)
+    if policy.network_inputs['range']:
+        range_stack = torch.stack([policy.range_mask for i in range(input_data.shape[0])], dim=0).unsqueeze(1)
+        input_data = torch.cat([input_data, range_stack], dim=1)
+
+    if policy.log_transform:
+        input_data = torch.log(input_data + 1e-6)
+    for c in range(input_data.shape[1]):
+        if "minmax" in policy.normalize_type:
+            c_max = torch.max(input_data[:,c,:,:])
+            c_min = torch.min(input_data[:,c,:,:])
+            input_data[:,c,:,:] = (input_data[:,c,:,:] - c_min) / (c_max - c_min)
+        elif "standardize" in policy.normalize_type:
+            c_mean = torch.mean(input_data[:,c,:,:])
+            c_std = torch.std(input_data[:,c,:,:])
+            input_data[:,c,:,:] = (input_data[:,c,:,:] - c_mean) / c_std
+
+    # Encoder
+    enc_layers = []
+    for i, layer in enumerate(policy.encoder):
+        enc_layers.append(input_data)
+        input_data = layer(input_data)
+    enc_layers.reverse()
+
+    # Decoder
+    for i, decoder_layer in enumerate(policy.decoder):
+        skip_con = enc_layers[i]
+        bi_upsample = nn.UpsamplingBilinear2d(size=(skip_con.shape[2], skip_con.shape[3]))
+        input_data = bi_upsample(input_data)
+        input_data = decoder_layer(input_data)
+        input_data = torch.cat([enc_layers[i], input_data], dim=1)
+        input_data = decoder_layer(input_data)
+
+    weight_mask = policy.final_layer(input_data).squeeze(1)
+    del input_data, enc_layers, bi_upsample, skip_con
+    torch.cuda.empty_cache()
+
+    if policy.norm_weights:
+        weight_mask = weight_mask / torch.amax(weight_mask, dim=(1,2), keepdim=True)
+    return weight_mask
+
+def time_mask_inference(policy, batch_scan, batch_map, T_init, num_batches=10, num_warmup=2, forward=None):
+    # Returns the number of scans per second for which a mask can be inferred
+    # forward(policy, batch_scan, batch_map, T_init, mask_only=True) replaces the policy forward if given
+    policy.eval()
+    if forward is None:
+        forward = lambda policy, *args, **kwargs: policy(*args, **kwargs)
+    with torch.no_grad():
+        for i in range(num_warmup):
+            forward(policy, batch_scan, batch_map, T_init, mask_only=True)
+        tic = time.time()
+        for i in range(num_batches):
+            forward(policy, batch_scan, batch_map, T_init, mask_only=True)
+        toc = time.time()
+
+    return num_batches * T_init.shape[0] / (toc - tic)
+
+def measure_saved_activations(policy, batch_scan, batch_map, T_init):
+    # Returns the number of bytes kept alive for the backward pass of a mask forward
+    # Tensors sharing storage (views) are only counted once
+    saved_storages = {}
+    def pack_hook(tensor):
+        storage = tensor.untyped_storage()
+        saved_storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    policy.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda tensor: tensor):
+        policy(batch_scan, batch_map, T_init, mask_only=True)
+
+    return sum(saved_storages.values())
+
+def time_mask_train_step(policy, batch_scan, batch_map, T_init, num_batches=10, num_warmup=2):
+    # Returns the mean time (s) of a training step with a mask loss only
+    policy.train()
+    opt = torch.optim.Adam(policy.parameters(), lr=1e-4)
+    mask_criterion = torch.nn.BCELoss()
+    fft_mask = torch.where(batch_scan['fft_data'] > 0.5, 1.0, 0.0).type(batch_scan['fft_data'].dtype)
+    for i in range(num_warmup + num_batches):
+        if i == num_warmup:
+            tic = time.time()
+        opt.zero_grad()
+        mask = policy(batch_scan, batch_map, T_init, mask_only=True)
+        loss = mask_criterion(mask, fft_mask)
+        loss.backward()
+        opt.step()
+    toc = time.time()
+
+    return (toc - tic) / num_batches
+
+def benchmark_inference(params, args, batch_scan, batch_map, T_init):
+    # The baseline is the forward from before the inference optimizations, the eager and
+    # optimized ones are the forward of this version without and with optimized_inference
+    results = {}
+    for name, optimized_inference, forward in [("baseline", False, baseline_mask_forward), ("eager", False, None),
+                                               ("optimized", True, None)]:
+        params["optimized_inference"] = optimized_inference
+        torch.manual_seed(0)
+        policy = LearnICPWeightPolicy(params=params)
+        policy = policy.to(device=params["device"])
+        results[name] = time_mask_inference(policy, batch_scan, batch_map, T_init, forward=forward,
+                                            num_batches=args.num_batches, num_warmup=args.num_warmup)
+
+    print("Mask inference on CPU, batch size " + str(args.batch_size) + ", " + str(args.cart_pixel_width) + " px")
+    print("Baseline (forward before the optimizations):  {:.2f} scans/s".format(results["baseline"]))
+    print("Eager (forward of this version):              {:.2f} scans/s ({:.2f}x)".format(results["eager"], results["eager"] / results["baseline"]))
+    print("Optimized (compiled, channels-last):          {:.2f} scans/s ({:.2f}x)".format(results["optimized"], results["optimized"] / results["baseline"]))
+
+def benchmark_training(params, args, batch_scan, batch_map, T_init):
+    results = {}
+    for grad_checkpoint in [False, True]:
+        params["grad_checkpoint"] = grad_checkpoint
+        torch.manual_seed(0)
+        policy = LearnICPWeightPolicy(params=params)
+        policy = policy.to(device=params["device"])
+        saved_bytes = measure_saved_activations(policy, batch_scan, batch_map, T_init)
+        step_time = time_mask_train_step(policy, batch_scan, batch_map, T_init,
+                                         num_batches=args.num_batches, num_warmup=args.num_warmup)
+        results[grad_checkpoint] = (saved_bytes, step_time)
+
+    print("Mask training step on CPU, batch size " + str(args.batch_size) + ", " + str(args.cart_pixel_width) + " px")
+    for grad_checkpoint in [False, True]:
+        saved_bytes, step_time = results[grad_checkpoint]
+        print("Checkpointing {}: {:.1f} MB saved activations ({:.1f} MB/sample), {:.3f} s/step".format(
+            grad_checkpoint, saved_bytes / 1e6, saved_bytes / 1e6 / args.batch_size, step_time))
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    params = default_params()
+    params["device"] = torch.device("cpu")
+    params["cart_pixel_width"] = args.cart_pixel_width
+    params["cart_resolution"] = args.cart_resolution
+
+    batch_scan, batch_map, T_init = form_random_batch(params, args.batch_size)
+
+    if args.mode == 'inference':
+        benchmark_inference(params, args, batch_scan, batch_map, T_init)
+    elif args.mode == 'train':
+        benchmark_training(params, args, batch_scan, batch_map, T_init)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', default='inference', type=str, help='inference (baseline vs eager vs compiled) or train (checkpointing vs not)')
+    parser.add_argument('--batch_size', default=4, type=int, help='number of scans per batch')
+    parser.add_argument('--num_batches', default=10, type=int, help='number of timed batches')
+    parser.add_argument('--num_warmup', default=2, type=int, help='number of untimed batches, includes compilation')
+    parser.add_argument('--num_threads', default=0, type=int, help='number of torch threads, 0 keeps the default')
+    parser.add_argument('--cart_pixel_width', default=640, type=int, help='cartesian image width (pixels)')
+    parser.add_argument('--cart_resolution', default=0.2384, type=float, help='cartesian resolution (m/pixel)')
+
+    args = parser.parse_args()
+
+    main(args)
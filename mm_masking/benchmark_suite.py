@@ -0,0 +1,205 @@
+import argparse
+import json
+import platform
+import time
+import numpy as np
+import torch
+from icp_weight_policy import LearnICPWeightPolicy
+from params import default_params
+from radar_utils import cfar_mask, extract_pc, radar_polar_to_cartesian_diff, extract_weights, extract_bev_from_pts
+from icp_utils import voxel_downsample
+from synthetic_data import synthetic_batch, pad_pc, POLAR_RES
+
+def time_rounds(fn, num_rounds=10, num_warmup=2):
+    # Wall time (s) statistics of num_rounds calls of fn, after num_warmup untimed calls
+    for _ in range(num_warmup):
+        fn()
+    times = []
+    for _ in range(num_rounds):
+        tic = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - tic)
+    times = np.array(times)
+    return {"min": float(np.min(times)), "max": float(np.max(times)), "mean": float(np.mean(times)),
+            "stddev": float(np.std(times)), "median": float(np.median(times)), "rounds": num_rounds}
+
+def kernel_benchmarks(params, batch):
+    # Radar kernels of the dataset and the policy, on the synthetic batch
+    loc_data = batch['loc_data']
+    fft_polar = loc_data['fft_polar']
+    azimuths = loc_data['azimuths']
+    az_timestamps = loc_data['az_timestamps']
+    thres_mask = cfar_mask(fft_polar, POLAR_RES, a_thresh=params["a_thresh"], b_thresh=params["b_thresh"], diff=False)
+    cart_mask = torch.rand((fft_polar.shape[0], params["cart_pixel_width"], params["cart_pixel_width"]), dtype=params["float_type"])
+
+    return {
+        "cfar_mask": lambda: cfar_mask(fft_polar, POLAR_RES, a_thresh=params["a_thresh"], b_thresh=params["b_thresh"], diff=False),
+        "cfar_mask_diff": lambda: cfar_mask(fft_polar, POLAR_RES, a_thresh=params["a_thresh"], b_thresh=params["b_thresh"], diff=True),
+        "extract_pc": lambda: extract_pc(thres_mask, POLAR_RES, azimuths, az_timestamps, diff=False),
+        "radar_polar_to_cartesian_diff": lambda: radar_polar_to_cartesian_diff(fft_polar, azimuths, POLAR_RES,
+                                                                               cart_resolution=params["cart_resolution"],
+                                                                               cart_pixel_width=params["cart_pixel_width"]),
+        "extract_weights": lambda: extract_weights(cart_mask, loc_data['raw_pc'], cart_resolution=params["cart_resolution"]),
+        "extract_bev_from_pts": lambda: extract_bev_from_pts(batch['map_data']['pc'], cart_resolution=params["cart_resolution"],
+                                                             cart_pixel_width=params["cart_pixel_width"]),
+    }
+
+def policy_benchmarks(policy, batch):
+    # Mask inference and a full forward with ICP, as in validate_policy
+    batch_scan = batch['loc_data']
+    batch_map = batch['map_data']
+    T_init = batch['transforms']['T_ml_init']
+
+    def forward_mask():
+        with torch.no_grad():
+            policy(batch_scan, batch_map, T_init, mask_only=True)
+
+    def forward_icp():
+        with torch.no_grad():
+            policy(batch_scan, batch_map, T_init)
+
+    return {"policy_forward_mask": forward_mask, "policy_forward_icp": forward_icp}
+
+def downsample_map_batch(batch_map, voxel_size, voxel_dim, pad_val):
+    # Voxel downsample each map of a batch as filter_map does, padded back to the batch width
+    map_pc = []
+    num_pts = []
+    for pc in batch_map['pc']:
+        valid = torch.all(pc != pad_val, dim=1)
+        pts_ds, norms_ds = voxel_downsample(pc[valid, :3], pc[valid, 3:], voxel_size, dim=voxel_dim)
+        map_pc.append(pad_pc(torch.cat((pts_ds, norms_ds), dim=1), pc.shape[0], pad_val=pad_val))
+        num_pts.append(pts_ds.shape[0])
+    return dict(batch_map, pc=torch.stack(map_pc)), num_pts
+
+def icp_errors(T_pred, T_gt, gt_eye):
+    # Mean rotation (rad) and translation (m) errors, as in eval_validation_loss
+    if gt_eye:
+        xi_wedge = T_pred - torch.eye(4, dtype=T_pred.dtype)
+    else:
+        xi_wedge = torch.matmul(T_pred, torch.inverse(T_gt)) - torch.eye(4, dtype=T_pred.dtype)
+    rot_err = torch.abs(xi_wedge[:, 1, 0]).mean().item()
+    trans_err = torch.norm(xi_wedge[:, 0:2, 3], dim=1).mean().item()
+    return rot_err, trans_err
+
+def voxel_downsample_report(policy, batch, voxel_sizes, voxel_dim, gt_eye, num_rounds=10, num_warmup=2):
+    # Map size, ICP error and forward time with the map as is and downsampled with each voxel size
+    pad_val = policy.ICP_alg.target_pad_val
+    batch_scan = batch['loc_data']
+    T_init = batch['transforms']['T_ml_init']
+    T_gt = batch['transforms']['T_ml_gt']
+    num_full = torch.sum(torch.all(batch['map_data']['pc'] != pad_val, dim=2), dim=1).tolist()
+    print("initial guess:     rot err {:.4f} rad, trans err {:.4f} m".format(*icp_errors(T_init, T_gt, gt_eye)))
+    rows = []
+    for voxel_size in [None] + voxel_sizes:
+        if voxel_size is None:
+            batch_map, num_pts = batch['map_data'], num_full
+        else:
+            batch_map, num_pts = downsample_map_batch(batch['map_data'], voxel_size, voxel_dim, pad_val)
+
+        def forward_icp():
+            with torch.no_grad():
+                return policy(batch_scan, batch_map, T_init)[0]
+
+        rot_err, trans_err = icp_errors(forward_icp(), T_gt, gt_eye)
+        stats = time_rounds(forward_icp, num_rounds=num_rounds, num_warmup=num_warmup)
+        rows.append({"voxel_size": voxel_size, "map_pts": float(np.mean(num_pts)),
+                     "map_pts_fraction": float(np.mean(np.array(num_pts) / np.array(num_full))),
+                     "rot_err": rot_err, "trans_err": trans_err, "median_time": stats["median"]})
+        print("voxel size {:>6s}: {:8.1f} map pts ({:5.1f}%), rot err {:.4f} rad, trans err {:.4f} m, forward {:8.2f} ms".format(
+            str(voxel_size), rows[-1]["map_pts"], 100 * rows[-1]["map_pts_fraction"], rot_err, trans_err, 1e3 * stats["median"]))
+    return rows
+
+def compare_results(results, baseline, tolerance):
+    # Benchmarks whose median time grew by more than tolerance (fraction) over the baseline
+    baseline_median = {(bench["name"], bench["batch_size"]): bench["stats"]["median"] for bench in baseline["benchmarks"]}
+    regressions = []
+    for bench in results["benchmarks"]:
+        key = (bench["name"], bench["batch_size"])
+        if key not in baseline_median:
+            continue
+        ratio = bench["stats"]["median"] / baseline_median[key]
+        print("{:<32s} batch {:<4d} {:6.2f}x of baseline".format(bench["name"], bench["batch_size"], ratio))
+        if ratio > 1.0 + tolerance:
+            regressions.append({"name": bench["name"], "batch_size": bench["batch_size"], "ratio": ratio})
+    return regressions
+
+def main(args):
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    params = default_params()
+    params["device"] = torch.device("cpu")
+    params["cart_pixel_width"] = args.cart_pixel_width
+    params["cart_resolution"] = args.cart_resolution
+    params["max_range"] = args.max_range
+    params["icp_solver"] = args.icp_solver
+
+    torch.manual_seed(0)
+    policy = LearnICPWeightPolicy(params=params)
+    policy.eval()
+
+    selected = args.benchmarks.split(',') if args.benchmarks else None
+    results = {"machine": {"platform": platform.platform(), "processor": platform.processor(),
+                           "python": platform.python_version(), "torch": torch.__version__,
+                           "num_threads": torch.get_num_threads()},
+               "config": vars(args), "benchmarks": []}
+    for batch_size in [int(x) for x in args.batch_sizes.split(',')]:
+        batch = synthetic_batch(params, batch_size, seed=args.seed, num_scan_pts=args.num_scan_pts,
+                                num_map_pts=args.num_map_pts, map_pad_val=policy.ICP_alg.target_pad_val)
+        benchmarks = kernel_benchmarks(params, batch)
+        benchmarks.update(policy_benchmarks(policy, batch))
+        for name, fn in benchmarks.items():
+            if selected is not None and name not in selected:
+                continue
+            stats = time_rounds(fn, num_rounds=args.num_rounds, num_warmup=args.num_warmup)
+            stats["scans_per_s"] = batch_size / stats["median"]
+            results["benchmarks"].append({"name": name, "batch_size": batch_size, "stats": stats})
+            print("{:<32s} batch {:<4d} median {:9.2f} ms, min {:9.2f} ms, {:8.2f} scans/s".format(
+                name, batch_size, 1e3*stats["median"], 1e3*stats["min"], stats["scans_per_s"]))
+
+    if args.voxel_sizes:
+        # Effect of map voxel downsampling (map_voxel_size) on the map size and the ICP error
+        batch = synthetic_batch(params, args.voxel_batch_size, seed=args.seed, num_scan_pts=args.num_scan_pts,
+                                num_map_pts=args.num_map_pts, map_pad_val=policy.ICP_alg.target_pad_val)
+        results["voxel_downsample"] = voxel_downsample_report(policy, batch, [float(x) for x in args.voxel_sizes.split(',')],
+                                                              args.map_voxel_dim, params["gt_eye"],
+                                                              num_rounds=args.num_rounds, num_warmup=args.num_warmup)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        print("Results written to " + args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print("Slower than the baseline by more than " + str(100 * args.tolerance) + "%: " + str(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', default='1,4', type=str, help='comma separated batch sizes to time each benchmark at')
+    parser.add_argument('--benchmarks', default='', type=str, help='comma separated benchmark names to run, empty to run all')
+    parser.add_argument('--num_rounds', default=10, type=int, help='number of timed calls of each benchmark')
+    parser.add_argument('--num_warmup', default=2, type=int, help='number of untimed calls of each benchmark')
+    parser.add_argument('--num_threads', default=0, type=int, help='number of torch threads, 0 keeps the default')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the synthetic data')
+    parser.add_argument('--num_scan_pts', default=2000, type=int, help='number of (padded) scan points per sample')
+    parser.add_argument('--num_map_pts', default=8000, type=int, help='number of (padded) map points per sample')
+    parser.add_argument('--cart_pixel_width', default=640, type=int, help='cartesian image width (pixels)')
+    parser.add_argument('--cart_resolution', default=0.2384, type=float, help='cartesian resolution (m/pixel)')
+    parser.add_argument('--max_range', default=None, type=float, help='maximum radar range (m), None keeps all 3360 bins')
+    parser.add_argument('--icp_solver', default='native', type=str, help='icp solver of the forward, native or dicp')
+    parser.add_argument('--voxel_sizes', default='', type=str, help='comma separated map voxel sizes (m) to compare ICP error against the full map with, empty to skip')
+    parser.add_argument('--map_voxel_dim', default=2, type=int, help='map voxel dimension of the comparison, 2 or 3')
+    parser.add_argument('--voxel_batch_size', default=8, type=int, help='number of synthetic samples of the voxel comparison')
+    parser.add_argument('--output', default=None, type=str, help='json file to write the results to')
+    parser.add_argument('--baseline', default=None, type=str, help='json results of an earlier run to compare against')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='slowdown (fraction of the baseline median) reported as a regression')
+
+    args = parser.parse_args()
+
+    exit(main(args))
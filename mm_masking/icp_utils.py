@@ -0,0 +1,310 @@
+import math
+import torch
+
+# Planar (dim=2) weighted ICP helpers
+# T follows the convention of T_ml_gt in ICPWeightDataset.filter_map, i.e. T maps
+# map points into the scan frame. The solver therefore estimates S = T^-1, which
+# maps scan points into the map frame, and returns T = S^-1.
+
+def se2_to_matrix(xi):
+    # Form a (N, 4, 4) transform from a (N, 3) perturbation [x, y, theta]
+    T = torch.eye(4, dtype=xi.dtype, device=xi.device).repeat(xi.shape[0], 1, 1)
+    cos_theta = torch.cos(xi[:, 2])
+    sin_theta = torch.sin(xi[:, 2])
+    T[:, 0, 0] = cos_theta
+    T[:, 0, 1] = -sin_theta
+    T[:, 1, 0] = sin_theta
+    T[:, 1, 1] = cos_theta
+    T[:, 0, 3] = xi[:, 0]
+    T[:, 1, 3] = xi[:, 1]
+    return T
+
+def transform_points_2d(T, pts):
+    # Apply the planar part of (N, 4, 4) transforms T to (N, m, 2) points
+    return pts @ T[:, :2, :2].transpose(1, 2) + T[:, :2, 3].unsqueeze(1)
+
+def nearest_neighbours(src_pts, tgt_pts, chunk_size=1024):
+    # Brute force nearest neighbour of each src point in tgt, done in chunks
+    # to keep the distance matrix small
+    nn_dist = torch.empty(src_pts.shape[:2], dtype=src_pts.dtype, device=src_pts.device)
+    nn_idx = torch.empty(src_pts.shape[:2], dtype=torch.long, device=src_pts.device)
+    for ii in range(src_pts.shape[0]):
+        for start in range(0, src_pts.shape[1], chunk_size):
+            end = start + chunk_size
+            dist = torch.cdist(src_pts[ii, start:end], tgt_pts[ii], compute_mode='donot_use_mm_for_euclid_dist')
+            nn_dist[ii, start:end], nn_idx[ii, start:end] = torch.min(dist, dim=1)
+    return nn_dist, nn_idx
+
+# Voxel hash index over the map points used for correspondence search
+# Cells are keyed by their integer (i, j) coordinates, and each sample stores its
+# occupied cell keys (sorted), the start and count of each cell in idx, and idx,
+# the map_pc indices of the points ordered by cell. T_nn maps map_pc points into
+# the frame the index was built in. All are padded to the number of map points so
+# that the index can be collated with the map.
+CELL_OFFSET = 2**20
+CELL_STRIDE = 2**21
+PAD_KEY = 2**62
+
+def cell_keys(cells):
+    return (cells[..., 0] + CELL_OFFSET) * CELL_STRIDE + (cells[..., 1] + CELL_OFFSET)
+
+def sort_by_voxel(pts, voxel_size):
+    # Order (M, 2) points by the key of their voxel
+    keys = cell_keys(torch.floor(pts / voxel_size).long())
+    keys_sorted, order = torch.sort(keys, stable=True)
+    return keys_sorted, order
+
+def index_from_sorted(keys_sorted, order, valid, num_pad):
+    # Form the index of the valid points from the voxel ordering of all points
+    # Indices refer to the valid points only, in their original order
+    valid_sorted = valid[order]
+    valid_idx = torch.cumsum(valid.long(), dim=0) - 1
+    idx = valid_idx[order[valid_sorted]]
+    keys, counts = torch.unique_consecutive(keys_sorted[valid_sorted], return_counts=True)
+    starts = torch.cumsum(counts, dim=0) - counts
+
+    map_index = {'nn_keys': torch.full((num_pad,), PAD_KEY, dtype=torch.long),
+                 'nn_starts': torch.zeros((num_pad,), dtype=torch.long),
+                 'nn_counts': torch.zeros((num_pad,), dtype=torch.long),
+                 'nn_idx': torch.zeros((num_pad,), dtype=torch.long)}
+    map_index['nn_keys'][:keys.shape[0]] = keys
+    map_index['nn_starts'][:keys.shape[0]] = starts
+    map_index['nn_counts'][:keys.shape[0]] = counts
+    map_index['nn_idx'][:idx.shape[0]] = idx
+    return map_index
+
+def build_map_index(map_pc, voxel_size, pad_val):
+    # Build the index of a padded (B, M, >=2) map batch in its own frame
+    map_indices = []
+    for ii in range(map_pc.shape[0]):
+        map_pts = map_pc[ii, :, :2]
+        valid = torch.all(torch.abs(map_pts) < pad_val, dim=1)
+        keys_sorted, order = sort_by_voxel(map_pts, voxel_size)
+        map_indices.append(index_from_sorted(keys_sorted, order, valid, map_pc.shape[1]))
+    map_index = {key: torch.stack([m_idx[key] for m_idx in map_indices]).to(map_pc.device) for key in map_indices[0]}
+    map_index['T_nn'] = torch.eye(4, dtype=map_pc.dtype, device=map_pc.device).repeat(map_pc.shape[0], 1, 1)
+    return map_index
+
+def query_map_index(src_pts, map_pts, map_index, voxel_size, radius, max_candidates=2**22):
+    # Nearest map point of each src point, exact for all neighbours closer than radius
+    # Points without a neighbour within radius get an infinite distance
+    num_rings = math.ceil(radius / voxel_size)
+    ring = torch.arange(-num_rings, num_rings + 1, device=src_pts.device)
+    cell_offsets = torch.stack(torch.meshgrid(ring, ring, indexing='ij'), dim=-1).reshape(-1, 2)
+
+    B, N = src_pts.shape[:2]
+    num_keys = map_index['nn_keys'].shape[1]
+    src_cells = torch.floor(transform_points_2d(map_index['T_nn'], src_pts) / voxel_size).long()
+
+    # Candidates of each query are padded to the largest cell, so bound the
+    # number of candidates processed at once
+    max_count = max(int(torch.max(map_index['nn_counts'])), 1)
+    chunk_size = max(max_candidates // (B * cell_offsets.shape[0] * max_count), 1)
+
+    nn_dist = torch.full((B, N), float('inf'), dtype=src_pts.dtype, device=src_pts.device)
+    nn_idx = torch.zeros((B, N), dtype=torch.long, device=src_pts.device)
+    for start in range(0, N, chunk_size):
+        end = min(start + chunk_size, N)
+        keys = cell_keys(src_cells[:, start:end].unsqueeze(2) + cell_offsets).reshape(B, -1)
+        pos = torch.clamp(torch.searchsorted(map_index['nn_keys'], keys), max=num_keys - 1)
+        found = torch.gather(map_index['nn_keys'], 1, pos) == keys
+        counts = torch.where(found, torch.gather(map_index['nn_counts'], 1, pos), 0)
+        chunk_count = int(torch.max(counts))
+        if chunk_count == 0:
+            continue
+        cand_offsets = torch.arange(chunk_count, device=src_pts.device)
+        cand_pos = torch.gather(map_index['nn_starts'], 1, pos).unsqueeze(-1) + cand_offsets
+        cand_valid = (cand_offsets < counts.unsqueeze(-1)).reshape(B, end - start, -1)
+        cand_pos = torch.clamp(cand_pos, max=num_keys - 1).reshape(B, -1)
+        cand_idx = torch.gather(map_index['nn_idx'], 1, cand_pos)
+        cand_pts = torch.gather(map_pts, 1, cand_idx.unsqueeze(-1).expand(-1, -1, 2)).reshape(B, end - start, -1, 2)
+
+        dist = torch.norm(cand_pts - src_pts[:, start:end].unsqueeze(2), dim=-1)
+        dist = torch.where(cand_valid, dist, float('inf'))
+        min_dist, min_pos = torch.min(dist, dim=-1)
+        nn_dist[:, start:end] = torch.where(min_dist < radius, min_dist, float('inf'))
+        nn_idx[:, start:end] = torch.gather(cand_idx.reshape(B, end - start, -1), 2, min_pos.unsqueeze(-1)).squeeze(-1)
+
+    return nn_dist, nn_idx
+
+def voxel_downsample(pts, norms, voxel_size, dim=2):
+    # Replace the (M, 3) points and normals in each voxel by their mean, with voxels
+    # over the first dim coordinates. Output is ordered by voxel coordinates so that
+    # it does not depend on the input order of the voxels
+    cells = torch.floor(pts[:, :dim] / voxel_size).long()
+    cells_unique, voxel_idx = torch.unique(cells, dim=0, return_inverse=True)
+    num_voxels = cells_unique.shape[0]
+    counts = torch.bincount(voxel_idx, minlength=num_voxels).unsqueeze(1).type(pts.dtype)
+    pts_ds = torch.zeros((num_voxels, 3), dtype=pts.dtype).index_add_(0, voxel_idx, pts) / counts
+
+    # Normals have an arbitrary sign, so the mean normal is taken as the principal
+    # direction of their outer products, signed to agree with their plain sum
+    outer = (norms.unsqueeze(2) * norms.unsqueeze(1)).reshape(-1, 9)
+    outer_sum = torch.zeros((num_voxels, 9), dtype=norms.dtype).index_add_(0, voxel_idx, outer).reshape(-1, 3, 3)
+    norms_ds = torch.linalg.eigh(outer_sum)[1][:, :, -1]
+    norms_sum = torch.zeros((num_voxels, 3), dtype=norms.dtype).index_add_(0, voxel_idx, norms)
+    norms_ds = torch.where(torch.sum(norms_ds * norms_sum, dim=1, keepdim=True) < 0.0, -norms_ds, norms_ds)
+
+    return pts_ds, norms_ds
+
+def compact_scan_pc(scan_pc, weights, weight_threshold=None, top_k=None):
+    # Gather the points with a weight above weight_threshold and/or among the top_k
+    # weights of their scan to the front, in their original order. The batch is cut
+    # to the largest number of kept points and the rest are zero, like the padding
+    # of the scan. Gradients flow to the kept weights through the gather.
+    keep = torch.ones_like(weights, dtype=torch.bool)
+    if weight_threshold is not None:
+        keep = keep & (weights.detach() > weight_threshold)
+    if top_k is not None and top_k < weights.shape[1]:
+        top_k_idx = torch.topk(weights.detach(), top_k, dim=1).indices
+        keep = keep & torch.zeros_like(keep).scatter_(1, top_k_idx, True)
+
+    num_keep = max(int(torch.max(torch.sum(keep, dim=1))), 1)
+    order = torch.argsort((~keep).long(), dim=1, stable=True)[:, :num_keep]
+    kept = torch.gather(keep, 1, order)
+    scan_pc = torch.gather(scan_pc, 1, order.unsqueeze(-1).expand(-1, -1, scan_pc.shape[2])) * kept.unsqueeze(-1)
+    weights = torch.gather(weights, 1, order) * kept
+
+    return scan_pc, weights
+
+def robust_weights(err, loss_fn):
+    # IRLS weights of each residual for the robust loss, any other name is plain L2
+    sq_err = torch.sum(err * err, dim=-1)
+    scale = loss_fn["metric"]
+    if loss_fn["name"] == "cauchy":
+        return 1.0 / (1.0 + sq_err / scale**2)
+    elif loss_fn["name"] == "huber":
+        return torch.clamp(scale / torch.sqrt(sq_err + 1e-12), max=1.0)
+    elif loss_fn["name"] == "geman-mcclure":
+        return 1.0 / (1.0 + sq_err / scale**2)**2
+    return torch.ones_like(sq_err)
+
+def icp_residuals(src_pts, map_pts, map_norms, nn_idx, icp_type):
+    # Residuals and their jacobians with respect to a left perturbation [x, y, theta]
+    # of the scan to map transform, evaluated at the transformed scan points src_pts
+    nn_idx_2d = nn_idx.unsqueeze(-1).expand(-1, -1, 2)
+    matched_pts = torch.gather(map_pts, 1, nn_idx_2d)
+    err = src_pts - matched_pts
+
+    jac = torch.zeros(src_pts.shape[:2] + (2, 3), dtype=src_pts.dtype, device=src_pts.device)
+    jac[:, :, 0, 0] = 1.0
+    jac[:, :, 1, 1] = 1.0
+    jac[:, :, 0, 2] = -src_pts[:, :, 1]
+    jac[:, :, 1, 2] = src_pts[:, :, 0]
+
+    if icp_type == "pt2pl":
+        # Project residual onto the (planar) normal of the matched map point
+        matched_norms = torch.gather(map_norms, 1, nn_idx_2d)
+        matched_norms = matched_norms / (torch.norm(matched_norms, dim=-1, keepdim=True) + 1e-12)
+        err = torch.sum(matched_norms * err, dim=-1, keepdim=True)
+        jac = matched_norms.unsqueeze(-2) @ jac
+
+    return err, jac
+
+def linearize_icp(scan_pts, map_pts, map_norms, S, weights, icp_type="pt2pt", trim_dist=5.0,
+                  loss_fn={"name": "cauchy", "metric": 1.0}, map_index=None, voxel_size=None):
+    # Form the Gauss-Newton system H xi = -g of the weighted ICP cost at S
+    # Correspondences, trimming and robust weights are treated as constants
+    src_pts = transform_points_2d(S, scan_pts)
+    if map_index is None:
+        nn_dist, nn_idx = nearest_neighbours(src_pts.detach(), map_pts)
+    else:
+        nn_dist, nn_idx = query_map_index(src_pts.detach(), map_pts, map_index, voxel_size, trim_dist)
+    err, jac = icp_residuals(src_pts, map_pts, map_norms, nn_idx, icp_type)
+
+    inliers = nn_dist < trim_dist
+    pt_weights = weights * robust_weights(err.detach(), loss_fn) * inliers
+
+    H = torch.einsum('bn,bnki,bnkj->bij', pt_weights, jac, jac)
+    g = torch.einsum('bn,bnki,bnk->bi', pt_weights, jac, err)
+
+    return H, g
+
+def solve_gauss_newton(H, g, damping=1e-6):
+    # Small damping keeps samples without any inliers from producing nans
+    H_damped = H + damping * torch.eye(3, dtype=H.dtype, device=H.device)
+    return -torch.linalg.solve(H_damped, g.unsqueeze(-1)).squeeze(-1)
+
+def split_pc(scan_pc, map_pc):
+    # ICP is planar, so only x, y of the points (and normals, if present) are used
+    scan_pts = scan_pc[:, :, :2]
+    map_pts = map_pc[:, :, :2]
+    if map_pc.shape[2] == 6:
+        map_norms = map_pc[:, :, 3:5]
+    else:
+        map_norms = None
+    return scan_pts, map_pts, map_norms
+
+def select_samples(active, scan_pts, map_pts, map_norms, weights, map_index):
+    # Select the samples in active from the ICP inputs
+    if map_norms is not None:
+        map_norms = map_norms[active]
+    if map_index is not None:
+        map_index = {key: value[active] for key, value in map_index.items()}
+    return scan_pts[active], map_pts[active], map_norms, weights[active], map_index
+
+def solve_icp(scan_pc, map_pc, T_init, weights, icp_type="pt2pt", trim_dist=5.0,
+              loss_fn={"name": "cauchy", "metric": 1.0}, max_iterations=50, tolerance=1e-5,
+              map_index=None, voxel_size=None):
+    # Iterate weighted ICP until the update of each sample is below tolerance
+    # Converged samples are dropped from further iterations
+    # Returns the estimates and the number of iterations each sample took
+    scan_pts, map_pts, map_norms = split_pc(scan_pc, map_pc)
+    S = torch.inverse(T_init)
+    num_iters = torch.zeros((T_init.shape[0],), dtype=torch.long, device=T_init.device)
+    active = torch.arange(T_init.shape[0], device=T_init.device)
+    active_inputs = (scan_pts, map_pts, map_norms, weights, map_index)
+    for ii in range(max_iterations):
+        scan_pts_a, map_pts_a, map_norms_a, weights_a, map_index_a = active_inputs
+        H, g = linearize_icp(scan_pts_a, map_pts_a, map_norms_a, S[active], weights_a,
+                             icp_type=icp_type, trim_dist=trim_dist, loss_fn=loss_fn,
+                             map_index=map_index_a, voxel_size=voxel_size)
+        xi = solve_gauss_newton(H, g)
+        S = S.index_copy(0, active, se2_to_matrix(xi) @ S[active])
+        num_iters[active] += 1
+
+        converged = torch.max(torch.abs(xi), dim=1)[0] < tolerance
+        if torch.all(converged):
+            break
+        elif torch.any(converged):
+            still_active = torch.nonzero(~converged).squeeze(1)
+            active = active[still_active]
+            active_inputs = select_samples(still_active, *active_inputs)
+
+    return torch.inverse(S), num_iters
+
+def evaluate_icp_solution(scan_pc, map_pc, T, weights, icp_type="pt2pt", trim_dist=5.0,
+                          map_index=None, voxel_size=None):
+    # Weighted mean squared residual of the inliers and number of inliers of each sample at T
+    # Points with zero weight, e.g. padding, are not counted as inliers
+    scan_pts, map_pts, map_norms = split_pc(scan_pc, map_pc)
+    src_pts = transform_points_2d(torch.inverse(T), scan_pts)
+    if map_index is None:
+        nn_dist, nn_idx = nearest_neighbours(src_pts, map_pts)
+    else:
+        nn_dist, nn_idx = query_map_index(src_pts, map_pts, map_index, voxel_size, trim_dist)
+    err, _ = icp_residuals(src_pts, map_pts, map_norms, nn_idx, icp_type)
+
+    inliers = (nn_dist < trim_dist) & (weights > 0.0)
+    inlier_weights = weights * inliers
+    residual = torch.sum(inlier_weights * torch.sum(err * err, dim=-1), dim=1) \
+        / torch.clamp(torch.sum(inlier_weights, dim=1), min=1e-12)
+
+    return residual, torch.sum(inliers, dim=1)
+
+def implicit_icp_refinement(scan_pc, map_pc, T_star, weights, icp_type="pt2pt", trim_dist=5.0,
+                            loss_fn={"name": "cauchy", "metric": 1.0}, map_index=None, voxel_size=None):
+    # Make a converged ICP solution T_star differentiable with respect to the point weights
+    # At the optimum the cost gradient g(xi = 0, w) is zero, so the implicit function
+    # theorem gives d xi / d w = -H^-1 d g / d w. Taking one Gauss-Newton step from T_star
+    # with H held constant has exactly this jacobian, while its value stays at T_star
+    # (up to the solver tolerance). Only this step is stored for backward.
+    scan_pts, map_pts, map_norms = split_pc(scan_pc, map_pc)
+    S_star = torch.inverse(T_star).detach()
+    H, g = linearize_icp(scan_pts, map_pts, map_norms, S_star, weights,
+                         icp_type=icp_type, trim_dist=trim_dist, loss_fn=loss_fn,
+                         map_index=map_index, voxel_size=voxel_size)
+    xi = solve_gauss_newton(H.detach(), g)
+    S = se2_to_matrix(xi) @ S_star
+
+    return torch.inverse(S)
@@ -3,13 +3,17 @@ import torch
 import numpy as np
 import os.path as osp
 import os
+import threading
 from pyboreas.utils.odometry import read_traj_file2, read_traj_file_gt2
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 from pylgmath import se3op, Transformation
-from radar_utils import load_radar, cfar_mask, extract_pc, load_pc_from_file, radar_cartesian_to_polar, radar_polar_to_cartesian_diff, extract_bev_from_pts, point_to_cart_idx
+from radar_utils import load_radar, get_num_range_bins, cfar_mask, extract_pc, load_pc_from_file, radar_cartesian_to_polar, radar_polar_to_cartesian_diff, extract_bev_from_pts, point_to_cart_idx
 from dICP.ICP import ICP
+from icp_utils import sort_by_voxel, index_from_sorted, voxel_downsample
+from target_cache import TargetCache, dataset_cache_key, pack_target, cached_target_frames
+from icp_weight_policy import required_inputs
 from pyboreas.utils.utils import (
     SE3Tose3,
     get_closest_index,
@@ -20,10 +24,29 @@ import vtr_pose_graph
 from vtr_utils.bag_file_parsing import Rosbag2GraphFactory
 import vtr_pose_graph.graph_utils as g_utils
 from vtr_pose_graph.graph_iterators import TemporalIterator
-from utils.extract_graph import extract_points_and_map
+from utils.extract_graph import extract_points_and_map, extract_map
 import time
 import pandas as pd
 
+def sample_init_perturbation(pos_std, rot_std, uniform=False, float_type=torch.float64):
+    # Sample a planar (x, y, yaw) perturbation to offset the ground truth pose with
+    # Training uses uniform samples in [-std, std], evaluation uses normal samples
+    if uniform:
+        xi_rand = 2 * torch.rand((6,1), dtype=float_type) - 1
+        # Scale x and y
+        xi_rand[0:2] = pos_std*xi_rand[0:2]
+        # Scale yaw
+        xi_rand[5] = rot_std*xi_rand[5]
+        # Zero out z, pitch, and roll
+        xi_rand[2:5] = 0.0
+    else:
+        xi_phi = np.random.normal(0.0, rot_std)
+        xi_x = np.random.normal(0.0, pos_std)
+        xi_y = np.random.normal(0.0, pos_std)
+        xi_rand = torch.tensor([[xi_x], [xi_y], [0.0], [0.0], [0.0], [xi_phi]], dtype=float_type)
+
+    return Transformation(xi_ab=xi_rand).matrix()
+
 class ICPWeightDataset():
 
     def __init__(self, loc_pairs, params=None, dataset_type='train'):
@@ -47,6 +70,16 @@ class ICPWeightDataset():
         a_thresh=params["a_thresh"]
         b_thresh=params["b_thresh"]
         network_input_type = params["network_input_type"]
+        scan_pc_source = params["scan_pc_source"]
+        max_range = params["max_range"]
+        cart_resolution = params["cart_resolution"]
+        cart_pixel_width = params["cart_pixel_width"]
+        nn_voxel_size = params["nn_voxel_size"]
+        elevation_threshold = params["map_elevation_threshold"]
+        z_normal_threshold = params["map_z_normal_threshold"]
+        map_voxel_size = params["map_voxel_size"]
+        map_voxel_dim = params["map_voxel_dim"]
+        target_cache_dir = params["target_cache_dir"]
 
         self.loc_pairs = loc_pairs
         self.float_type = float_type
@@ -54,6 +87,30 @@ class ICPWeightDataset():
         self.loc_sensor = loc_sensor
         self.gt_eye = gt_eye
         self.network_input_type = network_input_type
+        self.scan_pc_source = scan_pc_source
+        self.max_range = max_range
+        self.cart_resolution = cart_resolution
+        self.cart_pixel_width = cart_pixel_width
+        self.elevation_threshold = elevation_threshold
+        self.z_normal_threshold = z_normal_threshold
+        self.map_voxel_size = map_voxel_size
+        self.map_voxel_dim = map_voxel_dim
+        # Radar images are converted to float_type on the compute device if sent compact
+        self.transport_dtype = params["transport_dtype"]
+        # Scan fields used by the policy and the losses, the others are skipped
+        self.required_inputs = required_inputs(params)
+        # The map correspondence index is only needed by the native ICP solver
+        if params["icp_solver"] == 'native' or params["icp_grad"] == 'implicit':
+            self.nn_voxel_size = nn_voxel_size
+        else:
+            self.nn_voxel_size = None
+        # Voxel ordering of each teach vertex map, keyed by (graph id, map timestamp)
+        self.map_index_cache = {}
+        # The pose graphs and the map index cache are shared by the threads of a thread loader
+        # and are not known to be thread safe, so their reads and fills are serialized
+        self.graph_lock = threading.Lock()
+        if scan_pc_source == 'cfar' and map_sensor == 'lidar' and loc_sensor == 'lidar':
+            raise ValueError("CFAR scan pointclouds require a radar loc sensor")
 
         # Load in ICP to get target padding value
         config_path = '../external/dICP/config/dICP_config.yaml'
@@ -125,7 +182,16 @@ class ICPWeightDataset():
 
             # Check if result directory contains a metadata file
             # If not, create one
-            metadata_path = osp.join(vtr_result_dir, sensor_dir_name, map_seq, loc_seq, 'metadata.csv')
+            # The max map size depends on the map filtering, so non-default filtering
+            # gets its own metadata file
+            if elevation_threshold == 0.05 and z_normal_threshold == 0.9 and map_voxel_size is None:
+                metadata_name = 'metadata.csv'
+            else:
+                metadata_name = 'metadata_' + str(elevation_threshold) + '_' + str(z_normal_threshold)
+                if map_voxel_size is not None:
+                    metadata_name += '_' + str(map_voxel_size) + '_' + str(map_voxel_dim) + 'd'
+                metadata_name += '.csv'
+            metadata_path = osp.join(vtr_result_dir, sensor_dir_name, map_seq, loc_seq, metadata_name)
             if not osp.exists(metadata_path):
                 df_data = {'complete' : 0, 'up_to_idx': -1, 'max_loc': -1, 'max_map': -1}
                 df = pd.DataFrame(df_data, index=[0])
@@ -147,6 +213,8 @@ class ICPWeightDataset():
             print("Loading from metadata: " + str(not extract_pcs_metadata))
             local_max_loc_pts = 0
             local_max_map_pts = 0
+            num_map_pts_filt = 0
+            num_map_pts = 0
             for ii, (loc_v, e) in enumerate(TemporalIterator(v_start)):
                 # Check if vertex is valid
                 if e.from_id == vtr_pose_graph.INVALID_ID:
@@ -182,6 +250,8 @@ class ICPWeightDataset():
                     # Ensure CFAR of image exists, if it does not, create one
                     # This is done to speed up training so that CFAR image does not need to be created every time
                     #cfar_dir = osp.join(data_dir, 'cfar', loc_seq, network_input_type, str(a_thresh) + '_' + str(b_thresh))
+                    # The image is computed at full size and cropped to max_range when loaded,
+                    # so it is shared by all max_range settings
                     cfar_dir = osp.join(data_dir, 'cfar', loc_seq, 'polar', str(a_thresh) + '_' + str(b_thresh))
                     if not osp.exists(cfar_dir):
                         os.makedirs(cfar_dir)
@@ -225,7 +295,9 @@ class ICPWeightDataset():
 
                     map_pts_sensor_frame = (T_map_sensor_robot[:3,:3] @ map_pts.T + T_map_sensor_robot[:3, 3:4]).T
                     map_norms_sensor_frame = (T_map_sensor_robot[:3,:3] @ map_norms.T).T
-                    map_pts, map_norms = self.filter_map(map_pts_sensor_frame, map_norms_sensor_frame, T_gt_idx)
+                    map_pts, map_norms, valid_pts = self.filter_map(map_pts_sensor_frame, map_norms_sensor_frame, T_gt_idx)
+                    num_map_pts_filt += torch.sum(valid_pts).item()
+                    num_map_pts += map_pts.shape[0]
                     
 
                     # Plot for visualization
@@ -257,26 +329,11 @@ class ICPWeightDataset():
                     else:
                         T_init_idx = gt_T_s2_s1
                 else:
-                    if dataset_type == 'train':
-                        xi_rand = 2 * torch.rand((6,1), dtype=float_type) - 1
-                        # Scale x and y
-                        xi_rand[0:2] = pos_std*xi_rand[0:2]
-                        # Scale yaw
-                        xi_rand[5] = rot_std*xi_rand[5]
-                        # Zero out z, pitch, and roll
-                        xi_rand[2:5] = 0.0
-                    else:
-                        #xi_rand = 2 * torch.rand((6,1), dtype=float_type) - 1
-                        xi_phi = np.random.normal(0.0, rot_std)
-                        xi_x = np.random.normal(0.0, pos_std)
-                        xi_y = np.random.normal(0.0, pos_std)
-                        xi_rand = torch.tensor([[xi_x], [xi_y], [0.0], [0.0], [0.0], [xi_phi]], dtype=float_type)
-
-                    T_rand = Transformation(xi_ab=xi_rand)
+                    T_rand = sample_init_perturbation(pos_std, rot_std, uniform=(dataset_type == 'train'), float_type=float_type)
                     if gt_eye:
-                        T_init_idx = T_rand.matrix() # @ identity
+                        T_init_idx = T_rand # @ identity
                     else:
-                        T_init_idx = T_rand.matrix() @ gt_T_s2_s1
+                        T_init_idx = T_rand @ gt_T_s2_s1
                 T_init_idx = torch.tensor(T_init_idx, dtype=float_type)
 
                 # Stack data for more efficient storage and retrieval
@@ -306,6 +363,9 @@ class ICPWeightDataset():
                 df_data = {'complete' : meta_complete, 'up_to_idx': ii, 'max_loc': local_max_loc_pts, 'max_map': local_max_map_pts}
                 df = pd.DataFrame(df_data, index=[0])
                 df.to_csv(metadata_path, index=False)
+                if map_voxel_size is not None and num_map_pts_filt > 0:
+                    print("Map points after filtering: " + str(num_map_pts_filt) + ", after voxel downsampling: " + str(num_map_pts) \
+                          + " (" + str(round(100.0 * num_map_pts / num_map_pts_filt, 1)) + "%)")
                 
                 # Overwrite max point sizes if they are larger
                 if local_max_loc_pts > self.max_loc_pts:
@@ -317,6 +377,33 @@ class ICPWeightDataset():
         assert self.v_id_vector.shape[0] == self.graph_id_vector.shape[0] == self.T_loc_gt.shape[0] \
             == self.T_loc_init.shape[0] == len(self.loc_radar_path_list) == len(self.loc_cfar_path_list)
 
+        # Cache the binary targets of the mask losses that are in use
+        self.target_frames = cached_target_frames(params, self.augment)
+        if target_cache_dir is not None and len(self.target_frames) > 0:
+            target_shapes = {}
+            for name, frame in self.target_frames.items():
+                if frame == 'cartesian':
+                    target_shapes[name] = (cart_pixel_width, cart_pixel_width)
+                else:
+                    target_shapes[name] = (400, get_num_range_bins(3360, max_range=max_range, res=self.polar_res))
+            target_config = {'targets': self.target_frames, 'max_range': max_range, 'cart_resolution': cart_resolution,
+                             'cart_pixel_width': cart_pixel_width, 'gt_eye': gt_eye, 'map_elevation_threshold': elevation_threshold,
+                             'map_z_normal_threshold': z_normal_threshold, 'map_voxel_size': map_voxel_size, 'map_voxel_dim': map_voxel_dim}
+            self.target_cache = TargetCache(target_cache_dir, dataset_cache_key(self, target_config),
+                                            len(self), target_shapes)
+        else:
+            self.target_cache = None
+
+    def __getstate__(self):
+        # Locks are not sent to spawned loader workers, each worker makes its own
+        state = self.__dict__.copy()
+        del state['graph_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.graph_lock = threading.Lock()
+
     def __len__(self):
         return self.v_id_vector.shape[0]
 
@@ -328,57 +415,123 @@ class ICPWeightDataset():
         T_ml_gt = self.T_loc_gt[index]
 
         # Load in pointclouds and timestamps
-        scan_pc_raw, scan_pc_filt, map_pc, loc_stamp, map_stamp = self.load_graph_data(index, T_ml_gt)
-        assert scan_pc_raw.shape == scan_pc_filt.shape, 'Raw and filtered pointclouds dont match!'
-
+        # In cfar mode, only the map is loaded from the graph
+        load_scan = self.scan_pc_source != 'cfar'
+        scan_pc_raw, scan_pc_filt, map_pc, map_index, loc_stamp, map_stamp = self.load_graph_data(index, T_ml_gt, load_scan=load_scan)
+        if scan_pc_filt is not None:
+            assert scan_pc_raw.shape == scan_pc_filt.shape, 'Raw and filtered pointclouds dont match!'
+
+        loc_data = {'timestamp' : loc_stamp}
+        targets = None
         if not (self.map_sensor == 'lidar' and self.loc_sensor == 'lidar'):
             # Load in fft data
             loc_radar_img = cv2.imread(self.loc_radar_path_list[index], cv2.IMREAD_GRAYSCALE)
-            fft_data, azimuths, az_timestamps = load_radar(loc_radar_img)
+            fft_data, azimuths, az_timestamps = load_radar(loc_radar_img, max_range=self.max_range, res=self.polar_res)
             fft_data = torch.tensor(fft_data, dtype=self.float_type)
             azimuths = torch.tensor(azimuths, dtype=self.float_type)
             az_timestamps = torch.tensor(az_timestamps, dtype=self.float_type)
 
-            fft_cfar = cv2.imread(self.loc_cfar_path_list[index], cv2.IMREAD_GRAYSCALE)
-            fft_cfar = torch.tensor(fft_cfar, dtype=self.float_type)/255.0
+            if 'fft_cfar' in self.required_inputs:
+                fft_cfar = cv2.imread(self.loc_cfar_path_list[index], cv2.IMREAD_GRAYSCALE)
+                # Crop CFAR image to the same range as the fft data
+                fft_cfar = fft_cfar[:, :fft_data.shape[1]]
+                fft_cfar = torch.tensor(fft_cfar, dtype=self.float_type)/255.0
+            else:
+                fft_cfar = None
+
+            # Mask loss targets are formed before augmentation and rolled along with the data
+            if self.target_cache is not None:
+                targets = self.target_cache.load(index)
+                if targets is None:
+                    targets = self.form_targets(index, map_pc, fft_data, azimuths)
 
             # Deal with data augmentation
             if self.augment:
-                scan_pc_raw, scan_pc_filt, map_pc, azimuths, fft_data, fft_cfar = \
-                    self.augment_data(scan_pc_raw, scan_pc_filt, map_pc, azimuths, fft_data, fft_cfar)
-
-            if self.network_input_type == 'cartesian':
-                fft_data = radar_polar_to_cartesian_diff(fft_data.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res).squeeze(0)
-                fft_cfar = radar_polar_to_cartesian_diff(fft_cfar.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res).squeeze(0)
+                scan_pc_raw, scan_pc_filt, map_pc, azimuths, az_timestamps, fft_data, fft_cfar, angle = \
+                    self.augment_data(scan_pc_raw, scan_pc_filt, map_pc, azimuths, az_timestamps, fft_data, fft_cfar, targets=targets)
+                if map_index is not None:
+                    # The index stays in its own frame, so undo the map rotation in T_nn
+                    rot_aug = torch.eye(4, dtype=self.float_type)
+                    rot_aug[:2, :2] = torch.tensor([[torch.cos(angle), -torch.sin(angle)],
+                                                    [torch.sin(angle), torch.cos(angle)]], dtype=self.float_type)
+                    map_index['T_nn'] = map_index['T_nn'] @ rot_aug
+
+            if self.scan_pc_source == 'cfar':
+                # Scan points are extracted from the polar data after collation,
+                # so the polar fft data and azimuth timing must be kept
+                loc_data['az_timestamps'] = az_timestamps
+                if self.network_input_type == 'cartesian':
+                    loc_data['fft_polar'] = fft_data
+
+            if 'fft_data' in self.required_inputs:
+                if self.network_input_type == 'cartesian':
+                    fft_data = radar_polar_to_cartesian_diff(fft_data.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res,
+                                                             cart_resolution=self.cart_resolution, cart_pixel_width=self.cart_pixel_width).squeeze(0)
+                loc_data['fft_data'] = fft_data
+            if 'fft_cfar' in self.required_inputs:
+                if self.network_input_type == 'cartesian':
+                    fft_cfar = radar_polar_to_cartesian_diff(fft_cfar.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res,
+                                                             cart_resolution=self.cart_resolution, cart_pixel_width=self.cart_pixel_width).squeeze(0)
+                loc_data['fft_cfar'] = fft_cfar
+            loc_data['azimuths'] = azimuths
         else:
-            fft_data = 0.0
-            fft_cfar = 0.0
-
-        loc_data = {'raw_pc': scan_pc_raw, 'filtered_pc': scan_pc_filt,
-                    'fft_data' : fft_data, 'fft_cfar' : fft_cfar, 'timestamp' : loc_stamp}
+            if self.target_cache is not None:
+                targets = self.target_cache.load(index)
+                if targets is None:
+                    targets = self.form_targets(index, map_pc)
+
+        if self.transport_dtype is not None:
+            for name in ['fft_data', 'fft_cfar', 'fft_polar']:
+                if name in loc_data:
+                    loc_data[name], loc_data[name + '_scale'] = self.compact_image(loc_data[name])
+
+        if scan_pc_raw is not None:
+            loc_data['raw_pc'] = scan_pc_raw
+        if scan_pc_filt is not None:
+            loc_data['filtered_pc'] = scan_pc_filt
         map_data = {'pc': map_pc, 'timestamp' : map_stamp}
+        if map_index is not None:
+            map_data.update(map_index)
+        if targets is not None:
+            # Targets stay bit-packed until they are unpacked on the device of the loss
+            if 'fft_target' in targets:
+                loc_data['fft_target'] = torch.from_numpy(targets['fft_target'])
+            if 'map_pts_target' in targets:
+                map_data['map_pts_target'] = torch.from_numpy(targets['map_pts_target'])
         T_data = {'T_ml_init' : T_init, 'T_ml_gt' : T_ml_gt}
 
         return {'loc_data': loc_data, 'map_data': map_data, 'transforms': T_data}
     
-    def load_graph_data(self, idx, T_ml_gt):
+    def load_graph_data(self, idx, T_ml_gt, load_scan=True):
         v_id = self.v_id_vector[idx].item() # Need .item() as v_id must be int, not np.int32/64
         graph_id = self.graph_id_vector[idx]
         pair_graph = self.graph_list[graph_id]
-        vertex = pair_graph.get_vertex(v_id)
         if self.map_sensor == 'lidar' and self.loc_sensor == 'lidar':
             extract_raw_pts = False
         else:
             extract_raw_pts = True
         
-        curr_raw_pts, curr_filt_pts, map_pts, map_norms, loc_stamp, map_stamp = extract_points_and_map(pair_graph, vertex, msg_prefix=self.msg_prefix, extract_raw_pts=extract_raw_pts)
-        
-        # Make scan_pc batchable
-        curr_raw_pts = torch.from_numpy(curr_raw_pts)
-        curr_filt_pts = torch.from_numpy(curr_filt_pts)
-        scan_pc_pad = torch.zeros((self.max_loc_pts - curr_raw_pts.shape[0], 3), dtype=self.float_type)
-        scan_pc_raw = torch.cat((curr_raw_pts, scan_pc_pad), dim=0)
-        scan_pc_filt = torch.cat((curr_filt_pts, scan_pc_pad), dim=0)
+        with self.graph_lock:
+            vertex = pair_graph.get_vertex(v_id)
+            if load_scan:
+                curr_raw_pts, curr_filt_pts, map_pts, map_norms, loc_stamp, map_stamp = extract_points_and_map(pair_graph, vertex, msg_prefix=self.msg_prefix, extract_raw_pts=extract_raw_pts)
+            else:
+                map_pts, map_norms, loc_stamp, map_stamp = extract_map(pair_graph, vertex)
+
+        if load_scan:
+
+            # Make scan_pc batchable
+            curr_raw_pts = torch.from_numpy(curr_raw_pts)
+            curr_filt_pts = torch.from_numpy(curr_filt_pts)
+            scan_pc_pad = torch.zeros((self.max_loc_pts - curr_raw_pts.shape[0], 3), dtype=self.float_type)
+            scan_pc_raw = torch.cat((curr_raw_pts, scan_pc_pad), dim=0)
+            if 'filtered_pc' in self.required_inputs:
+                scan_pc_filt = torch.cat((curr_filt_pts, scan_pc_pad), dim=0)
+            else:
+                scan_pc_filt = None
+        else:
+            scan_pc_raw = None
+            scan_pc_filt = None
         
         # Transform map pointcloud to scan frame
         map_pts = torch.from_numpy(map_pts)
@@ -389,15 +542,38 @@ class ICPWeightDataset():
 
         # Next, filter the map points based on field of view and z-normal value
         # We only do filtering for lidar
-        map_pts_sensor_frame, map_norms_sensor_frame = self.filter_map(map_pts_sensor_frame, map_norms_sensor_frame, T_ml_gt, return_aligned=self.gt_eye)
+        map_pts_filt, map_norms_filt, valid_pts = self.filter_map(map_pts_sensor_frame, map_norms_sensor_frame, T_ml_gt, return_aligned=self.gt_eye)
+
+        # Form the correspondence index of the map in the map sensor frame
+        # The voxel ordering only depends on the teach vertex, so it is built once
+        # and only the points removed by the filter are dropped per sample
+        if self.nn_voxel_size is not None and self.map_voxel_size is not None:
+            # Downsampled points depend on the filter, so they are indexed per sample
+            keys_sorted, order = sort_by_voxel(map_pts_filt[:, :2], self.nn_voxel_size)
+            valid_ds = torch.ones((map_pts_filt.shape[0],), dtype=torch.bool)
+            map_index = index_from_sorted(keys_sorted, order, valid_ds, self.max_map_pts)
+            map_index['T_nn'] = torch.eye(4, dtype=self.float_type)
+        elif self.nn_voxel_size is not None:
+            map_key = (graph_id, map_stamp)
+            with self.graph_lock:
+                if map_key not in self.map_index_cache:
+                    self.map_index_cache[map_key] = sort_by_voxel(map_pts_sensor_frame[:, :2], self.nn_voxel_size)
+                keys_sorted, order = self.map_index_cache[map_key]
+            map_index = index_from_sorted(keys_sorted, order, valid_pts, self.max_map_pts)
+            if self.gt_eye:
+                map_index['T_nn'] = torch.inverse(T_ml_gt)
+            else:
+                map_index['T_nn'] = torch.eye(4, dtype=self.float_type)
+        else:
+            map_index = None
 
         # Make map_pc batchable
-        map_pc_pad = self.target_pad_val*torch.ones((self.max_map_pts - map_pts_sensor_frame.shape[0], 3), dtype=self.float_type)
-        map_pts_pc = torch.cat((map_pts_sensor_frame, map_pc_pad), dim=0)
-        map_norms_pc = torch.cat((map_norms_sensor_frame, map_pc_pad), dim=0)
+        map_pc_pad = self.target_pad_val*torch.ones((self.max_map_pts - map_pts_filt.shape[0], 3), dtype=self.float_type)
+        map_pts_pc = torch.cat((map_pts_filt, map_pc_pad), dim=0)
+        map_norms_pc = torch.cat((map_norms_filt, map_pc_pad), dim=0)
         map_pc = torch.cat((map_pts_pc, map_norms_pc), dim=1)
 
-        return scan_pc_raw, scan_pc_filt, map_pc, loc_stamp, map_stamp
+        return scan_pc_raw, scan_pc_filt, map_pc, map_index, loc_stamp, map_stamp
 
     def filter_map(self, map_pts, map_norms, T_ml_gt, return_aligned=False):
         # Transform map points to loc frame using gt to filter
@@ -405,9 +581,8 @@ class ICPWeightDataset():
         map_norms_loc_frame = (T_ml_gt[:3,:3] @ map_norms.T).T
 
         # Filter by elevation and z-normal score
-        # TODO: Make these parameters
-        elevation_threshold = 0.05
-        z_normal_threshold = 0.9
+        elevation_threshold = self.elevation_threshold
+        z_normal_threshold = self.z_normal_threshold
         p_in_s = map_pts_loc_frame
         elev = torch.abs(torch.atan2(p_in_s[:,2], torch.sqrt(p_in_s[:,0] * p_in_s[:,0] + p_in_s[:,1] * p_in_s[:,1])))
         z_norm = torch.abs(map_norms_loc_frame[:,2])
@@ -417,12 +592,43 @@ class ICPWeightDataset():
             valid_pts = torch.ones((map_pts_loc_frame.shape[0],), dtype=torch.bool)
         
         # Extract only valid points
+        map_pts = map_pts[valid_pts]
+        map_norms = map_norms[valid_pts]
+
+        # Downsample in the map frame, so that the voxel grid is fixed for a teach vertex
+        if self.map_voxel_size is not None:
+            map_pts, map_norms = voxel_downsample(map_pts, map_norms, self.map_voxel_size, dim=self.map_voxel_dim)
+
         if return_aligned:
-            return map_pts_loc_frame[valid_pts], map_norms_loc_frame[valid_pts]
-        else:
-            return map_pts[valid_pts], map_norms[valid_pts]
+            map_pts = (T_ml_gt[:3,:3] @ map_pts.T + T_ml_gt[:3, 3:4]).T
+            map_norms = (T_ml_gt[:3,:3] @ map_norms.T).T
+        return map_pts, map_norms, valid_pts
     
-    def augment_data(self, scan_pc_raw, scan_pc_filt, map_pc, azimuths, fft_data, fft_cfar):
+    def compact_image(self, image):
+        # Radar images are in [0, 1] and come from 8-bit pngs, so uint8 is exact for polar
+        # images and within half a step for interpolated cartesian ones
+        if self.transport_dtype == 'uint8':
+            image_q = torch.round(torch.clamp(image, 0.0, 1.0) * 255.0).type(torch.uint8)
+            return image_q, 1.0 / 255.0
+        elif self.transport_dtype == 'float16':
+            return image.type(torch.float16), 1.0
+        raise ValueError("Invalid transport_dtype: " + str(self.transport_dtype))
+
+    def form_targets(self, index, map_pc, fft_data=None, azimuths=None):
+        # Form the binary mask loss targets of a sample and store them in the target cache
+        targets = {}
+        if 'fft_target' in self.target_frames:
+            if self.network_input_type == 'cartesian':
+                fft_data = radar_polar_to_cartesian_diff(fft_data.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res,
+                                                         cart_resolution=self.cart_resolution, cart_pixel_width=self.cart_pixel_width).squeeze(0)
+            # Same threshold as the fft mask loss, relative to the mean of the whole image
+            targets['fft_target'] = (fft_data > 3.0*torch.mean(fft_data)).numpy()
+        if 'map_pts_target' in self.target_frames:
+            targets['map_pts_target'] = extract_bev_from_pts(map_pc.unsqueeze(0), cart_resolution=self.cart_resolution,
+                                                             cart_pixel_width=self.cart_pixel_width).squeeze(0).numpy()
+        return self.target_cache.save(index, targets)
+
+    def augment_data(self, scan_pc_raw, scan_pc_filt, map_pc, azimuths, az_timestamps, fft_data, fft_cfar, targets=None):
         if not self.gt_eye:
             raise NotImplementedError('Only gt_eye=True is supported at this time')
 
@@ -432,8 +638,11 @@ class ICPWeightDataset():
                                 [torch.sin(angle), torch.cos(angle)]], dtype=self.float_type)
         
         # Rotate map pointcloud
-        scan_pc_raw[:,:2] = torch.matmul(scan_pc_raw[:,:2], rot_mat)
-        scan_pc_filt[:,:2] = torch.matmul(scan_pc_filt[:,:2], rot_mat)
+        # Scan pointclouds are not loaded when they are extracted from the fft data
+        if scan_pc_raw is not None:
+            scan_pc_raw[:,:2] = torch.matmul(scan_pc_raw[:,:2], rot_mat)
+        if scan_pc_filt is not None:
+            scan_pc_filt[:,:2] = torch.matmul(scan_pc_filt[:,:2], rot_mat)
         map_pc[:,:2] = torch.matmul(map_pc[:,:2], rot_mat)
         if map_pc.shape[1] == 6:
             map_pc[:,3:5] = torch.matmul(map_pc[:,3:5], rot_mat)
@@ -446,10 +655,20 @@ class ICPWeightDataset():
         min_az_idx = torch.argmin(azimuths)
         # Roll azimuths and fft data so that min azimuth is at index 0
         azimuths = torch.roll(azimuths, -min_az_idx.item(), dims=0)
+        az_timestamps = torch.roll(az_timestamps, -min_az_idx.item(), dims=0)
         fft_data = torch.roll(fft_data, -min_az_idx.item(), dims=0)
-        fft_cfar = torch.roll(fft_cfar, -min_az_idx.item(), dims=0)
+        if fft_cfar is not None:
+            fft_cfar = torch.roll(fft_cfar, -min_az_idx.item(), dims=0)
 
-        return scan_pc_raw, scan_pc_filt, map_pc, azimuths, fft_data, fft_cfar
+        # Roll the bit-packed polar mask loss targets in place
+        # Cartesian targets are not cached when augmenting, see cached_target_frames
+        if targets is not None:
+            for name, packed in targets.items():
+                shape = self.target_cache.target_shapes[name]
+                target = np.unpackbits(packed)[:shape[0]*shape[1]].reshape(shape)
+                targets[name] = pack_target(np.roll(target, -min_az_idx.item(), axis=0))
+
+        return scan_pc_raw, scan_pc_filt, map_pc, azimuths, az_timestamps, fft_data, fft_cfar, angle
 
     def get_item_from_loc_timestamp(self, loc_stamp_req):
         # Find the index of the loc_stamp
@@ -459,38 +678,8 @@ class ICPWeightDataset():
         index = [i for i, s in enumerate(self.loc_radar_path_list) if loc_radar_path_to_find in s]
         assert index != [], 'loc_stamp_req not found in dataset'
         index = index[0]
-        # Load in initial guess
-        T_init = self.T_loc_init[index]
-
-        # Load in ground truth localization to map pose
-        T_ml_gt = self.T_loc_gt[index]
 
-        # Load in pointclouds and timestamps
-        scan_pc_raw, scan_pc_filt, map_pc, loc_stamp, map_stamp = self.load_graph_data(index, T_ml_gt)
-        assert scan_pc_raw.shape == scan_pc_filt.shape, 'Raw and filtered pointclouds dont match!'
-        assert loc_stamp_req == loc_stamp, 'loc_stamp_req does not match loc_stamp'
-
-        loc_radar_img = cv2.imread(self.loc_radar_path_list[index], cv2.IMREAD_GRAYSCALE)
-        fft_data, azimuths, az_timestamps = load_radar(loc_radar_img)
-        fft_data = torch.tensor(fft_data, dtype=self.float_type)
-        azimuths = torch.tensor(azimuths, dtype=self.float_type)
-        az_timestamps = torch.tensor(az_timestamps, dtype=self.float_type)
-
-        fft_cfar = cv2.imread(self.loc_cfar_path_list[index], cv2.IMREAD_GRAYSCALE)
-        fft_cfar = torch.tensor(fft_cfar, dtype=self.float_type)/255.0
-
-        # Deal with data augmentation
-        if self.augment:
-            scan_pc_raw, scan_pc_filt, map_pc, azimuths, fft_data, fft_cfar = \
-                self.augment_data(scan_pc_raw, scan_pc_filt, map_pc, azimuths, fft_data, fft_cfar)
-
-        if self.network_input_type == 'cartesian':
-            fft_data = radar_polar_to_cartesian_diff(fft_data.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res).squeeze(0)
-            fft_cfar = radar_polar_to_cartesian_diff(fft_cfar.unsqueeze(0), azimuths.unsqueeze(0), self.polar_res).squeeze(0)
-
-        loc_data = {'raw_pc': scan_pc_raw, 'filtered_pc': scan_pc_filt,
-                    'fft_data' : fft_data, 'fft_cfar' : fft_cfar, 'timestamp' : loc_stamp}
-        map_data = {'pc': map_pc, 'timestamp' : map_stamp}
-        T_data = {'T_ml_init' : T_init, 'T_ml_gt' : T_ml_gt}
+        item = self.__getitem__(index)
+        assert loc_stamp_req == item['loc_data']['timestamp'], 'loc_stamp_req does not match loc_stamp'
 
-        return {'loc_data': loc_data, 'map_data': map_data, 'transforms': T_data}
\ No newline at end of file
+        return item
\ No newline at end of file
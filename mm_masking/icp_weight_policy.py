@@ -1,10 +1,16 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 from torch.nn import ModuleList
+from torch.utils.checkpoint import checkpoint
 from dICP.ICP import ICP
-from radar_utils import load_pc_from_file, cfar_mask, extract_pc, radar_polar_to_cartesian_diff, radar_cartesian_to_polar, radar_polar_to_cartesian, extract_weights, point_to_cart_idx, form_cart_range_angle_grid, form_polar_range_grid
+from mask_cache import MaskCache, policy_cache_key
+from target_cache import cached_target_frames
+from timing_utils import StageTimer
+from icp_utils import solve_icp, implicit_icp_refinement, build_map_index, compact_scan_pc, evaluate_icp_solution
+from radar_utils import load_pc_from_file, get_num_range_bins, cfar_mask, extract_pc, extract_scan_pc, radar_polar_to_cartesian_diff, radar_cartesian_to_polar, radar_polar_to_cartesian, extract_weights, point_to_cart_idx, form_cart_range_angle_grid, form_polar_range_grid
 from neptune.types import File
 import time
 
@@ -21,6 +27,41 @@ def weights_init(m):
         except AttributeError:
             print("Skipping initialization of ", classname)
 
+def required_inputs(params):
+    # Scan fields of a batch that the policy and the losses use
+    # The dataset does not load, convert or send the others
+    required = set()
+    # Cartesian fft targets are formed from the fft data when training with augmentation
+    targets_cached = params["target_cache_dir"] is not None and \
+        'fft_target' in cached_target_frames(params, params["augment"])
+    if params["fft_input"] or params["range_input"] or (params["loss_fft_mask_weight"] > 0.0 and not targets_cached):
+        required.add('fft_data')
+    if params["scan_pc_source"] == 'cfar' and params["network_input_type"] == 'polar':
+        # Scan points are extracted from the polar fft data
+        required.add('fft_data')
+    if params["cfar_input"] or params["loss_cfar_mask_weight"] > 0.0:
+        required.add('fft_cfar')
+    if params["scan_pc_source"] == 'vtr':
+        required.add('raw_pc')
+        # Lidar loc scans have no separate raw pointcloud, the filtered one is used for both
+        if not (params["map_sensor"] == 'lidar' and params["loc_sensor"] == 'lidar'):
+            required.add('filtered_pc')
+    return required
+
+def decode_scan_images(batch_scan, device, float_type):
+    # Move the radar images of a batch to device and convert them to float_type in place
+    # Images sent in a compact transport dtype are multiplied by the scale sent with them
+    for name in ['fft_data', 'fft_cfar', 'fft_polar']:
+        if name not in batch_scan:
+            continue
+        image = batch_scan[name].to(device)
+        if image.dtype != float_type:
+            image = image.type(float_type)
+            if name + '_scale' in batch_scan:
+                image = image * batch_scan[name + '_scale'].to(device).type(float_type).reshape(-1, 1, 1)
+        batch_scan[name] = image
+    return batch_scan
+
 class LearnICPWeightPolicy(nn.Module):
     def __init__(self, params):
         super().__init__()
@@ -40,26 +81,45 @@ class LearnICPWeightPolicy(nn.Module):
         init_weights=params["init_weights"]
         normalize_type=params["normalize"]
         log_transform=params["log_transform"]
+        normalize_stats=params["normalize_stats"]
         a_threshold=params["a_thresh"]
         b_threshold=params["b_thresh"]
         gt_eye=params["gt_eye"]
         max_iter=params["max_iter"]
+        scan_pc_source=params["scan_pc_source"]
+        max_range=params["max_range"]
+        cart_resolution=params["cart_resolution"]
+        cart_pixel_width=params["cart_pixel_width"]
+
+        # The UNet mask has the same layout as its input
+        if network_input_type != network_output_type:
+            raise ValueError("network_output_type must match network_input_type")
 
         if params["loss_icp_rot_weight"] > 0.0 and params["loss_icp_trans_weight"] > 0.0:
             self.use_ICP_4_train = True
         else:
             self.use_ICP_4_train = False
 
-        config_path = '../external/dICP/config/dICP_config.yaml'
-        self.ICP_alg = ICP(icp_type=icp_type, config_path=config_path, differentiable=True, max_iterations=max_iter, tolerance=1e-5)
-        self.ICP_alg_inference = ICP(icp_type=icp_type, config_path=config_path, differentiable=False, max_iterations=50, tolerance=1e-5)
+        # ICP settings
+        self.icp_trim_dist = params["icp_trim_dist"]
+        self.icp_loss = params["icp_loss"]
+        self.icp_loss_scale = params["icp_loss_scale"]
+        self.icp_max_iter_inference = params["icp_max_iter_inference"]
+        self.icp_tolerance = params["icp_tolerance"]
+
+        self.icp_config_path = '../external/dICP/config/dICP_config.yaml'
+        self.ICP_alg = ICP(icp_type=icp_type, config_path=self.icp_config_path, differentiable=True, max_iterations=max_iter, tolerance=self.icp_tolerance)
+        self.ICP_alg_inference = ICP(icp_type=icp_type, config_path=self.icp_config_path, differentiable=False,
+                                     max_iterations=self.icp_max_iter_inference, tolerance=self.icp_tolerance)
         self.float_type = float_type
         self.device = device
         self.network_inputs = network_inputs
         if network_input_type == 'cartesian':
-            self.range_mask, _ = form_cart_range_angle_grid(device=device)
+            self.range_mask, _ = form_cart_range_angle_grid(cart_resolution=cart_resolution, cart_pixel_width=cart_pixel_width, device=device)
         elif network_input_type == 'polar':
-            self.range_mask = form_polar_range_grid(polar_resolution=self.res, device=device)
+            # Polar scans are cropped to max_range when loaded
+            polar_pixel_shape = (400, get_num_range_bins(3360, max_range=max_range, res=self.res))
+            self.range_mask = form_polar_range_grid(polar_resolution=self.res, polar_pixel_shape=polar_pixel_shape, device=device)
         
         self.network_input_type = network_input_type
         self.network_output_type = network_output_type
@@ -68,10 +128,44 @@ class LearnICPWeightPolicy(nn.Module):
         self.batch_norm = batch_norm
         self.normalize_type = normalize_type
         self.log_transform = log_transform
+        self.normalize_stats = normalize_stats
         self.a_thres = a_threshold
         self.b_thres = b_threshold
         self.gt_eye = gt_eye
+        self.scan_pc_source = scan_pc_source
+        self.max_range = max_range
+        self.cart_resolution = cart_resolution
+        self.cart_pixel_width = cart_pixel_width
         self.norm_weights = params['norm_weights']
+        self.optimized_inference = params["optimized_inference"]
+        # Compact dtype the radar images are sent in, the network input is quantized with it
+        self.transport_dtype = params["transport_dtype"]
+        self.grad_checkpoint = params["grad_checkpoint"]
+        self.icp_type = icp_type
+        self.icp_grad = params["icp_grad"]
+        self.implicit_max_iter = params["implicit_max_iter"]
+        self.icp_solver = params["icp_solver"]
+        # The implicit gradient is taken at the native solver's solution, so validation and checkpoint
+        # selection must use the same solver
+        if self.icp_grad == 'implicit' and self.icp_solver != 'native':
+            raise ValueError("icp_grad 'implicit' requires icp_solver 'native'")
+        self.nn_voxel_size = params["nn_voxel_size"]
+        self.max_iter = max_iter
+        self.icp_weight_threshold = params["icp_weight_threshold"]
+        self.icp_top_k = params["icp_top_k"]
+        # Only the mask network runs in mixed precision, weight extraction and ICP
+        # stay in float_type
+        if params["mixed_precision"] == "bf16":
+            self.autocast_dtype = torch.bfloat16
+        elif params["mixed_precision"] == "fp16":
+            self.autocast_dtype = torch.float16
+        else:
+            self.autocast_dtype = None
+        # Compiled channels-last copy of the mask network layers used by infer_mask
+        # Kept in a dict so that it is not registered as a submodule and saved with the weights
+        self.inference_network = {}
+        self.mask_cache = None
+        self.upsample_sizes = {}
 
         # Parameters saving
         self.mean_num_pts = 0.0
@@ -79,9 +173,20 @@ class LearnICPWeightPolicy(nn.Module):
         self.min_w = 0.0
         self.mean_w = 0.0
         self.mean_all_pts = 0.0
+        self.icp_num_iters = None
+        # Per-sample solver stats of the last ICP call, see icp_stats
+        self.icp_stats_enabled = params["icp_stats"]
+        self.icp_stats = None
+        # Times the stages of forward, set by the training loop when stage timing is on
+        self.timer = StageTimer(enabled=False)
 
         # Define network
         init_c_num = network_inputs['fft'] + network_inputs['cfar'] + network_inputs['range']
+        if normalize_stats == 'dataset':
+            # Per channel normalization as input_scale * input + input_bias, set from the
+            # training set by compute_normalization_stats and saved with the weights
+            self.register_buffer('input_scale', torch.ones((1, init_c_num, 1, 1), dtype=float_type, device=device))
+            self.register_buffer('input_bias', torch.zeros((1, init_c_num, 1, 1), dtype=float_type, device=device))
         enc_channels = [init_c_num, 8, 16, 32, 64, 128, 256]
         dec_channels = [256, 128, 64, 32, 16, 8]
 
@@ -124,67 +229,51 @@ class LearnICPWeightPolicy(nn.Module):
 
         return nn.Sequential(*modules)
 
-    def forward(self, batch_scan, batch_map, T_init, binary=False, override_mask=None, neptune_run=None, epoch=0, batch_idx=0, mask_only=False):
+    def forward(self, batch_scan, batch_map, T_init, binary=False, override_mask=None, neptune_run=None, epoch=0, batch_idx=0, mask_only=False, icp_inputs_only=False):
         # If override_mask is not None, then don't use network to get mask, just use override_mask
         # Extract points
-        fft_data = batch_scan['fft_data'].to(self.device)#.requires_grad_(True)
-        fft_cfar = batch_scan['fft_cfar'].to(self.device)
-        scan_pc_raw = batch_scan['raw_pc'].to(self.device)
+        # Images that are not used are not loaded by the dataset, see required_inputs
+        decode_scan_images(batch_scan, self.device, self.float_type)
+        fft_data = batch_scan['fft_data'].to(self.device) if 'fft_data' in batch_scan else None
+        fft_cfar = batch_scan['fft_cfar'].to(self.device) if 'fft_cfar' in batch_scan else None
+        if self.scan_pc_source == 'cfar':
+            # Extract scan points from the polar fft data on the compute device
+            scan_pc_raw = self.extract_scan_pc(batch_scan)
+        else:
+            scan_pc_raw = batch_scan['raw_pc'].to(self.device)
         #map_pc_paths = batch_map['pc_path']
         map_pc = batch_map['pc'].to(self.device)
+        # Correspondence index of the map precomputed by the dataset, if any
+        if 'nn_keys' in batch_map:
+            map_index = {key: batch_map[key].to(self.device) for key in ['nn_keys', 'nn_starts', 'nn_counts', 'nn_idx', 'T_nn']}
+        else:
+            map_index = None
 
+        self.timer.tic('forward/mask')
         if override_mask is None:
-            input_data = None
-            # Convert input data to desired network input
-            if self.network_inputs['fft']:
-                # FFT image is already in polar or cartesian
-                input_data = fft_data.unsqueeze(1)
-            if self.network_inputs['cfar']:
-                # CFAR image is already in polar or cartesian
-                input_data = torch.cat([input_data, fft_cfar.unsqueeze(1)], dim=1)
-            if self.network_inputs['range']:
-                range_stack = torch.stack([self.range_mask for i in range(input_data.shape[0])], dim=0).unsqueeze(1)
-                input_data = torch.cat([input_data, range_stack], dim=1)
-
-            if self.log_transform:
-                input_data = torch.log(input_data + 1e-6)
-            for c in range(input_data.shape[1]):
-                if "minmax" in self.normalize_type:
-                    c_max = torch.max(input_data[:,c,:,:])
-                    c_min = torch.min(input_data[:,c,:,:])
-                    input_data[:,c,:,:] = (input_data[:,c,:,:] - c_min) / (c_max - c_min)
-                elif "standardize" in self.normalize_type:
-                    c_mean = torch.mean(input_data[:,c,:,:])
-                    c_std = torch.std(input_data[:,c,:,:])
-                    input_data[:,c,:,:] = (input_data[:,c,:,:] - c_mean) / c_std
-
-            # Encoder
-            enc_layers = []
-            for i, layer in enumerate(self.encoder):
-                enc_layers.append(input_data)
-                input_data = layer(input_data)
-            enc_layers.reverse()
-
-            # Decoder
-            for i, decoder_layer in enumerate(self.decoder):
-                # Load in skip connection
-                skip_con = enc_layers[i]
-                # Upsample input data to match skip connection
-                bi_w = skip_con.shape[2]
-                bi_h = skip_con.shape[3]
-                bi_upsample = nn.UpsamplingBilinear2d(size=(bi_w, bi_h))
-                input_data = bi_upsample(input_data)
-                # Now convolve using decoder to reduce channels
-                input_data = decoder_layer(input_data)
-                # Concatenate with skip connection
-                input_data = torch.cat([enc_layers[i], input_data], dim=1)
-                # Pass through decoder again
-                input_data = decoder_layer(input_data)
-
-            weight_mask = self.final_layer(input_data).squeeze(1)
-
-            del input_data, enc_layers, bi_upsample, bi_w, bi_h, skip_con
-            torch.cuda.empty_cache()
+            # Masks of a frozen policy can be read from the mask cache
+            use_cache = self.mask_cache is not None and not self.training and not torch.is_grad_enabled()
+            weight_mask_q = None
+            if use_cache:
+                weight_mask_q = self.mask_cache.load(batch_scan['timestamp'])
+
+            if weight_mask_q is None:
+                input_data = self.form_network_input(fft_data, fft_cfar)
+                with torch.autocast(device_type=torch.device(self.device).type, dtype=self.autocast_dtype,
+                                    enabled=self.autocast_dtype is not None):
+                    if self.optimized_inference and not self.training and not torch.is_grad_enabled():
+                        weight_mask = self.infer_mask(input_data)
+                    else:
+                        weight_mask = self.mask_network(input_data)
+                weight_mask = weight_mask.type(self.float_type)
+                del input_data
+                if use_cache:
+                    weight_mask_q = self.mask_cache.save(batch_scan['timestamp'], weight_mask)
+
+            # Use the quantized mask whether it was cached or not, so that results
+            # do not depend on the state of the cache
+            if weight_mask_q is not None:
+                weight_mask = weight_mask_q.to(self.device).type(self.float_type) / 255.0
         else:
             weight_mask = override_mask
 
@@ -194,13 +283,23 @@ class LearnICPWeightPolicy(nn.Module):
 
         if binary:
             weight_mask = torch.where(weight_mask > 0.5, 1.0, 0.0)
+        self.timer.toc('forward/mask')
 
         if mask_only:
             return weight_mask
 
         # Extract weights correcponding to scan_pc
         # Check if weight mask is as 1's, then dont need to extract
-        weights, diff_mean_num_non0, mean_num_non0, mean_w, max_w, min_w = extract_weights(weight_mask, scan_pc_raw)
+        self.timer.tic('forward/weights')
+        if self.network_output_type == 'polar':
+            # Sample polar mask directly using the range and azimuth of each point
+            azimuths = batch_scan['azimuths'].to(self.device)
+            weights, diff_mean_num_non0, mean_num_non0, mean_w, max_w, min_w = extract_weights(weight_mask, scan_pc_raw,
+                                                                                              azimuths=azimuths, radar_resolution=self.res)
+        else:
+            weights, diff_mean_num_non0, mean_num_non0, mean_w, max_w, min_w = extract_weights(weight_mask, scan_pc_raw,
+                                                                                              cart_resolution=self.cart_resolution)
+        self.timer.toc('forward/weights')
         
         # Save params
         self.mean_num_pts = mean_num_non0
@@ -214,9 +313,12 @@ class LearnICPWeightPolicy(nn.Module):
         self.mean_all_pts = torch.sum(non0_pts) / scan_pc_raw.shape[0]
 
         del fft_data, fft_cfar
-        torch.cuda.empty_cache()
 
-        scan_pc_filt = batch_scan['filtered_pc'].to(self.device)
+        if self.scan_pc_source == 'cfar' or 'filtered_pc' not in batch_scan:
+            # CFAR points, or lidar scans, are used for both weight extraction and ICP
+            scan_pc_filt = scan_pc_raw
+        else:
+            scan_pc_filt = batch_scan['filtered_pc'].to(self.device)
 
         if neptune_run is not None and batch_idx <= 10:
             # Plot the scan and map pointclouds
@@ -270,14 +372,295 @@ class LearnICPWeightPolicy(nn.Module):
         if self.training and not self.use_ICP_4_train:
             return T_init, weight_mask, diff_mean_num_non0
 
-        T_est = self.icp(scan_pc_filt, map_pc, T_init, weights)
+        # Only pass the points that matter to ICP
+        if self.icp_weight_threshold is not None or self.icp_top_k is not None:
+            scan_pc_filt, weights = compact_scan_pc(scan_pc_filt, weights, weight_threshold=self.icp_weight_threshold,
+                                                    top_k=self.icp_top_k)
+
+        # Everything ICP needs, e.g. to run it with several settings over the same weights
+        if icp_inputs_only:
+            return scan_pc_filt, map_pc, T_init, weights, map_index
+
+        # With several initial guesses per scan (B, K, 4, 4), the mask and weights
+        # are shared and ICP is solved for each guess along the batch dimension
+        if T_init.dim() == 4:
+            num_hyp = T_init.shape[1]
+            scan_pc_filt = scan_pc_filt.repeat_interleave(num_hyp, dim=0)
+            weights = weights.repeat_interleave(num_hyp, dim=0)
+            map_pc = map_pc.repeat_interleave(num_hyp, dim=0)
+            if map_index is not None:
+                map_index = {key: value.repeat_interleave(num_hyp, dim=0) for key, value in map_index.items()}
+            self.timer.tic('forward/icp')
+            T_est = self.icp(scan_pc_filt, map_pc, T_init.reshape(-1, 4, 4), weights, map_index=map_index)
+            self.timer.toc('forward/icp')
+            return T_est.reshape(-1, num_hyp, 4, 4), weight_mask, diff_mean_num_non0
+
+        self.timer.tic('forward/icp')
+        T_est = self.icp(scan_pc_filt, map_pc, T_init, weights, map_index=map_index)
+        self.timer.toc('forward/icp')
 
         return T_est, weight_mask, diff_mean_num_non0
     
-    def icp(self, scan_pc, map_pc, T_init, weights):
-        loss_fn = {"name": "cauchy", "metric": 1.0}
-        trim_dist = 5.0
-        if self.training:
+    def form_network_input(self, fft_data, fft_cfar):
+        input_data = self.stack_network_input(fft_data, fft_cfar)
+
+        if self.normalize_stats == 'dataset':
+            # Fixed affine from the training set statistics, does not depend on the batch
+            if "minmax" in self.normalize_type or "standardize" in self.normalize_type:
+                input_data = torch.addcmul(self.input_bias, input_data, self.input_scale)
+        # Normalize each channel over the whole batch
+        elif "minmax" in self.normalize_type:
+            c_max = torch.amax(input_data, dim=(0,2,3), keepdim=True)
+            c_min = torch.amin(input_data, dim=(0,2,3), keepdim=True)
+            input_data = (input_data - c_min) / (c_max - c_min)
+        elif "standardize" in self.normalize_type:
+            c_mean = torch.mean(input_data, dim=(0,2,3), keepdim=True)
+            c_std = torch.std(input_data, dim=(0,2,3), keepdim=True)
+            input_data = (input_data - c_mean) / c_std
+
+        return input_data
+
+    def stack_network_input(self, fft_data, fft_cfar):
+        # Convert input data to desired network input, before normalization
+        # FFT and CFAR images are already in polar or cartesian
+        input_channels = []
+        if self.network_inputs['fft']:
+            input_channels.append(fft_data.unsqueeze(1))
+        if self.network_inputs['cfar']:
+            input_channels.append(fft_cfar.unsqueeze(1))
+        if self.network_inputs['range']:
+            range_stack = self.range_mask.expand(fft_data.shape[0], 1, -1, -1)
+            input_channels.append(range_stack.type(fft_data.dtype))
+        input_data = torch.cat(input_channels, dim=1)
+
+        if self.log_transform:
+            input_data = torch.log(input_data + 1e-6)
+
+        return input_data
+
+    def compute_normalization_stats(self, iterator):
+        # Single streaming pass over iterator to set the per channel normalization
+        # Sums are accumulated in float64 so that the mean and std are exact over large datasets
+        c_num = self.input_scale.shape[1]
+        c_min = torch.full((c_num,), float('inf'), dtype=torch.float64, device=self.device)
+        c_max = torch.full((c_num,), -float('inf'), dtype=torch.float64, device=self.device)
+        c_sum = torch.zeros((c_num,), dtype=torch.float64, device=self.device)
+        c_sum_sq = torch.zeros((c_num,), dtype=torch.float64, device=self.device)
+        num_px = 0
+        with torch.no_grad():
+            for batch in iterator:
+                decode_scan_images(batch['loc_data'], self.device, self.float_type)
+                fft_data = batch['loc_data']['fft_data'].to(self.device) if 'fft_data' in batch['loc_data'] else None
+                fft_cfar = batch['loc_data']['fft_cfar'].to(self.device) if 'fft_cfar' in batch['loc_data'] else None
+                input_data = self.stack_network_input(fft_data, fft_cfar).type(torch.float64)
+                c_min = torch.minimum(c_min, torch.amin(input_data, dim=(0,2,3)))
+                c_max = torch.maximum(c_max, torch.amax(input_data, dim=(0,2,3)))
+                c_sum += torch.sum(input_data, dim=(0,2,3))
+                c_sum_sq += torch.sum(input_data**2, dim=(0,2,3))
+                num_px += input_data.shape[0] * input_data.shape[2] * input_data.shape[3]
+
+        if "minmax" in self.normalize_type:
+            c_shift = c_min
+            c_scale = 1.0 / (c_max - c_min)
+        else:
+            c_shift = c_sum / num_px
+            c_scale = 1.0 / torch.sqrt(c_sum_sq / num_px - c_shift**2)
+        self.input_scale.copy_(c_scale.reshape(1, -1, 1, 1))
+        self.input_bias.copy_((-c_shift * c_scale).reshape(1, -1, 1, 1))
+
+        return {"min": c_min.cpu(), "max": c_max.cpu(), "mean": (c_sum / num_px).cpu(),
+                "std": torch.sqrt(c_sum_sq / num_px - (c_sum / num_px)**2).cpu()}
+
+    def get_upsample_sizes(self, input_shape):
+        # Sizes of the skip connections used by each decoder stage
+        # These only depend on the input shape, so are computed once per shape
+        if input_shape not in self.upsample_sizes:
+            size = input_shape
+            enc_sizes = [size]
+            for i in range(len(self.encoder) - 1):
+                # All encoder blocks except the first end with a maxpool
+                if i > 0:
+                    size = (size[0] // 2, size[1] // 2)
+                enc_sizes.append(size)
+            enc_sizes.reverse()
+            self.upsample_sizes[input_shape] = enc_sizes[:len(self.decoder)]
+        return self.upsample_sizes[input_shape]
+
+    def mask_network(self, input_data, layers=None):
+        # layers holds the encoder, decoder and final layer to run, the policy's own by default
+        encoder = self.encoder if layers is None else layers["encoder"]
+        decoder = self.decoder if layers is None else layers["decoder"]
+        final_layer = self.final_layer if layers is None else layers["final_layer"]
+        upsample_sizes = self.get_upsample_sizes(tuple(input_data.shape[2:]))
+
+        # Encoder
+        enc_layers = []
+        for i, layer in enumerate(encoder):
+            enc_layers.append(input_data)
+            input_data = self.run_block(layer, input_data)
+        enc_layers.reverse()
+
+        # Decoder
+        for i, decoder_layer in enumerate(decoder):
+            # Upsample input data to match skip connection
+            input_data = F.interpolate(input_data, size=upsample_sizes[i], mode='bilinear', align_corners=True)
+            # Now convolve using decoder to reduce channels
+            input_data = self.run_block(decoder_layer, input_data)
+            # Concatenate with skip connection
+            input_data = torch.cat([enc_layers[i], input_data], dim=1)
+            # Pass through decoder again
+            input_data = self.run_block(decoder_layer, input_data)
+
+        weight_mask = final_layer(input_data).squeeze(1)
+
+        return weight_mask
+
+    def run_block(self, block, input_data):
+        # With gradient checkpointing, the block activations are not stored for the
+        # backward pass but recomputed from the block input instead
+        if self.grad_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint(block, input_data, use_reentrant=False)
+        return block(input_data)
+
+    def infer_mask(self, input_data):
+        # Run a compiled channels-last copy of the mask network layers, the trained layers are left as is
+        # The copy is made on first use and its weights are refreshed whenever the trained ones changed
+        layers = nn.ModuleDict({"encoder": self.encoder, "decoder": self.decoder, "final_layer": self.final_layer})
+        weights = list(layers.parameters()) + list(layers.buffers())
+        weights_version = sum(weight._version for weight in weights)
+        if len(self.inference_network) == 0 or self.inference_network["device"] != weights[0].device:
+            layers_copy = copy.deepcopy(layers).to(memory_format=torch.channels_last)
+            network = lambda data: self.mask_network(data, layers=layers_copy)
+            self.inference_network = {"layers": layers_copy, "compiled": torch.compile(network), "version": weights_version,
+                                      "device": weights[0].device}
+        elif self.inference_network["version"] != weights_version:
+            layers_copy = self.inference_network["layers"]
+            copies = list(layers_copy.parameters()) + list(layers_copy.buffers())
+            with torch.no_grad():
+                for weight_copy, weight in zip(copies, weights):
+                    weight_copy.copy_(weight)
+            self.inference_network["version"] = weights_version
+        with torch.inference_mode():
+            input_data = input_data.contiguous(memory_format=torch.channels_last)
+            weight_mask = self.inference_network["compiled"](input_data)
+        # Return a regular tensor so that the mask can be used outside of inference mode
+        return weight_mask.contiguous().clone()
+
+    def extract_scan_pc(self, batch_scan):
+        # Polar fft data is only sent separately if the network uses cartesian inputs
+        if 'fft_polar' in batch_scan:
+            fft_polar = batch_scan['fft_polar'].to(self.device)
+        else:
+            fft_polar = batch_scan['fft_data'].to(self.device)
+        azimuths = batch_scan['azimuths'].to(self.device)
+        az_timestamps = batch_scan['az_timestamps'].to(self.device)
+
+        if self.max_range is None:
+            scan_pc = extract_scan_pc(fft_polar, azimuths, az_timestamps, self.res,
+                                      a_thresh=self.a_thres, b_thresh=self.b_thres)
+        else:
+            # max_range only crops the scan, CFAR keeps its 80 m detection limit
+            scan_pc = extract_scan_pc(fft_polar, azimuths, az_timestamps, self.res,
+                                      a_thresh=self.a_thres, b_thresh=self.b_thres, maxr=min(self.max_range, 80.0))
+        return scan_pc.type(self.float_type)
+
+    def enable_mask_cache(self, cache_dir, max_size_mb=1024):
+        # Cache mask network outputs on disk, only used when evaluating without gradients
+        # The key is computed from the current weights, so enable the cache after loading them
+        # Scans are keyed by loc timestamp, so it is only valid for data without augmentation,
+        # and with batch-wise input normalization a mask is the one from the first batch it was in
+        input_config = {"network_input_type": self.network_input_type, "network_inputs": self.network_inputs,
+                        "normalize": self.normalize_type, "normalize_stats": self.normalize_stats, "log_transform": self.log_transform,
+                        "cart_resolution": self.cart_resolution, "cart_pixel_width": self.cart_pixel_width,
+                        "max_range": self.max_range, "autocast_dtype": str(self.autocast_dtype),
+                        "transport_dtype": self.transport_dtype}
+        # Dataset normalization stats are buffers, so they are keyed with the weights
+        if self.network_inputs['cfar']:
+            # The CFAR input image depends on the thresholds it was computed with
+            input_config["a_thres"] = self.a_thres
+            input_config["b_thres"] = self.b_thres
+        self.mask_cache = MaskCache(cache_dir, policy_cache_key(self, input_config), max_size_mb=max_size_mb)
+
+    def set_icp_settings(self, trim_dist=None, loss=None, loss_scale=None, max_iter_inference=None, tolerance=None):
+        # Change the ICP settings, e.g. to sweep them over fixed weights
+        # Settings left as None are kept
+        if trim_dist is not None:
+            self.icp_trim_dist = trim_dist
+        if loss is not None:
+            self.icp_loss = loss
+        if loss_scale is not None:
+            self.icp_loss_scale = loss_scale
+        if max_iter_inference is not None or tolerance is not None:
+            if max_iter_inference is not None:
+                self.icp_max_iter_inference = max_iter_inference
+            if tolerance is not None:
+                self.icp_tolerance = tolerance
+            self.ICP_alg_inference = ICP(icp_type=self.icp_type, config_path=self.icp_config_path, differentiable=False,
+                                         max_iterations=self.icp_max_iter_inference, tolerance=self.icp_tolerance)
+
+    def icp(self, scan_pc, map_pc, T_init, weights, map_index=None):
+        if not self.icp_stats_enabled:
+            return self.icp_solve(scan_pc, map_pc, T_init, weights, map_index=map_index)
+
+        sync = torch.device(self.device).type == 'cuda'
+        if sync:
+            torch.cuda.synchronize()
+        tic = time.perf_counter()
+        T_est = self.icp_solve(scan_pc, map_pc, T_init, weights, map_index=map_index)
+        if sync:
+            torch.cuda.synchronize()
+        batch_time = time.perf_counter() - tic
+
+        # Final residual and inliers are evaluated at the solution, so they are known for dICP too
+        with torch.no_grad():
+            if map_index is None and self.nn_voxel_size is not None:
+                map_index = build_map_index(map_pc, self.nn_voxel_size, self.ICP_alg.target_pad_val)
+            residual, num_inliers = evaluate_icp_solution(scan_pc, map_pc, T_est.detach(), weights.detach(),
+                                                          icp_type=self.icp_type, trim_dist=self.icp_trim_dist,
+                                                          map_index=map_index, voxel_size=self.nn_voxel_size)
+        # Samples of a batch are solved together, so they share its wall time
+        # Iterations are only known for the native solver, -1 otherwise
+        if self.icp_num_iters is not None:
+            num_iters = self.icp_num_iters
+            time_per_iter = batch_time / max(int(torch.max(num_iters)), 1)
+        else:
+            num_iters = torch.full_like(num_inliers, -1)
+            time_per_iter = float('nan')
+        self.icp_stats = {"num_iters": num_iters.cpu(), "residual": residual.cpu(), "num_inliers": num_inliers.cpu(),
+                          "batch_time": torch.full((T_est.shape[0],), batch_time, dtype=torch.float64),
+                          "time_per_iter": torch.full((T_est.shape[0],), time_per_iter, dtype=torch.float64)}
+        return T_est
+
+    def icp_solve(self, scan_pc, map_pc, T_init, weights, map_index=None):
+        loss_fn = {"name": self.icp_loss, "metric": self.icp_loss_scale}
+        trim_dist = self.icp_trim_dist
+        # Iterations taken by each sample, only known for the native solver
+        self.icp_num_iters = None
+        use_native = self.icp_solver == 'native'
+        if use_native and map_index is None and self.nn_voxel_size is not None:
+            # Built once and reused by every ICP iteration
+            map_index = build_map_index(map_pc, self.nn_voxel_size, self.ICP_alg.target_pad_val)
+
+        if self.training and self.icp_grad == 'implicit':
+            # Converge without tracking gradients, then attach the implicit gradient
+            # with respect to weights at the solution
+            with torch.no_grad():
+                T_star, self.icp_num_iters = solve_icp(scan_pc, map_pc, T_init, weights.detach(), icp_type=self.icp_type,
+                                                       trim_dist=trim_dist, loss_fn=loss_fn,
+                                                       max_iterations=self.implicit_max_iter, tolerance=self.icp_tolerance,
+                                                       map_index=map_index, voxel_size=self.nn_voxel_size)
+            return implicit_icp_refinement(scan_pc, map_pc, T_star, weights, icp_type=self.icp_type,
+                                           trim_dist=trim_dist, loss_fn=loss_fn,
+                                           map_index=map_index, voxel_size=self.nn_voxel_size)
+        elif use_native:
+            # Same iteration settings as the dICP instances
+            max_iterations = self.max_iter if self.training else self.icp_max_iter_inference
+            T_est, self.icp_num_iters = solve_icp(scan_pc, map_pc, T_init, weights, icp_type=self.icp_type,
+                                                  trim_dist=trim_dist, loss_fn=loss_fn,
+                                                  max_iterations=max_iterations, tolerance=self.icp_tolerance,
+                                                  map_index=map_index, voxel_size=self.nn_voxel_size)
+            return T_est
+        elif self.training:
             icp_result = self.ICP_alg.icp(scan_pc, map_pc, 
                                     T_init=T_init, weight=weights,
                                     trim_dist=trim_dist, loss_fn=loss_fn, dim=2)
@@ -0,0 +1,70 @@
+import hashlib
+import os
+import os.path as osp
+import numpy as np
+import torch
+
+def policy_cache_key(policy, input_config):
+    # Hash of the policy weights and of the config that turns a scan into network input
+    hasher = hashlib.sha1()
+    for name, tensor in sorted(policy.state_dict().items()):
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    hasher.update(repr(sorted(input_config.items())).encode())
+    return hasher.hexdigest()[:16]
+
+class MaskCache():
+    # Disk cache of mask network outputs of a frozen policy
+    # Masks are stored quantized to uint8, one file per loc timestamp, in a directory
+    # named by the policy key. The least recently used entries are evicted once the
+    # directory grows above max_size_mb.
+    def __init__(self, cache_dir, policy_key, max_size_mb=1024):
+        self.cache_dir = osp.join(cache_dir, policy_key)
+        if not osp.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self.max_size = max_size_mb * 1e6
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy'))
+
+    def entry_path(self, loc_stamp):
+        return osp.join(self.cache_dir, str(int(loc_stamp)) + '.npy')
+
+    def load(self, loc_stamps):
+        # Returns the uint8 masks of all loc_stamps, or None if any of them is missing
+        masks = []
+        for loc_stamp in loc_stamps:
+            path = self.entry_path(loc_stamp)
+            try:
+                masks.append(np.load(path))
+            except (FileNotFoundError, ValueError):
+                return None
+            # Mark as recently used
+            os.utime(path)
+        return torch.from_numpy(np.stack(masks))
+
+    def save(self, loc_stamps, masks):
+        # Store masks with values in [0, 1] and return their uint8 version
+        masks_q = torch.round(torch.clamp(masks.detach(), 0.0, 1.0) * 255).to(torch.uint8).cpu()
+        for loc_stamp, mask_q in zip(loc_stamps, masks_q.numpy()):
+            path = self.entry_path(loc_stamp)
+            if osp.exists(path):
+                self.size -= osp.getsize(path)
+            # Write to a temporary file first so that readers never see partial entries
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, mask_q)
+            os.replace(tmp_path, path)
+            self.size += osp.getsize(path)
+        self.evict()
+        return masks_q
+
+    def evict(self):
+        if self.size <= self.max_size:
+            return
+        entries = [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith('.npy')]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            entry_size = entry.stat().st_size
+            os.remove(entry.path)
+            self.size -= entry_size
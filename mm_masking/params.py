@@ -0,0 +1,111 @@
+import torch
+
+def default_params():
+    params = {
+        "device": torch.device("cuda" if torch.cuda.is_available() else "cpu"),
+
+        # Dataset params
+        "num_train": 1,
+        "num_val": 1,
+        "augment": True,
+        "random": False,
+        "float_type": torch.float32,
+        "use_gt": False,
+        "pos_std": 2.0,             # Standard deviation of position initial guess
+        "rot_std": 0.6,             # Standard deviation of rotation initial guess
+        "num_hypotheses": 0,        # Number of initial guesses per scan in the final robustness evaluation, 0 to skip it
+        "hypothesis_fail_trans": 1.0, # Translation error (m) above which ICP from an initial guess counts as failed
+        "hypothesis_fail_rot": 0.1, # Rotation error (rad) above which ICP from an initial guess counts as failed
+        "gt_eye": True,             # Should ground truth transform be identity?
+        "map_sensor": "lidar",
+        "loc_sensor": "radar",
+        "max_range": None,          # Maximum radar range (m) kept from each scan, None keeps all 3360 bins (~200 m)
+                                    # 80.0 covers the cartesian image and the CFAR range
+        "cart_resolution": 0.2384,  # Cartesian resolution (m/pixel) of network inputs and outputs
+        "cart_pixel_width": 640,    # Cartesian image width (pixels), e.g. 320 with 0.4768 m/pixel covers the same area
+        "scan_pc_source": "vtr",    # Options are "vtr" (pointclouds saved by VTR) and "cfar" (extracted from fft data during training)
+        "map_elevation_threshold": 0.05, # Maximum elevation (rad) of lidar map points seen from the radar
+        "map_z_normal_threshold": 0.9,   # Maximum absolute z component of lidar map point normals
+        "map_voxel_size": None,     # Voxel size (m) the filtered map is downsampled with, None to not downsample
+        "map_voxel_dim": 2,         # Options are 2 and 3, whether map voxels are over x, y or x, y, z
+        "transport_dtype": None,    # Options are None, "uint8" and "float16", compact dtype of the radar images sent by loader workers
+        "log_transform": False,      # True or false for log transform of fft data
+        "normalize": ["minmax"],  # Options are "minmax", "standardize", and none
+                                    # happens after log transform if log transform is true
+        "normalize_stats": "batch", # Options are "batch" and "dataset", normalize with stats of each batch or of one pass over the training set
+
+        # Iterator params
+        "batch_size_train": 16,
+        "batch_size_test": 32,
+        "shuffle": True,
+        "loader": "process",        # Options are "process" (DataLoader workers) and "thread" (thread pool in the main process)
+        "loader_workers": 4,        # Number of DataLoader worker processes
+        "loader_prefetch_factor": 2, # Number of batches each DataLoader worker loads ahead
+        "loader_persistent_workers": True, # Whether DataLoader workers are kept alive across epochs
+        "loader_pin_memory": False, # Whether DataLoader batches are copied to pinned memory
+        "loader_config": None, # Loader settings written by autotune_loader.py, e.g. "loader_config.json", None to keep the settings here
+        "loader_threads": 8,        # Number of threads of the thread loader
+        "loader_prefetch": 4,       # Number of batches the thread loader loads ahead
+        "loader_ordered": True,     # Whether the thread loader returns batches in sampling order or as soon as they are loaded
+        "loader_torch_threads": None, # Number of torch threads while the thread loader runs, None keeps the default. Process wide, so it also applies to the training step
+
+        # Profiling params
+        "stage_timing": False,      # Whether to time the stages of every training and validation step and log their percentiles per epoch
+        "profile_epoch": None,      # Epoch to record a torch.profiler chrome trace in, None for no trace
+        "profile_start_batch": 5,   # First batch of the traced window, earlier batches warm up the loaders and allocator
+        "profile_num_batches": 5,   # Number of traced batches
+
+        # Training params
+        "icp_type": "pt2pt", # Options are "pt2pt" and "pt2pl"
+        "num_epochs": 30,
+        "learning_rate": 1e-4,
+        "leaky": False,   # True or false for leaky relu
+        "dropout": 0.05,   # Dropout rate, set 0 for no dropout
+        "batch_norm": False, # True or false for batch norm
+        "init_weights": True, # True or false for manually initializing weights
+        "clip_value": 0.0, # Value to clip gradients at, set 0 for no clipping
+        "a_thresh": 1.0, # Threshold for CFAR
+        "b_thresh": 0.09, # Threshold for CFAR
+
+        # Choose weights for loss function
+        "loss_icp_rot_weight": 1.0, # Weight for icp rotation error loss
+        "loss_icp_trans_weight": 1.0, # Weight for icp translation error loss
+        "loss_fft_mask_weight": 0.0, # Weight for fft mask loss
+        "loss_map_pts_mask_weight": 1.0, # Weight for map pts mask loss
+        "loss_cfar_mask_weight": 0.0, # Weight for cfar mask loss
+        "num_pts_weight": 0.0, # Weight for number of points loss
+        "optimizer": "adam", # Options are "adam" and "sgd"
+        "icp_loss_only_iter": -1, # Number of iterations after which to only use icp loss
+        "max_iter": 10, # Maximum number of iterations for icp
+        "icp_trim_dist": 5.0, # Correspondences further than this (m) are not used by icp
+        "icp_loss": "cauchy", # Robust loss of icp, the native solver supports "cauchy", "huber", "geman-mcclure" and "L2"
+        "icp_loss_scale": 1.0, # Scale (m) of the robust loss
+        "icp_max_iter_inference": 50, # Maximum number of icp iterations during inference
+        "icp_tolerance": 1e-5, # Icp stops once the update is below this, with icp_solver "native" each sample also stops iterating once its own update is
+        "icp_grad": "unroll", # Options are "unroll" and "implicit", backprop through max_iter icp iterations or implicitly through the converged solution (needs icp_solver "native")
+        "implicit_max_iter": 50, # Maximum number of (untracked) icp iterations when icp_grad is "implicit"
+        "icp_solver": "dicp", # Options are "dicp" and "native", native is opt-in: implicit gradients, the map index and dropping converged samples only exist in it, and it converges from smaller initial errors, see README
+        "icp_weight_threshold": None, # Only scan points with a weight above this are passed to icp, None to pass all
+        "icp_top_k": None, # Only the top k weighted scan points of each scan are passed to icp, None to pass all
+        "nn_voxel_size": 2.5, # Voxel size (m) of the map correspondence index, None for brute force search. Only used with icp_solver "native"
+        "icp_stats": False, # Whether to record the iterations, final residual, inliers and wall time of every icp solve and log them per epoch
+        "icp_stats_log": None, # Csv file in the checkpoint directory that the per-sample icp stats of every epoch are appended to, None to only log the aggregates
+
+        # Model setup
+        "network_input_type": "cartesian", # Options are "cartesian" and "polar", what the network takes in
+        "network_output_type": "cartesian", # Options are "cartesian" and "polar"
+        "binary_inference": False, # Options are True and False, whether the mask is binary or not during inference
+        "norm_weights": True, # Options are True and False, whether to normalize weights to always have max weight of 1
+        "mask_cache_dir": None, # Directory to cache the masks of the best policy in for the final evaluations, None to not cache
+        "mask_cache_max_mb": 1024, # Maximum size (MB) of the mask cache
+        "target_cache_dir": None, # Directory of the bit-packed fft and map pts mask loss targets, e.g. "../data/target_cache", None to form them every batch
+        "mixed_precision": None, # Options are None, "bf16" and "fp16", precision of the mask network (bf16 also works on CPU)
+        "grad_checkpoint": False, # Options are True and False, whether to recompute UNet block activations during backward to save memory
+        "optimized_inference": False, # Options are True and False, whether to run the mask network compiled and channels-last during inference
+        # Choose inputs to network
+        "fft_input": True,
+        "cfar_input": False,
+        "range_input": False,
+    }
+
+    return params
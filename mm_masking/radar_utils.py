@@ -17,15 +17,23 @@ def load_pc_from_file(file_path, to_type=None, to_device='cpu'):
         pc = pc.type(to_type)
     return pc
 
-def load_radar(raw_img):
+def load_radar(raw_img, max_range=None, res=0.0596):
     raw_data = np.asarray(raw_img)
     time_convert = 1000
     encoder_conversion = 2 * np.pi / 5600
     timestamps = np.frombuffer(raw_data[:,:8].tobytes(), dtype=np.int64) * time_convert
     azimuths = np.frombuffer(raw_data[:,8:10].tobytes(), dtype=np.uint16) * encoder_conversion
-    fft_data = np.divide(raw_data[:,11:], 255.0, dtype=np.float32)
+    # Only keep range bins up to max_range, cropping before the float conversion
+    num_bins = get_num_range_bins(raw_data.shape[1] - 11, max_range=max_range, res=res)
+    fft_data = np.divide(raw_data[:,11:11+num_bins], 255.0, dtype=np.float32)
     return fft_data, azimuths, timestamps
 
+def get_num_range_bins(full_num_bins, max_range=None, res=0.0596):
+    # Number of range bins needed to cover max_range, where bin 0 is at 0 m
+    if max_range is None:
+        return full_num_bins
+    return min(full_num_bins, int(np.ceil(max_range / res)) + 1)
+
 def cfar_mask(raw_scans, res, width=101, minr=2.0, maxr=80.0, guard=5, 
                     a_thresh=1.0, b_thresh=0.09, diff=True, steep_fact=10.0):
     assert(raw_scans.ndim == 3), "raw_scans must be 3D"
@@ -39,18 +47,19 @@ def cfar_mask(raw_scans, res, width=101, minr=2.0, maxr=80.0, guard=5,
     maxcol = min(raw_scans.shape[2], int(maxr / res - w2 - guard))
     col_range = torch.arange(mincol, maxcol)
 
-    left_start_idx = col_range - w2 - guard
-    left_end_idx = col_range - guard
-    left = torch.zeros((raw_scans.shape[0], raw_scans.shape[1], len(left_start_idx)), device=device)
+    # Window sums are computed from a cumulative sum along range so that the
+    # whole batch is handled in a few kernels instead of a loop over columns
+    # scan_csum[:, :, k] contains the sum of raw_scans[:, :, :k]
+    scan_csum = F.pad(torch.cumsum(raw_scans, dim=2), (1, 0))
 
-    for idx, (start, end) in enumerate(zip(left_start_idx, left_end_idx)):
-        left[:, :, idx] = torch.sum(raw_scans[:, :, start:end], axis=2)
+    left_start_idx = (col_range - w2 - guard).to(device)
+    left_end_idx = (col_range - guard).to(device)
+    left = scan_csum[:, :, left_end_idx] - scan_csum[:, :, left_start_idx]
 
-    right_start_idx = col_range + guard + 1
-    right_end_idx = col_range + w2 + guard + 1
-    right = torch.zeros((raw_scans.shape[0], raw_scans.shape[1], len(right_start_idx)), device=device)
-    for idx, (start, end) in enumerate(zip(right_start_idx, right_end_idx)):
-        right[:, :, idx] = torch.sum(raw_scans[:, :,start:end], axis=2)
+    # Windows running past the last range bin are cut short, like slicing would
+    right_start_idx = torch.clamp(col_range + guard + 1, max=raw_scans.shape[2]).to(device)
+    right_end_idx = torch.clamp(col_range + w2 + guard + 1, max=raw_scans.shape[2]).to(device)
+    right = scan_csum[:, :, right_end_idx] - scan_csum[:, :, right_start_idx]
     
     stat = torch.maximum(left, right) / w2  # GO-CFAR
     thres = a_thresh * stat + b_thresh
@@ -105,11 +114,31 @@ def extract_pc(thres_mask, res, azimuth_angles, azimuth_times, T_ab=None, diff=T
 
     return pc_list
 
-def extract_weights(mask, scan_pc):
+def extract_scan_pc(fft_data, azimuths, azimuth_times, res, a_thresh=1.0, b_thresh=0.09, minr=2.0, maxr=80.0):
+    # Extract CFAR pointclouds from a batch of polar scans
+    # The resulting pointclouds are zero padded to match the largest one in the batch,
+    # which is the same convention used for the VTR pointclouds
+    thres_mask = cfar_mask(fft_data, res, minr=minr, maxr=maxr, a_thresh=a_thresh, b_thresh=b_thresh, diff=False)
+    pc_list = extract_pc(thres_mask, res, azimuth_angles=azimuths, azimuth_times=azimuth_times, diff=False)
+    scan_pc = torch.nn.utils.rnn.pad_sequence(pc_list, batch_first=True, padding_value=0.0)
+
+    return scan_pc
+
+def extract_weights(mask, scan_pc, azimuths=None, radar_resolution=0.0596, cart_resolution=0.2384):
     # Extract weights from mask corresponding to scan_pc points
+    # If azimuths are provided, mask is assumed to be polar and is sampled directly
+    # using the range and azimuth of each point, otherwise mask is assumed to be cartesian
+    # with a pixel width taken from the mask itself
     mask_c = mask.unsqueeze(1)
     scan_pc = scan_pc.type(mask_c.dtype)
-    grid_pc = point_to_cart_idx(scan_pc, min_to_plus_1=True)
+    if azimuths is None:
+        grid_pc = point_to_cart_idx(scan_pc, cart_resolution=cart_resolution, cart_pixel_width=mask.shape[2], min_to_plus_1=True)
+    else:
+        # Pad the mask with the last and first azimuths so that points between
+        # the last and first azimuth are interpolated across the wrap-around
+        mask_c = torch.cat((mask_c[:, :, -1:], mask_c, mask_c[:, :, :1]), dim=2)
+        grid_pc = point_to_polar_idx(scan_pc, azimuths.type(mask_c.dtype), radar_resolution,
+                                     polar_pixel_width=mask.shape[2], min_to_plus_1=True)
 
     # scan_pc has filled in (0, 0) points for batch shape matching
     # We want weights corresponding to these points to be 0
@@ -139,30 +168,58 @@ def extract_weights(mask, scan_pc):
 
     return weights, diff_mean_num_non0, mean_num_non0, mean_w, max_w, min_w
 
-def extract_bev_from_pts(pc, cart_pixel_width=640):
-    # Find cartesian indeces of the pointcloud
-    pc_idx = point_to_cart_idx(pc)
-
-    # Set all out of range indices to midpoint
-    pc_idx[pc_idx < 0] = cart_pixel_width // 2
-    pc_idx[pc_idx > (cart_pixel_width-1)] = cart_pixel_width // 2
-
-    # Form the BEV with all 0's for now
-    pc_bev = torch.zeros((pc.shape[0], cart_pixel_width, cart_pixel_width), dtype=pc.dtype, device=pc.device)
-    
-    # Fill in 1's for all nearby pixels from each pc_idx
-    pc_idx_floor = torch.floor(pc_idx).type(torch.long)
-    pc_idx_ceil = torch.ceil(pc_idx).type(torch.long)
-    pc_bev[torch.arange(pc_idx_ceil.shape[0]).unsqueeze(1), pc_idx_ceil[:,:,0], pc_idx_floor[:,:,1]] = 1
-    pc_bev[torch.arange(pc_idx_ceil.shape[0]).unsqueeze(1), pc_idx_ceil[:,:,0], pc_idx_ceil[:,:,1]] = 1
-    pc_bev[torch.arange(pc_idx_ceil.shape[0]).unsqueeze(1), pc_idx_floor[:,:,0], pc_idx_floor[:,:,1]] = 1
-    pc_bev[torch.arange(pc_idx_ceil.shape[0]).unsqueeze(1), pc_idx_floor[:,:,0], pc_idx_ceil[:,:,1]] = 1
-
-    # All out of bound and fake points generated for batching
-    # are stored in centermost pixel, zero it out
-    pc_bev[:, cart_pixel_width // 2, cart_pixel_width // 2] = 0.0
-
-    return pc_bev
+def extract_bev_from_pts(pc, cart_resolution=0.2384, cart_pixel_width=640, footprint_radius=None, out=None, sparse=False):
+    # Rasterize the x, y coordinates of pointclouds pc (B, N, 2+) into binary BEV images (B, W, W)
+    # footprint_radius=None fills the floor/ceil pixels around each point, otherwise all
+    # pixels within footprint_radius (pixels) of the nearest pixel are filled
+    # out is an optional contiguous (B, W, W) buffer to reuse, sparse=True returns a COO tensor instead
+    batch_size = pc.shape[0]
+    width = cart_pixel_width
+
+    # Cartesian pixel coordinates, same convention as point_to_cart_idx
+    pc_u = -pc[:, :, 0] / cart_resolution + width / 2
+    pc_v = pc[:, :, 1] / cart_resolution + width / 2
+
+    # Drop out of bound points, fake points generated for batching and nans up front
+    valid = (pc_u >= 0) & (pc_u <= width - 1) & (pc_v >= 0) & (pc_v <= width - 1)
+    batch_idx = torch.nonzero(valid, as_tuple=True)[0]
+    pc_u = pc_u[valid]
+    pc_v = pc_v[valid]
+    row_offset = batch_idx * width
+
+    # Flat (b, u, v) indices of the footprint of each point
+    if footprint_radius is None:
+        u_floor = (row_offset + torch.floor(pc_u).type(torch.long)) * width
+        u_ceil = (row_offset + torch.ceil(pc_u).type(torch.long)) * width
+        v_floor = torch.floor(pc_v).type(torch.long)
+        v_ceil = torch.ceil(pc_v).type(torch.long)
+        flat_idx = torch.cat((u_floor + v_floor, u_floor + v_ceil, u_ceil + v_floor, u_ceil + v_ceil))
+    else:
+        r = int(footprint_radius)
+        du, dv = torch.meshgrid(torch.arange(-r, r + 1, device=pc.device), torch.arange(-r, r + 1, device=pc.device), indexing='ij')
+        in_disk = du**2 + dv**2 <= footprint_radius**2
+        u = torch.round(pc_u).type(torch.long).unsqueeze(1) + du[in_disk]
+        v = torch.round(pc_v).type(torch.long).unsqueeze(1) + dv[in_disk]
+        in_img = (u >= 0) & (u < width) & (v >= 0) & (v < width)
+        flat_idx = ((row_offset.unsqueeze(1) + u) * width + v)[in_img]
+
+    if sparse:
+        flat_idx = torch.unique(flat_idx)
+        indices = torch.stack((flat_idx // (width * width), (flat_idx // width) % width, flat_idx % width))
+        values = torch.ones(flat_idx.shape[0], dtype=pc.dtype, device=pc.device)
+        return torch.sparse_coo_tensor(indices, values, (batch_size, width, width), is_coalesced=True)
+
+    # Duplicate pixels all write the same value, so a single index_put_ suffices
+    if out is not None:
+        # Scatter straight into the reused buffer, without allocating an image per call
+        out_flat = out.view(-1)
+        out_flat.zero_()
+        out_flat.index_put_((flat_idx,), torch.ones(1, dtype=out.dtype, device=out.device))
+        return out
+    # Writing into a bool image first keeps the scattered writes in a 4-8x smaller buffer
+    pc_bev = torch.zeros((batch_size * width * width,), dtype=torch.bool, device=pc.device)
+    pc_bev.index_put_((flat_idx,), torch.ones(1, dtype=torch.bool, device=pc.device))
+    return pc_bev.view(batch_size, width, width).type(pc.dtype)
 
 def mean_peaks_parallel_fast(arr, diff, steep_fact):
     res = torch.zeros_like(arr)
@@ -273,7 +330,8 @@ def radar_polar_to_cartesian_diff(fft_data, azimuths, radar_resolution, cart_res
         np.ndarray: Cartesian radar power readings
     """
     # Compute the range (m) and angle (rad) values for each cartesian pixel
-    sample_range, sample_angle = form_cart_range_angle_grid(cart_pixel_width=cart_pixel_width, dtype=fft_data.dtype, device=fft_data.device)
+    sample_range, sample_angle = form_cart_range_angle_grid(cart_resolution=cart_resolution, cart_pixel_width=cart_pixel_width,
+                                                            dtype=fft_data.dtype, device=fft_data.device)
 
     # So far sample_range and sample_angle are the same for each item in batch
     # Now, expand them to match batch size
@@ -396,6 +454,40 @@ def point_to_cart_idx(pc, cart_resolution=0.2384, cart_pixel_width=640, min_to_p
 
     return grid_pc
 
+def point_to_polar_idx(pc, azimuths, radar_resolution, polar_pixel_width=3360, min_to_plus_1=False):
+    # Compute the polar pixel coordinates of each point in the pointcloud pc
+    # pc is a tensor of shape (N, m, 2/3), azimuths is a tensor of shape (N, M)
+    # Range pixel 0 is 0 m, which matches extract_pc and form_polar_range_grid
+    grid_pc_range = torch.sqrt(pc[:,:,0] * pc[:,:,0] + pc[:,:,1] * pc[:,:,1]) / radar_resolution
+    pc_angle = torch.arctan2(pc[:,:,1], pc[:,:,0])
+    pc_angle = pc_angle + torch.where(pc_angle < 0, 2. * torch.pi, 0.0) # wrap to 0-2pi
+
+    # Pad the azimuths with the last azimuth before 0 and the first azimuth after 2pi
+    # so that every angle in 0-2pi falls between two padded azimuths
+    # Padded azimuth j corresponds to azimuth j - 1 of the original scan
+    azms_pad = torch.cat((azimuths[:, -1:] - 2. * torch.pi, azimuths, azimuths[:, :1] + 2. * torch.pi), dim=1)
+    # Searchsorted complains if the arrays are not contiguous
+    c_hi = torch.searchsorted(azms_pad.contiguous(), pc_angle.contiguous(), right=True)
+    c_hi = torch.clamp(c_hi, 1, azms_pad.shape[1] - 1)
+    c_lo = c_hi - 1
+    a_hi = torch.gather(azms_pad, 1, c_hi)
+    a_lo = torch.gather(azms_pad, 1, c_lo)
+    # Interpolate between the two neighbouring azimuths, this also handles
+    # the non-constant azimuth step (wobble) of the old CIR204 data
+    grid_pc_azimuth = c_lo + (pc_angle - a_lo) / (a_hi - a_lo + 1e-14)
+
+    if min_to_plus_1:
+        # grid_sample takes the (x, y) = (range, azimuth) coordinates in the range [-1, 1]
+        # Coordinates are for a mask padded with one azimuth on either side
+        grid_pc = torch.stack((grid_pc_range, grid_pc_azimuth), axis=2)
+        grid_pc[:,:,0] = grid_pc[:,:,0] / (polar_pixel_width - 1) * 2 - 1
+        grid_pc[:,:,1] = grid_pc[:,:,1] / (azms_pad.shape[1] - 1) * 2 - 1
+    else:
+        # Return (azimuth, range) pixel coordinates of the unpadded mask
+        grid_pc = torch.stack((grid_pc_azimuth - 1, grid_pc_range), axis=2)
+
+    return grid_pc
+
 def form_cart_range_angle_grid(cart_resolution=0.2384, cart_pixel_width=640, dtype=None, device='cpu'):
     # Compute the range (m) and angle (rad) value of each cartesian pixel
     # A pixels coordinates are the center of the pixel
@@ -404,7 +496,7 @@ def form_cart_range_angle_grid(cart_resolution=0.2384, cart_pixel_width=640, dty
     if (cart_pixel_width % 2) == 0:
         cart_min_range = (cart_pixel_width / 2 - 0.5) * cart_resolution
     else:
-        cart_min_range = cart_pixel_width / 2 * cart_resolution
+        cart_min_range = cart_pixel_width // 2 * cart_resolution
     
     # Compute the value of each cartesian pixel, centered at 0
     if dtype is None:
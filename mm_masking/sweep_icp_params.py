@@ -0,0 +1,108 @@
+import argparse
+import itertools
+import time
+import torch
+import pandas as pd
+from icp_weight_dataset import ICPWeightDataset
+from icp_weight_policy import LearnICPWeightPolicy, decode_scan_images
+from train_icp_weights import default_params, default_loc_pairs, eval_validation_loss, form_iterator
+
+def icp_settings_grid(trim_dists, losses, loss_scales, max_iters):
+    # All combinations of the given ICP settings
+    return [{"trim_dist": trim_dist, "loss": loss, "loss_scale": loss_scale, "max_iter_inference": max_iter}
+            for trim_dist, loss, loss_scale, max_iter in itertools.product(trim_dists, losses, loss_scales, max_iters)]
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def sweep_icp_params(policy, iterator, settings_grid, gt_eye=True, device=torch.device('cpu'), binary=False):
+    # Evaluate ICP with every setting in settings_grid
+    # The weights of each validation batch are computed once and reused for all settings
+    policy.eval()
+    results = [dict(settings, norm_err=0.0, rot_err=0.0, trans_err=0.0, icp_time=0.0) for settings in settings_grid]
+    num_samples = 0
+    weights_time = 0.0
+
+    with torch.no_grad():
+        for i_batch, batch in enumerate(iterator):
+            batch_scan = batch['loc_data']
+            batch_map = batch['map_data']
+            batch_T_gt = batch['transforms']['T_ml_gt'].to(device)
+            batch_T_init = batch['transforms']['T_ml_init'].to(device)
+            decode_scan_images(batch_scan, device, policy.float_type)
+            num_samples += batch_T_gt.shape[0]
+
+            tic = time.time()
+            icp_inputs = policy(batch_scan, batch_map, batch_T_init, binary=binary, icp_inputs_only=True)
+            sync(device)
+            weights_time += time.time() - tic
+
+            for result, settings in zip(results, settings_grid):
+                policy.set_icp_settings(**settings)
+                tic = time.time()
+                T_pred = policy.icp(*icp_inputs)
+                sync(device)
+                result["icp_time"] += time.time() - tic
+
+                val_acc = eval_validation_loss(T_pred, batch_T_gt, gt_eye=gt_eye)
+                result["norm_err"] += val_acc[0].item()
+                result["rot_err"] += val_acc[1].item()
+                result["trans_err"] += val_acc[2].item()
+
+    for result in results:
+        result["norm_err"] /= len(iterator)
+        result["rot_err"] /= len(iterator)
+        result["trans_err"] /= len(iterator)
+        # Report runtime per scan
+        result["icp_time"] /= num_samples
+
+    return pd.DataFrame(results), weights_time / num_samples
+
+def main(args):
+    params = default_params()
+    params["num_val"] = args.num_val
+    params["batch_size_test"] = args.batch_size
+    params["icp_solver"] = args.icp_solver
+
+    _, val_loc_pairs = default_loc_pairs()
+    val_dataset = ICPWeightDataset(loc_pairs=val_loc_pairs, params=params, dataset_type='test')
+    validation_iterator = form_iterator(val_dataset, params, params["batch_size_test"], shuffle=False, drop_last=False)
+
+    policy = LearnICPWeightPolicy(params=params)
+    policy = policy.to(device=params["device"])
+    policy.load_state_dict(torch.load(args.checkpoint, map_location=params["device"]))
+    if args.mask_cache_dir is not None:
+        policy.enable_mask_cache(args.mask_cache_dir, max_size_mb=args.mask_cache_max_mb)
+
+    settings_grid = icp_settings_grid(trim_dists=[float(x) for x in args.trim_dists.split(',')],
+                                      losses=args.losses.split(','),
+                                      loss_scales=[float(x) for x in args.loss_scales.split(',')],
+                                      max_iters=[int(x) for x in args.max_iters.split(',')])
+    print("Evaluating " + str(len(settings_grid)) + " ICP settings on " + str(len(val_dataset)) + " validation samples")
+
+    results, weights_time = sweep_icp_params(policy, validation_iterator, settings_grid, gt_eye=params["gt_eye"],
+                                             device=params["device"], binary=params["binary_inference"])
+
+    print("Weights computed once per scan in {:.4f} s/scan".format(weights_time))
+    print(results.sort_values("norm_err").to_string(index=False))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', required=True, type=str, help='path of the trained policy state dict')
+    parser.add_argument('--trim_dists', default='2.0,5.0,10.0', type=str, help='comma separated trim distances (m)')
+    parser.add_argument('--losses', default='cauchy', type=str, help='comma separated robust losses')
+    parser.add_argument('--loss_scales', default='0.5,1.0,2.0', type=str, help='comma separated robust loss scales (m)')
+    parser.add_argument('--max_iters', default='10,25,50', type=str, help='comma separated icp iteration caps')
+    parser.add_argument('--icp_solver', default='dicp', type=str, help='dicp or native')
+    parser.add_argument('--num_val', default=-1, type=int, help='number of validation samples, -1 for all')
+    parser.add_argument('--batch_size', default=32, type=int, help='validation batch size')
+    parser.add_argument('--mask_cache_dir', default=None, type=str, help='directory to cache masks in across runs, None to not cache')
+    parser.add_argument('--mask_cache_max_mb', default=1024, type=int, help='maximum size (MB) of the mask cache')
+    parser.add_argument('--output', default=None, type=str, help='csv file to save the results table to')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,164 @@
+import math
+import torch
+import torch.nn.functional as F
+from radar_utils import cfar_mask, radar_polar_to_cartesian_diff, get_num_range_bins
+
+# Synthetic samples with the shapes and conventions of ICPWeightDataset batches, so that
+# the radar kernels and the policy can be run without Boreas data or a VTR pose graph.
+# Scenes are planar landmarks (walls and poles), seen by a spinning radar at a random pose.
+
+ENCODER_COUNTS = 5600   # Encoder resolution of the Navtech radar, see load_radar
+POLAR_RES = 0.0596      # Range resolution (m/bin) of the polar scans
+
+def planar_transform(x, y, theta, dtype=torch.float32):
+    # (4, 4) transform of a planar pose
+    T = torch.eye(4, dtype=dtype)
+    T[0, 0] = math.cos(theta)
+    T[0, 1] = -math.sin(theta)
+    T[1, 0] = math.sin(theta)
+    T[1, 1] = math.cos(theta)
+    T[0, 3] = x
+    T[1, 3] = y
+    return T
+
+def random_planar_transform(pos_std, rot_std, generator=None, dtype=torch.float32):
+    # Uniform planar perturbation in [-std, std], like sample_init_perturbation for training
+    xi = 2 * torch.rand(3, generator=generator, dtype=torch.float64) - 1
+    return planar_transform(pos_std*xi[0].item(), pos_std*xi[1].item(), rot_std*xi[2].item(), dtype=dtype)
+
+def synthetic_scene(num_walls=12, num_poles=40, extent=60.0, point_spacing=0.2, generator=None):
+    # Landmark points (N, 2) and their normals (N, 2) in the map frame
+    # Walls are line segments sampled every point_spacing, poles are single points
+    pts = []
+    norms = []
+    for _ in range(num_walls):
+        start = extent * (2 * torch.rand(2, generator=generator) - 1)
+        angle = 2 * math.pi * torch.rand(1, generator=generator).item()
+        length = 5.0 + 25.0 * torch.rand(1, generator=generator).item()
+        direction = torch.tensor([math.cos(angle), math.sin(angle)])
+        steps = torch.arange(0.0, length, point_spacing).unsqueeze(1)
+        pts.append(start + steps * direction)
+        norms.append(torch.tensor([-direction[1], direction[0]]).repeat(steps.shape[0], 1))
+    pts.append(extent * (2 * torch.rand((num_poles, 2), generator=generator) - 1))
+    pole_angle = 2 * math.pi * torch.rand(num_poles, generator=generator)
+    norms.append(torch.stack((torch.cos(pole_angle), torch.sin(pole_angle)), dim=1))
+    return torch.cat(pts, dim=0), torch.cat(norms, dim=0)
+
+def synthetic_azimuths(num_azimuths=400, scan_period=0.25, wobble=0.002, start_time=0.0, generator=None):
+    # Azimuths (rad) of one rotation and the time (ns) each was measured at, as returned by load_radar
+    # The rotation speed varies slowly over a scan, so azimuths wobble around their nominal
+    # spacing, and they are quantized to the encoder counts
+    nominal = 2 * math.pi * torch.arange(num_azimuths, dtype=torch.float64) / num_azimuths
+    phase = 2 * math.pi * torch.rand(1, generator=generator, dtype=torch.float64)
+    azimuths = nominal + wobble * torch.sin(nominal + phase)
+    azimuths = torch.round(azimuths * ENCODER_COUNTS / (2 * math.pi)) * (2 * math.pi / ENCODER_COUNTS)
+    # Each azimuth is timed by where the rotation actually is, plus a few us of jitter
+    az_times = start_time + 1e9 * scan_period * azimuths / (2 * math.pi)
+    az_times = az_times + 1e3 * (2 * torch.rand(num_azimuths, generator=generator, dtype=torch.float64) - 1)
+    return azimuths, az_times
+
+def synthetic_polar_scan(landmarks, azimuths, num_range_bins=3360, res=POLAR_RES, noise_level=0.15, generator=None):
+    # Polar (A, R) fft data in [0, 1] of landmarks (N, 2) in the scan frame
+    # Each landmark returns in the azimuth closest to its bearing, spread over a few range
+    # bins, on top of speckle noise that falls off with range. Values are quantized to 8 bits
+    # like the radar pngs.
+    num_azimuths = azimuths.shape[0]
+    ranges = torch.norm(landmarks, dim=1)
+    bearings = torch.remainder(torch.atan2(landmarks[:, 1], landmarks[:, 0]), 2 * math.pi)
+    range_bins = torch.round(ranges / res).long()
+    az_idx = torch.remainder(torch.searchsorted(azimuths.type(bearings.dtype), bearings), num_azimuths)
+    visible = range_bins < num_range_bins
+
+    returns = torch.zeros((num_azimuths, num_range_bins))
+    amplitude = 0.5 + 0.4 * torch.rand(int(torch.sum(visible)), generator=generator)
+    returns.index_put_((az_idx[visible], range_bins[visible]), amplitude, accumulate=True)
+    kernel = torch.exp(-0.5 * (torch.arange(-4, 5, dtype=torch.float32) / 1.5)**2).reshape(1, 1, -1)
+    returns = F.conv1d(returns.unsqueeze(1), kernel, padding=4).squeeze(1)
+
+    bin_ranges = res * torch.arange(num_range_bins, dtype=torch.float32)
+    speckle = noise_level * torch.rand((num_azimuths, num_range_bins), generator=generator) * torch.exp(-bin_ranges / 50.0)
+    fft_data = torch.clamp(returns + speckle, 0.0, 1.0)
+    return torch.round(fft_data * 255.0) / 255.0
+
+def pad_pc(pc, num_pts, pad_val=0.0):
+    # Pad or cut a (N, C) pointcloud to num_pts points
+    if pc.shape[0] >= num_pts:
+        return pc[:num_pts]
+    pad = pad_val * torch.ones((num_pts - pc.shape[0], pc.shape[1]), dtype=pc.dtype)
+    return torch.cat((pc, pad), dim=0)
+
+def synthetic_sample(params, num_scan_pts=2000, num_map_pts=8000, scan_range=80.0, map_pad_val=1000.0,
+                     num_azimuths=400, generator=None):
+    # One sample with the keys and frames of ICPWeightDataset.__getitem__
+    # With gt_eye the map is given in the scan frame and T_ml_init is a perturbation of identity
+    dtype = params["float_type"]
+    landmarks, landmark_norms = synthetic_scene(generator=generator)
+
+    # T_ml_gt maps map points into the scan frame
+    T_ml_gt = random_planar_transform(10.0, math.pi, generator=generator, dtype=dtype)
+    T_rand = random_planar_transform(params["pos_std"], params["rot_std"], generator=generator, dtype=dtype)
+    landmarks_s = landmarks @ T_ml_gt[:2, :2].T.type(torch.float32) + T_ml_gt[:2, 3].type(torch.float32)
+    norms_s = landmark_norms @ T_ml_gt[:2, :2].T.type(torch.float32)
+
+    # Scan points are the landmarks within range that were detected, with range noise, and clutter
+    in_range = torch.norm(landmarks_s, dim=1) < scan_range
+    detected = in_range & (torch.rand(in_range.shape[0], generator=generator) < 0.7)
+    scan_pts = landmarks_s[detected] + 0.1 * torch.randn((int(torch.sum(detected)), 2), generator=generator)
+    num_clutter = max(scan_pts.shape[0] // 10, 1)
+    clutter_angle = 2 * math.pi * torch.rand(num_clutter, generator=generator)
+    clutter_range = scan_range * torch.rand(num_clutter, generator=generator)
+    clutter = torch.stack((clutter_range * torch.cos(clutter_angle), clutter_range * torch.sin(clutter_angle)), dim=1)
+    scan_pc = F.pad(torch.cat((scan_pts, clutter), dim=0), (0, 1)).type(dtype)
+    # VTR keeps the points that passed its filters, here the landmark detections
+    scan_pc_filt = torch.cat((scan_pc[:scan_pts.shape[0]], torch.zeros((num_clutter, 3), dtype=dtype)), dim=0)
+    order = torch.randperm(scan_pc.shape[0], generator=generator)[:num_scan_pts]
+    scan_pc_raw = pad_pc(scan_pc[order], num_scan_pts)
+    scan_pc_filt = pad_pc(scan_pc_filt[order], num_scan_pts)
+
+    # Map points and normals, x, y, z, nx, ny, nz
+    if params["gt_eye"]:
+        map_pts, map_norms, T_ml_init = landmarks_s, norms_s, T_rand
+    else:
+        map_pts, map_norms, T_ml_init = landmarks, landmark_norms, T_rand @ T_ml_gt
+    map_pc = torch.cat((F.pad(map_pts, (0, 1)), F.pad(map_norms, (0, 1))), dim=1).type(dtype)
+    map_pc = pad_pc(map_pc[torch.randperm(map_pc.shape[0], generator=generator)], num_map_pts, pad_val=map_pad_val)
+
+    azimuths, az_times = synthetic_azimuths(num_azimuths=num_azimuths, generator=generator)
+    num_range_bins = get_num_range_bins(3360, max_range=params["max_range"], res=POLAR_RES)
+    fft_data = synthetic_polar_scan(landmarks_s, azimuths, num_range_bins=num_range_bins, generator=generator).type(dtype)
+    azimuths = azimuths.type(dtype)
+    az_times = az_times.type(dtype)
+
+    loc_data = {'timestamp': int(az_times[0].item()), 'fft_polar': fft_data, 'azimuths': azimuths,
+                'az_timestamps': az_times, 'raw_pc': scan_pc_raw, 'filtered_pc': scan_pc_filt}
+    map_data = {'pc': map_pc, 'timestamp': int(az_times[0].item())}
+    T_data = {'T_ml_init': T_ml_init, 'T_ml_gt': T_ml_gt}
+
+    return {'loc_data': loc_data, 'map_data': map_data, 'transforms': T_data}
+
+def synthetic_batch(params, batch_size, seed=0, **kwargs):
+    # Collated batch of synthetic samples, see synthetic_sample
+    # The network inputs are formed as in ICPWeightDataset, batched instead of per sample
+    # The polar scans are kept as fft_polar, as the dataset does for cfar scan points
+    generator = torch.Generator().manual_seed(seed)
+    samples = [synthetic_sample(params, generator=generator, **kwargs) for _ in range(batch_size)]
+    batch = {}
+    for key in ['loc_data', 'map_data', 'transforms']:
+        batch[key] = {name: torch.stack([torch.as_tensor(sample[key][name]) for sample in samples])
+                      for name in samples[0][key]}
+
+    loc_data = batch['loc_data']
+    fft_polar = loc_data['fft_polar']
+    fft_cfar = cfar_mask(fft_polar, POLAR_RES, a_thresh=params["a_thresh"], b_thresh=params["b_thresh"], diff=False)
+    if params["network_input_type"] == 'cartesian':
+        loc_data['fft_data'] = radar_polar_to_cartesian_diff(fft_polar, loc_data['azimuths'], POLAR_RES,
+                                                             cart_resolution=params["cart_resolution"],
+                                                             cart_pixel_width=params["cart_pixel_width"])
+        loc_data['fft_cfar'] = radar_polar_to_cartesian_diff(fft_cfar, loc_data['azimuths'], POLAR_RES,
+                                                             cart_resolution=params["cart_resolution"],
+                                                             cart_pixel_width=params["cart_pixel_width"])
+    else:
+        loc_data['fft_data'] = loc_data.pop('fft_polar')
+        loc_data['fft_cfar'] = fft_cfar
+
+    return batch
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import os.path as osp
+import threading
+import numpy as np
+import torch
+
+def dataset_cache_key(dataset, target_config):
+    # Hash of the samples of a dataset and of the config the targets are formed with
+    hasher = hashlib.sha1()
+    hasher.update(repr(dataset.loc_pairs).encode())
+    hasher.update(np.ascontiguousarray(dataset.v_id_vector).tobytes())
+    hasher.update(np.ascontiguousarray(dataset.graph_id_vector).tobytes())
+    hasher.update(dataset.T_loc_gt.contiguous().numpy().tobytes())
+    hasher.update(repr(sorted(target_config.items())).encode())
+    return hasher.hexdigest()[:16]
+
+def pack_target(target):
+    # Bit-pack a binary (H, W) target into a flat uint8 array
+    return np.packbits(np.asarray(target).reshape(-1) > 0.5)
+
+def unpack_target(packed, shape, dtype=torch.float32):
+    # Unpack a batch of bit-packed targets (B, num_bytes) into (B, H, W) masks
+    # Works on any device, so targets can be moved packed and unpacked on the gpu
+    if packed.device.type == 'cpu':
+        unpacked = torch.from_numpy(np.unpackbits(packed.numpy(), axis=1))
+    else:
+        bits = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=packed.device)
+        unpacked = (packed.unsqueeze(-1) & bits) > 0
+    num_px = shape[0] * shape[1]
+    return unpacked.reshape(packed.shape[0], -1)[:, :num_px].reshape((packed.shape[0],) + tuple(shape)).type(dtype)
+
+def cached_target_frames(params, augment):
+    # Frames of the mask loss targets that are cached, by target name
+    # The fft target is in the network input frame, the map pts target is cartesian.
+    # Augmentation rotates the data by a random angle. Polar targets follow it exactly by
+    # rolling the azimuths, but cartesian ones would have to be resampled, which does not
+    # match rasterizing the rotated data. They are then formed by the loss, see eval_training_loss.
+    frames = {}
+    if params["loss_fft_mask_weight"] > 0.0 and not (params["map_sensor"] == 'lidar' and params["loc_sensor"] == 'lidar'):
+        frames['fft_target'] = params["network_input_type"]
+    if params["loss_map_pts_mask_weight"] > 0.0:
+        frames['map_pts_target'] = 'cartesian'
+    if augment:
+        frames = {name: frame for name, frame in frames.items() if frame != 'cartesian'}
+    return frames
+
+class TargetCache():
+    # Memory-mapped cache of the binary supervision targets of the mask losses
+    # Each target is stored bit-packed, one row per dataset sample, in a .npy file
+    # named by the dataset key. Rows are filled the first time a sample is loaded,
+    # so the files are shared by all loader workers and reused by later runs.
+    def __init__(self, cache_dir, dataset_key, num_samples, target_shapes):
+        if not osp.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.target_shapes = target_shapes
+        self.paths = {}
+        for name, shape in target_shapes.items():
+            path = osp.join(cache_dir, dataset_key + '_' + name + '.npy')
+            num_bytes = (shape[0] * shape[1] + 7) // 8
+            if not osp.exists(path):
+                np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(num_samples, num_bytes)).flush()
+            self.paths[name] = path
+        filled_path = osp.join(cache_dir, dataset_key + '_filled.npy')
+        if not osp.exists(filled_path):
+            np.lib.format.open_memmap(filled_path, mode='w+', dtype=np.uint8, shape=(num_samples, len(target_shapes))).flush()
+        self.paths['filled'] = filled_path
+        # Memory maps are opened lazily in every loader worker process
+        # The lock keeps the threads of a thread loader from opening them concurrently
+        self.memmaps = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        with self.lock:
+            if self.memmaps is None or self.pid != os.getpid():
+                self.memmaps = {name: np.load(path, mmap_mode='r+') for name, path in self.paths.items()}
+                self.pid = os.getpid()
+            return self.memmaps
+
+    def __getstate__(self):
+        # Memory maps are not sent to spawned workers, they reopen the files
+        state = self.__dict__.copy()
+        state['memmaps'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def load(self, index):
+        # Returns the bit-packed targets of sample index, or None if they are not stored yet
+        memmaps = self.open()
+        if not memmaps['filled'][index].all():
+            return None
+        return {name: np.array(memmaps[name][index]) for name in self.target_shapes}
+
+    def save(self, index, targets):
+        # Store the binary (H, W) targets of sample index and return their packed version
+        memmaps = self.open()
+        packed = {name: pack_target(targets[name]) for name in self.target_shapes}
+        for name in self.target_shapes:
+            memmaps[name][index] = packed[name]
+        # Only mark the row as filled once all of its targets are written
+        memmaps['filled'][index] = 1
+        return packed
@@ -0,0 +1,76 @@
+import concurrent.futures
+import cv2
+import torch
+from torch.utils.data import default_collate
+
+class ThreadPoolLoader():
+    # Batch iterator that fetches samples on a thread pool in the main process
+    # Image decoding and most numpy/torch ops release the GIL, so threads overlap them
+    # without forking the dataset or pickling samples between processes.
+    # At most prefetch_batches batches are in flight. With ordered=False a batch is
+    # returned as soon as all of its samples are loaded instead of in sampling order.
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False, num_threads=8,
+                 prefetch_batches=4, ordered=True, collate_fn=default_collate,
+                 cv2_threads=1, torch_threads=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.num_threads = num_threads
+        self.prefetch_batches = max(1, prefetch_batches)
+        self.ordered = ordered
+        self.collate_fn = collate_fn
+        # Each loader thread would otherwise use cv2's own thread pool on top of the loader threads
+        # Both settings are process wide, so torch_threads also applies to the training step
+        if cv2_threads is not None:
+            cv2.setNumThreads(cv2_threads)
+        if torch_threads is not None:
+            torch.set_num_threads(torch_threads)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def batch_indices(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.dataset)).tolist()
+        else:
+            order = list(range(len(self.dataset)))
+        return [order[i*self.batch_size:(i+1)*self.batch_size] for i in range(len(self))]
+
+    def __iter__(self):
+        pending = iter(self.batch_indices())
+        # Sample futures of each batch in flight, in sampling order
+        in_flight = []
+
+        def submit_next():
+            indices = next(pending, None)
+            if indices is not None:
+                in_flight.append([self.executor.submit(self.dataset.__getitem__, idx) for idx in indices])
+
+        for _ in range(self.prefetch_batches):
+            submit_next()
+
+        while len(in_flight) > 0:
+            if self.ordered:
+                batch_futures = in_flight.pop(0)
+            else:
+                batch_futures = None
+                while batch_futures is None:
+                    for futures in in_flight:
+                        if all(future.done() for future in futures):
+                            batch_futures = futures
+                            break
+                    else:
+                        waiting = [future for futures in in_flight for future in futures if not future.done()]
+                        concurrent.futures.wait(waiting, return_when=concurrent.futures.FIRST_COMPLETED)
+                in_flight.remove(batch_futures)
+            # Exceptions raised while loading a sample are raised here
+            samples = [future.result() for future in batch_futures]
+            submit_next()
+            yield self.collate_fn(samples)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
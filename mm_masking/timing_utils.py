@@ -0,0 +1,113 @@
+import os
+import os.path as osp
+import time
+import numpy as np
+import torch
+
+class StageTimer():
+    # Wall clock time of named stages of a step, aggregated into percentiles
+    # Stages are timed with tic(name)/toc(name). On a gpu the device is synchronized
+    # at both ends so that asynchronous kernels are counted in the stage that launched them.
+    # A disabled timer does nothing, so the hooks can stay in place.
+    def __init__(self, enabled=True, device='cpu'):
+        self.enabled = enabled
+        self.sync = enabled and torch.device(device).type == 'cuda'
+        self.times = {}
+        self.starts = {}
+        self.ranges = {}
+
+    def tic(self, name):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        # Stages also show up as ranges in profiler traces
+        self.ranges[name] = torch.profiler.record_function(name)
+        self.ranges[name].__enter__()
+        self.starts[name] = time.perf_counter()
+
+    def toc(self, name):
+        if not self.enabled:
+            return
+        if self.sync:
+            torch.cuda.synchronize()
+        self.record(name, time.perf_counter() - self.starts.pop(name))
+        self.ranges.pop(name).__exit__(None, None, None)
+
+    def cancel(self, name):
+        # End a stage without recording it, e.g. waiting for a batch that never comes
+        if not self.enabled or name not in self.starts:
+            return
+        self.starts.pop(name)
+        self.ranges.pop(name).__exit__(None, None, None)
+
+    def record(self, name, duration):
+        if self.enabled:
+            self.times.setdefault(name, []).append(duration)
+
+    def summary(self, percentiles=(50, 90, 99)):
+        # Per stage number of calls, total and mean time and percentiles (s)
+        stats = {}
+        for name, times in self.times.items():
+            times = np.array(times)
+            stats[name] = {"count": len(times), "total": float(np.sum(times)), "mean": float(np.mean(times))}
+            for p in percentiles:
+                stats[name]["p" + str(p)] = float(np.percentile(times, p))
+        return stats
+
+    def print_summary(self, title=""):
+        stats = self.summary()
+        if len(stats) == 0:
+            return
+        # Nested stages, e.g. forward/icp, are already counted in their parent stage
+        total = sum(stage["total"] for name, stage in stats.items() if '/' not in name)
+        print(title + " stage times (ms): ")
+        for name, stage in stats.items():
+            print("  {:<20s} n={:<6d} mean={:8.2f} p50={:8.2f} p90={:8.2f} p99={:8.2f} ({:.1f}% of timed)".format(
+                name, stage["count"], 1e3*stage["mean"], 1e3*stage["p50"], 1e3*stage["p90"], 1e3*stage["p99"],
+                100.0*stage["total"]/total))
+
+    def log(self, neptune_run, namespace):
+        for name, stage in self.summary().items():
+            for key in ["mean", "p50", "p90", "p99"]:
+                neptune_run[namespace + "/" + name + "/" + key].append(stage[key])
+
+    def reset(self):
+        self.times = {}
+        self.starts = {}
+        self.ranges = {}
+
+class ProfilerWindow():
+    # Records a torch.profiler chrome trace of batches [start_batch, start_batch + num_batches)
+    # step(i_batch) is called at the start of every batch and stop() at the end of the epoch
+    def __init__(self, trace_path, start_batch=5, num_batches=5, enabled=True):
+        self.trace_path = trace_path
+        self.start_batch = start_batch
+        self.end_batch = start_batch + num_batches
+        self.enabled = enabled
+        self.profiler = None
+
+    def step(self, i_batch):
+        if not self.enabled:
+            return
+        if i_batch == self.start_batch and self.profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities)
+            self.profiler.start()
+        elif i_batch == self.end_batch:
+            self.stop()
+
+    def stop(self):
+        # Also called at the end of an epoch, in case it had fewer batches than the window
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        trace_dir = osp.dirname(self.trace_path)
+        if trace_dir != '' and not osp.exists(trace_dir):
+            os.makedirs(trace_dir)
+        self.profiler.export_chrome_trace(self.trace_path)
+        print("Profiler trace saved to " + self.trace_path)
+        self.profiler = None
+        self.enabled = False
@@ -1,10 +1,12 @@
 import argparse
 import torch
-from icp_weight_dataset import ICPWeightDataset
+from icp_weight_dataset import ICPWeightDataset, sample_init_perturbation
 from torch.utils.data import DataLoader
-from icp_weight_policy import LearnICPWeightPolicy
+from thread_loader import ThreadPoolLoader
+from icp_weight_policy import LearnICPWeightPolicy, decode_scan_images
 import time
 import pickle
+import json
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
@@ -15,50 +17,77 @@ import neptune
 from neptune_pytorch import NeptuneLogger
 from neptune.utils import stringify_unsupported
 from radar_utils import extract_bev_from_pts
+from target_cache import unpack_target
+from timing_utils import StageTimer, ProfilerWindow
+from params import default_params
 import os.path as osp
 
-scaler = torch.cuda.amp.GradScaler()
-
-def train_policy(model, iterator, opt, loss_weights=[],
+def train_policy(model, iterator, opt, scaler, loss_weights=[],
                  device='cpu', epoch=None,
-                 icp_loss_only_iter=0, gt_eye=True):
+                 icp_loss_only_iter=0, gt_eye=True, timer=None, profiler=None, icp_stats=None):
     model.train()
     loss_hist = 0.0
     loss_comp_hist = []
+    # Stages of the policy forward are timed by the same timer
+    timer = timer if timer is not None else StageTimer(enabled=False)
+    model.timer = timer
 
+    timer.tic('load')
     for i_batch, batch in enumerate(iterator):
+        timer.toc('load')
+        if profiler is not None:
+            profiler.step(i_batch)
         #print("Batch: ", i_batch)
         # Load in data
+        timer.tic('to_device')
         batch_scan = batch['loc_data']
         batch_map = batch['map_data']
         batch_T = batch['transforms']
         batch_T_init = batch_T['T_ml_init'].to(device)
+        # Images may be sent by the workers as uint8/float16, convert them on the device
+        decode_scan_images(batch_scan, device, model.float_type)
+        timer.toc('to_device')
 
         # Zero grad
         opt.zero_grad()
 
-        #with torch.cuda.amp.autocast():
+        timer.tic('forward')
         T_pred, mask, num_non0 = model(batch_scan, batch_map, batch_T_init)
+        timer.toc('forward')
+        # Per-sample ICP stats of the batch, only recorded if the policy has icp_stats set
+        if icp_stats is not None and model.icp_stats is not None:
+            icp_stats.append(model.icp_stats)
+            model.icp_stats = None
         del batch_T_init
 
         # Compute loss
+        timer.tic('loss')
         batch_T_gt = batch_T['T_ml_gt'].to(device)
         loss, loss_comp = eval_training_loss(T_pred, mask, num_non0, batch_T_gt, batch_scan, batch_map, model, loss_weights=loss_weights,
                                 icp_loss_only_iter=icp_loss_only_iter, gt_eye=gt_eye, epoch=epoch)
+        timer.toc('loss')
         del batch_T_gt, mask, T_pred, batch_scan, batch_map
         # Compute the derivatives
-        #scaler.scale(loss).backward()
-        loss.backward()
+        # The scaler is only enabled for fp16, otherwise these are regular backward/step calls
+        timer.tic('backward')
+        scaler.scale(loss).backward()
+        timer.toc('backward')
 
         # Take step
-        #scaler.step(opt)
-        #scaler.update()
-        opt.step()
+        timer.tic('step')
+        scaler.step(opt)
+        scaler.update()
+        timer.toc('step')
         
         loss_hist += loss.detach()
         loss_comp_hist.append(loss_comp)
         del loss
         torch.cuda.empty_cache()
+        timer.tic('load')
+    timer.cancel('load')
+    if profiler is not None:
+        profiler.stop()
+    model.timer = StageTimer(enabled=False)
 
     mean_loss = loss_hist/len(iterator)
     # Compute mean of each loss component
@@ -69,29 +98,43 @@ def train_policy(model, iterator, opt, loss_weights=[],
     return mean_loss, mean_loss_comp
 
 def validate_policy(model, iterator, gt_eye=True, device='cpu', binary=False,
-                    neptune_run=None, epoch=None):
+                    neptune_run=None, epoch=None, timer=None, icp_stats=None):
     model.eval()
+    timer = timer if timer is not None else StageTimer(enabled=False)
+    model.timer = timer
     val_acc = torch.zeros((1,3), device=device)
     mean_num_pc = 0.0
     max_w = 0.0
     min_w = 1000.0
     mean_w = 0.0
+    icp_num_iters = []
 
     with torch.no_grad():
+        timer.tic('load')
         for i_batch, batch in enumerate(iterator):
+            timer.toc('load')
             #print("Batch: ", i_batch)
             # Load in data
+            timer.tic('to_device')
             batch_scan = batch['loc_data']
             batch_map = batch['map_data']
             batch_T = batch['transforms']
             batch_T_gt = batch_T['T_ml_gt'].to(device)
             batch_T_init = batch_T['T_ml_init'].to(device)
+            decode_scan_images(batch_scan, device, model.float_type)
+            timer.toc('to_device')
 
+            timer.tic('forward')
             if neptune_run is not None:# and i_batch == 0:
                 T_pred, mask, _ = model(batch_scan, batch_map, batch_T_init, binary=binary, neptune_run=neptune_run, epoch=epoch, batch_idx=i_batch)
             else:
                 T_pred, mask, _ = model(batch_scan, batch_map, batch_T_init, binary=binary)
+            timer.toc('forward')
+            if icp_stats is not None and model.icp_stats is not None:
+                icp_stats.append(model.icp_stats)
+                model.icp_stats = None
 
+            timer.tic('metrics')
             mean_num_pc += model.mean_num_pts
 
             if model.max_w > max_w:
@@ -101,9 +144,17 @@ def validate_policy(model, iterator, gt_eye=True, device='cpu', binary=False,
 
             mean_w += model.mean_w
 
+            # Histogram of the number of ICP iterations each sample took
+            # Only the native solver tracks per-sample convergence
+            if model.icp_num_iters is not None:
+                icp_num_iters.append(model.icp_num_iters.cpu())
+                if neptune_run is not None:
+                    neptune_run["icp_iter_hist"].append(str(torch.bincount(icp_num_iters[-1]).tolist()))
+
             # Compute validation loss
             val_acc_i = eval_validation_loss(T_pred, batch_T_gt, gt_eye=gt_eye)
             val_acc += val_acc_i
+            timer.toc('metrics')
 
             # Save first mask from this batch to neptune with name "learned_mask_#i_batch"
             if neptune_run is not None and epoch is not None and i_batch <= 10:
@@ -119,24 +170,26 @@ def validate_policy(model, iterator, gt_eye=True, device='cpu', binary=False,
                 plt.close()
 
                 # If pre-training evaluation, save the 0'th raw scan for reference
+                # Only the scan fields the dataset loaded are plotted, see required_inputs
                 if epoch == -1:
-                    fft_data = batch_scan['fft_data']
-                    cfar_data = batch_scan['fft_cfar']
+                    raw_figs = []
+                    if 'fft_data' in batch_scan:
+                        fft_data = batch_scan['fft_data'].cpu()
+                        #mean_azimuth = torch.mean(fft_data, dim=2).unsqueeze(-1)
+                        #fft_mask = torch.where(fft_data > 3.0*mean_azimuth, torch.ones_like(fft_data), torch.zeros_like(fft_data))
+                        #bev_data = radar_polar_to_cartesian_diff(fft_data, batch_scan['azimuths'], model.res)
+                        bev_data = fft_data
+                        #bev_fft_mask_data = radar_polar_to_cartesian_diff(fft_mask, batch_scan['azimuths'], model.res)
+                        mean_bev_scan = torch.mean(bev_data, dim=(1,2), keepdim=True)
+                        bev_fft_mask_data = torch.where(bev_data > 3.0*mean_bev_scan, torch.ones_like(bev_data), torch.zeros_like(bev_data))
+                        raw_figs.append(("BEV Scan 0", bev_data[0].numpy()))
+                    if 'fft_cfar' in batch_scan:
+                        raw_figs.append(("CFAR Mask 0", batch_scan['fft_cfar'][0].cpu().numpy()))
+                    if 'fft_data' in batch_scan:
+                        raw_figs.append(("FFT Mask 0", bev_fft_mask_data[0].numpy()))
                     map_pts = batch_map['pc']
-                    #mean_azimuth = torch.mean(fft_data, dim=2).unsqueeze(-1)
-                    #fft_mask = torch.where(fft_data > 3.0*mean_azimuth, torch.ones_like(fft_data), torch.zeros_like(fft_data))
-                    #bev_data = radar_polar_to_cartesian_diff(fft_data, batch_scan['azimuths'], model.res)
-                    bev_data = fft_data
-                    #bev_fft_mask_data = radar_polar_to_cartesian_diff(fft_mask, batch_scan['azimuths'], model.res)
-                    mean_bev_scan = torch.mean(bev_data, dim=(1,2), keepdim=True)
-                    bev_fft_mask_data = torch.where(bev_data > 3.0*mean_bev_scan, torch.ones_like(bev_data), torch.zeros_like(bev_data))
-                    bev_map_pts_mask = extract_bev_from_pts(map_pts)
-                    
-                    scan_0 = fft_data[0].numpy()
-                    bev_scan_0 = bev_data[0].numpy()
-                    cfar_data_0 = cfar_data[0].numpy()
-                    bev_fft_mask_0 = bev_fft_mask_data[0].numpy()
-                    bev_map_pts_mask_0 = bev_map_pts_mask[0].numpy()
+                    bev_map_pts_mask = extract_bev_from_pts(map_pts, cart_resolution=model.cart_resolution, cart_pixel_width=model.cart_pixel_width)
+                    raw_figs.append(("Map Mask 0", bev_map_pts_mask[0].numpy()))
 
                     #fig = plt.figure()
                     #plt.imshow(scan_0, cmap='gray')
@@ -144,29 +197,15 @@ def validate_policy(model, iterator, gt_eye=True, device='cpu', binary=False,
                     #neptune_run["raw_scan"].append(fig, name=("Polar Scan 0, batch " + str(i_batch)))
                     #plt.close()
 
-                    fig = plt.figure()
-                    plt.imshow(bev_scan_0, cmap='gray')
-                    plt.colorbar(location='top', shrink=0.5)
-                    neptune_run["raw_scan"].append(fig, name=("BEV Scan 0, batch " + str(i_batch)))
-                    plt.close()
-
-                    fig = plt.figure()
-                    plt.imshow(cfar_data_0, cmap='gray')
-                    plt.colorbar(location='top', shrink=0.5)
-                    neptune_run["raw_scan"].append(fig, name=("CFAR Mask 0, batch " + str(i_batch)))
-                    plt.close()
-
-                    fig = plt.figure()
-                    plt.imshow(bev_fft_mask_0, cmap='gray')
-                    plt.colorbar(location='top', shrink=0.5)
-                    neptune_run["raw_scan"].append(fig, name=("FFT Mask 0, batch " + str(i_batch)))
-                    plt.close()
-
-                    fig = plt.figure()
-                    plt.imshow(bev_map_pts_mask_0, cmap='gray')
-                    plt.colorbar(location='top', shrink=0.5)
-                    neptune_run["raw_scan"].append(fig, name=("Map Mask 0, batch " + str(i_batch)))
-                    plt.close()
+                    for fig_name, image in raw_figs:
+                        fig = plt.figure()
+                        plt.imshow(image, cmap='gray')
+                        plt.colorbar(location='top', shrink=0.5)
+                        neptune_run["raw_scan"].append(fig, name=(fig_name + ", batch " + str(i_batch)))
+                        plt.close()
+            timer.tic('load')
+        timer.cancel('load')
+        model.timer = StageTimer(enabled=False)
 
         mean_num_pc /= len(iterator)
         mean_w /= len(iterator)
@@ -174,8 +213,39 @@ def validate_policy(model, iterator, gt_eye=True, device='cpu', binary=False,
 
         val_acc /= len(iterator)
 
+        if len(icp_num_iters) > 0:
+            icp_iter_hist = torch.bincount(torch.cat(icp_num_iters))
+            print("ICP iterations histogram (number of samples per iteration count): ", icp_iter_hist.tolist())
+
     return val_acc, mean_num_pc, mean_w, max_w, min_w
 
+def summarize_icp_stats(icp_stats):
+    # Mean and percentiles over all samples of the per-sample ICP stats of an epoch
+    summary = {}
+    for key in icp_stats[0]:
+        values = torch.cat([batch[key] for batch in icp_stats]).double()
+        # Iterations (-1) and time per iteration (nan) are not known for dICP
+        values = values[(values >= 0) & ~torch.isnan(values)]
+        if values.shape[0] == 0:
+            continue
+        summary[key + "_mean"] = torch.mean(values).item()
+        summary[key + "_p50"] = torch.quantile(values, 0.5).item()
+        summary[key + "_p90"] = torch.quantile(values, 0.9).item()
+        summary[key + "_max"] = torch.max(values).item()
+    return summary
+
+def write_icp_stats(path, epoch, split, icp_stats):
+    # Append the per-sample ICP stats of an epoch to a csv file
+    keys = list(icp_stats[0].keys())
+    new_file = not osp.exists(path)
+    with open(path, 'a') as f:
+        if new_file:
+            f.write(",".join(["epoch", "split", "batch", "sample"] + keys) + "\n")
+        for i_batch, batch in enumerate(icp_stats):
+            for i_sample in range(batch[keys[0]].shape[0]):
+                row = [str(epoch), split, str(i_batch), str(i_sample)] + [str(batch[key][i_sample].item()) for key in keys]
+                f.write(",".join(row) + "\n")
+
 def eval_training_loss(T_pred, mask, num_non0, batch_T_gt, batch_scan, batch_map, model, loss_weights=[],
                        icp_loss_only_iter=0, gt_eye=True, epoch=0):
     mask_criterion = torch.nn.BCELoss()
@@ -202,11 +272,15 @@ def eval_training_loss(T_pred, mask, num_non0, batch_T_gt, batch_scan, batch_map
         (loss_weights['icp_rot'] <= 0 and loss_weights['icp_trans'] <= 0):
         # Compute FFT mask loss
         if loss_weights['fft'] > 0.0:
-            # Find mean value of each fft azimuth
-            fft_data = batch_scan['fft_data'].to(mask.device)
-            #mean_azimuth = torch.mean(fft_data, dim=2).unsqueeze(-1)
-            mean_azimuth = torch.mean(fft_data, dim=(1,2), keepdim=True)
-            fft_mask = torch.where(fft_data > 3.0*mean_azimuth, torch.ones_like(fft_data), torch.zeros_like(fft_data))
+            if 'fft_target' in batch_scan:
+                # Precomputed by the dataset
+                fft_mask = unpack_target(batch_scan['fft_target'].to(mask.device), mask.shape[-2:], dtype=mask.dtype)
+            else:
+                # Find mean value of each fft azimuth
+                fft_data = batch_scan['fft_data'].to(mask.device)
+                #mean_azimuth = torch.mean(fft_data, dim=2).unsqueeze(-1)
+                mean_azimuth = torch.mean(fft_data, dim=(1,2), keepdim=True)
+                fft_mask = torch.where(fft_data > 3.0*mean_azimuth, torch.ones_like(fft_data), torch.zeros_like(fft_data))
 
             #if model.network_output_type == "cartesian":
             #    azimuths = batch_scan['azimuths'].to(mask.device)
@@ -221,8 +295,12 @@ def eval_training_loss(T_pred, mask, num_non0, batch_T_gt, batch_scan, batch_map
 
         # Compute mask pts loss
         if loss_weights['mask_pts'] > 0.0:
-            map_pts = batch_map['pc'].to(mask.device)
-            map_pts_mask = extract_bev_from_pts(map_pts)
+            if 'map_pts_target' in batch_map:
+                # Precomputed by the dataset
+                map_pts_mask = unpack_target(batch_map['map_pts_target'].to(mask.device), mask.shape[-2:], dtype=mask.dtype)
+            else:
+                map_pts = batch_map['pc'].to(mask.device)
+                map_pts_mask = extract_bev_from_pts(map_pts, cart_resolution=model.cart_resolution, cart_pixel_width=model.cart_pixel_width)
             loss_mask_pts = mask_criterion(mask, map_pts_mask)
 
         # Compute loss associated with number of points
@@ -252,8 +330,15 @@ def eval_training_loss(T_pred, mask, num_non0, batch_T_gt, batch_scan, batch_map
     
     return loss, loss_components
 
-def eval_validation_loss(T_pred, batch_T_gt, gt_eye=True):
-    
+def eval_validation_loss(T_pred, batch_T_gt, gt_eye=True, reduce=True):
+    # Mean (norm, rot, trans) error over the batch, or the error of each sample (B, 3) if not reduce
+    # T_pred can hold K hypotheses per sample (B, K, 4, 4), their errors are then (B, K, 3)
+    num_hyp = None
+    if T_pred.dim() == 4:
+        num_hyp = T_pred.shape[1]
+        T_pred = T_pred.reshape(-1, 4, 4)
+        batch_T_gt = batch_T_gt.repeat_interleave(num_hyp, dim=0)
+
     # Compute ICP error
     if gt_eye:
         xi_wedge = T_pred - torch.eye(4, dtype=T_pred.dtype, device=T_pred.device)
@@ -263,15 +348,54 @@ def eval_validation_loss(T_pred, batch_T_gt, gt_eye=True):
     xi_r = xi_wedge[:, 0:2, 3]
     xi_theta = xi_wedge[:, 1, 0].unsqueeze(-1)
     xi_stack = torch.cat((xi_theta, xi_r), dim=1)
-    norm_err = torch.norm(xi_stack, dim=1).mean()
-    rot_err = torch.norm(xi_theta, dim=1).mean()
-    trans_err = torch.norm(xi_r, dim=1).mean()
+    norm_err = torch.norm(xi_stack, dim=1)
+    rot_err = torch.norm(xi_theta, dim=1)
+    trans_err = torch.norm(xi_r, dim=1)
 
     # Stack errors together
-    tot_err = torch.hstack((norm_err, rot_err, trans_err))
+    tot_err = torch.stack((norm_err, rot_err, trans_err), dim=1)
+    if num_hyp is not None:
+        tot_err = tot_err.reshape(-1, num_hyp, 3)
+    if reduce:
+        tot_err = tot_err.reshape(-1, 3).mean(dim=0)
 
     return tot_err
 
+def validate_hypotheses(model, iterator, num_hypotheses, pos_std, rot_std, gt_eye=True, device='cpu', binary=False,
+                        fail_trans=1.0, fail_rot=0.1):
+    # Evaluate robustness to the initial guess
+    # The mask of each scan is computed once and ICP is solved from num_hypotheses
+    # initial guesses sampled around the ground truth, as for validation datasets.
+    # The (norm, rot, trans) errors of each scan are reduced over its hypotheses (mean, worst,
+    # std and fraction failed) and these are averaged over scans
+    model.eval()
+    scan_err = []
+
+    with torch.no_grad():
+        for i_batch, batch in enumerate(iterator):
+            batch_scan = batch['loc_data']
+            batch_map = batch['map_data']
+            batch_T_gt = batch['transforms']['T_ml_gt'].to(device)
+
+            batch_size = batch_T_gt.shape[0]
+            T_rand = [sample_init_perturbation(pos_std, rot_std, float_type=batch_T_gt.dtype) for _ in range(batch_size * num_hypotheses)]
+            T_rand = torch.tensor(np.stack(T_rand), dtype=batch_T_gt.dtype, device=device).reshape(batch_size, num_hypotheses, 4, 4)
+            if gt_eye:
+                batch_T_init = T_rand
+            else:
+                batch_T_init = T_rand @ batch_T_gt.unsqueeze(1)
+
+            T_pred, _, _ = model(batch_scan, batch_map, batch_T_init, binary=binary)
+            scan_err.append(eval_validation_loss(T_pred, batch_T_gt, gt_eye=gt_eye, reduce=False))
+
+    scan_err = torch.cat(scan_err, dim=0)
+    failed = (scan_err[:, :, 2] > fail_trans) | (scan_err[:, :, 1] > fail_rot)
+    hyp_acc = {"mean": scan_err.mean(dim=1).mean(dim=0), "worst": scan_err.max(dim=1)[0].mean(dim=0),
+               "std": scan_err.std(dim=1).mean(dim=0) if num_hypotheses > 1 else torch.zeros(3, device=device),
+               "fail_rate": failed.type(scan_err.dtype).mean(dim=1).mean(dim=0)}
+
+    return hyp_acc
+
 def generate_baseline(model, iterator, baseline_type="train", device='cpu',
                       loss_weights={'icp': 1.0, 'fft': 0.0, 'mask_pts': 0.0, 'cfar': 0.0},
                       binary=False, gt_eye=True):
@@ -292,13 +416,17 @@ def generate_baseline(model, iterator, baseline_type="train", device='cpu',
             batch_T = batch['transforms']
             batch_T_gt = batch_T['T_ml_gt'].to(device)
             batch_T_init = batch_T['T_ml_init'].to(device)
+            decode_scan_images(batch_scan, device, model.float_type)
 
             # Form baseline masks
-            fft_data = batch_scan['fft_data'].to(device)
+            # The range mask has the shape of the network input, whether or not fft data was loaded
+            mask_shape = (batch_T_init.shape[0],) + tuple(model.range_mask.shape[-2:])
             if loss_weights['cfar'] > 0.0:
                 # CFAR image is loaded in polar or cartesian already
                 fft_cfar = batch_scan['fft_cfar'].to(device)
                 ones_mask = fft_cfar
+            elif loss_weights['fft'] > 0.0 and 'fft_target' in batch_scan:
+                ones_mask = unpack_target(batch_scan['fft_target'].to(device), mask_shape[1:], dtype=model.float_type)
             elif loss_weights['fft'] > 0.0:
                 # Find mean value of each fft azimuth
                 fft_data = batch_scan['fft_data'].to(device)
@@ -309,11 +437,13 @@ def generate_baseline(model, iterator, baseline_type="train", device='cpu',
                 #    azimuths = batch_scan['azimuths'].to(device)
                 #    fft_mask = radar_polar_to_cartesian_diff(fft_mask, azimuths, model.res)
                 ones_mask = fft_mask
+            elif loss_weights['mask_pts'] > 0.0 and 'map_pts_target' in batch_map:
+                ones_mask = unpack_target(batch_map['map_pts_target'].to(device), (model.cart_pixel_width, model.cart_pixel_width), dtype=batch_map['pc'].dtype)
             elif loss_weights['mask_pts'] > 0.0:
                 map_pts = batch_map['pc'].to(device)
-                ones_mask = extract_bev_from_pts(map_pts)
+                ones_mask = extract_bev_from_pts(map_pts, cart_resolution=model.cart_resolution, cart_pixel_width=model.cart_pixel_width)
             else:
-                ones_mask = torch.ones_like(fft_data)
+                ones_mask = torch.ones(mask_shape, dtype=model.float_type, device=device)
 
             # Compute training baselines
             T_pred_ones, mask_ones, num_non0 = model(batch_scan, batch_map, batch_T_init,
@@ -343,6 +473,37 @@ def generate_baseline(model, iterator, baseline_type="train", device='cpu',
 
     return mean_loss_init, mean_loss_ones
 
+def form_iterator(dataset, params, batch_size, shuffle=False, drop_last=False):
+    # Batches are loaded by DataLoader worker processes or by a thread pool in the main process
+    if params["loader"] == "thread":
+        return ThreadPoolLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                                num_threads=params["loader_threads"], prefetch_batches=params["loader_prefetch"],
+                                ordered=params["loader_ordered"], torch_threads=params["loader_torch_threads"])
+    # Persistent workers keep their dataset, and its map index cache, across epochs
+    num_workers = params["loader_workers"]
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers, drop_last=drop_last,
+                      prefetch_factor=params["loader_prefetch_factor"] if num_workers > 0 else None,
+                      persistent_workers=params["loader_persistent_workers"] and num_workers > 0,
+                      pin_memory=params["loader_pin_memory"])
+
+def default_loc_pairs():
+    # Map and localization sequence pairs used for training and validation
+    train_loc_pairs = [["boreas-2020-11-26-13-58", "boreas-2020-12-01-13-26"],
+                       ["boreas-2020-11-26-13-58", "boreas-2020-12-18-13-44"],
+                       ["boreas-2020-11-26-13-58", "boreas-2021-02-02-14-07"],
+                       ["boreas-2020-11-26-13-58", 'boreas-2021-03-02-13-38'],
+                      ["boreas-2020-11-26-13-58", "boreas-2021-03-30-14-23"],
+                      ["boreas-2020-11-26-13-58", "boreas-2021-04-20-14-11"],
+                      ["boreas-2020-11-26-13-58", "boreas-2021-04-08-12-44"],
+                      ["boreas-2020-11-26-13-58", "boreas-2021-04-29-15-55"],
+                      ["boreas-2020-11-26-13-58", "boreas-2021-05-06-13-19"],
+                      ["boreas-2020-11-26-13-58", 'boreas-2021-06-17-17-52'],
+                      ["boreas-2020-11-26-13-58", 'boreas-2021-08-05-13-34'],
+                      ["boreas-2020-11-26-13-58", 'boreas-2021-09-07-09-35']]
+    val_loc_pairs = [["boreas-2020-11-26-13-58", 'boreas-2021-04-13-14-49']]
+
+    return train_loc_pairs, val_loc_pairs
+
 def main():
     neptune_mode = "debug"
     run = neptune.init_run(
@@ -351,63 +512,18 @@ def main():
         mode=neptune_mode
     )
 
-    params = {
-        "device": torch.device("cuda" if torch.cuda.is_available() else "cpu"),
-
-        # Dataset params
-        "num_train": 1,
-        "num_val": 1,
-        "augment": True,
-        "random": False,
-        "float_type": torch.float32,
-        "use_gt": False,
-        "pos_std": 2.0,             # Standard deviation of position initial guess
-        "rot_std": 0.6,             # Standard deviation of rotation initial guess
-        "gt_eye": True,             # Should ground truth transform be identity?
-        "map_sensor": "lidar",
-        "loc_sensor": "radar",
-        "log_transform": False,      # True or false for log transform of fft data
-        "normalize": ["minmax"],  # Options are "minmax", "standardize", and none
-                                    # happens after log transform if log transform is true
-
-        # Iterator params
-        "batch_size_train": 16,
-        "batch_size_test": 32,
-        "shuffle": True,
-
-        # Training params
-        "icp_type": "pt2pt", # Options are "pt2pt" and "pt2pl"
-        "num_epochs": 30,
-        "learning_rate": 1e-4,
-        "leaky": False,   # True or false for leaky relu
-        "dropout": 0.05,   # Dropout rate, set 0 for no dropout
-        "batch_norm": False, # True or false for batch norm
-        "init_weights": True, # True or false for manually initializing weights
-        "clip_value": 0.0, # Value to clip gradients at, set 0 for no clipping
-        "a_thresh": 1.0, # Threshold for CFAR
-        "b_thresh": 0.09, # Threshold for CFAR
-
-        # Choose weights for loss function
-        "loss_icp_rot_weight": 1.0, # Weight for icp rotation error loss
-        "loss_icp_trans_weight": 1.0, # Weight for icp translation error loss
-        "loss_fft_mask_weight": 0.0, # Weight for fft mask loss
-        "loss_map_pts_mask_weight": 1.0, # Weight for map pts mask loss
-        "loss_cfar_mask_weight": 0.0, # Weight for cfar mask loss
-        "num_pts_weight": 0.0, # Weight for number of points loss
-        "optimizer": "adam", # Options are "adam" and "sgd"
-        "icp_loss_only_iter": -1, # Number of iterations after which to only use icp loss
-        "max_iter": 10, # Maximum number of iterations for icp
-
-        # Model setup
-        "network_input_type": "cartesian", # Options are "cartesian" and "polar", what the network takes in
-        "network_output_type": "cartesian", # Options are "cartesian" and "polar"
-        "binary_inference": False, # Options are True and False, whether the mask is binary or not during inference
-        "norm_weights": True, # Options are True and False, whether to normalize weights to always have max weight of 1
-        # Choose inputs to network
-        "fft_input": True,
-        "cfar_input": False,
-        "range_input": False,
-    }
+    params = default_params()
+    # Use the fastest loader settings found by autotune_loader.py, if asked to
+    # Only the loader* settings are applied, the batch size changes training and is left to the user
+    if params["loader_config"] is not None:
+        with open(params["loader_config"], 'r') as f:
+            loader_config = json.load(f)
+        loader_settings = {key: value for key, value in loader_config["params"].items() if key.startswith("loader")}
+        params.update(loader_settings)
+        print("Loader settings from " + params["loader_config"] + ": ", loader_settings)
+        if loader_config["params"].get("batch_size_train", params["batch_size_train"]) != params["batch_size_train"]:
+            print("Loader config was fastest at batch_size_train " + str(loader_config["params"]["batch_size_train"]) +
+                  ", training keeps batch_size_train " + str(params["batch_size_train"]))
 
     print("Using device: ", params['device'])
 
@@ -417,19 +533,7 @@ def main():
                     "num_pts": params["num_pts_weight"]}
 
     # Load in all ground truth data based on the localization pairs provided in 
-    train_loc_pairs = [["boreas-2020-11-26-13-58", "boreas-2020-12-01-13-26"],
-                       ["boreas-2020-11-26-13-58", "boreas-2020-12-18-13-44"],
-                       ["boreas-2020-11-26-13-58", "boreas-2021-02-02-14-07"],
-                       ["boreas-2020-11-26-13-58", 'boreas-2021-03-02-13-38'],
-                      ["boreas-2020-11-26-13-58", "boreas-2021-03-30-14-23"],
-                      ["boreas-2020-11-26-13-58", "boreas-2021-04-20-14-11"],
-                      ["boreas-2020-11-26-13-58", "boreas-2021-04-08-12-44"],
-                      ["boreas-2020-11-26-13-58", "boreas-2021-04-29-15-55"],
-                      ["boreas-2020-11-26-13-58", "boreas-2021-05-06-13-19"],
-                      ["boreas-2020-11-26-13-58", 'boreas-2021-06-17-17-52'],
-                      ["boreas-2020-11-26-13-58", 'boreas-2021-08-05-13-34'],
-                      ["boreas-2020-11-26-13-58", 'boreas-2021-09-07-09-35']]
-    val_loc_pairs = [["boreas-2020-11-26-13-58", 'boreas-2021-04-13-14-49']]
+    train_loc_pairs, val_loc_pairs = default_loc_pairs()
 
 
     tic = time.time()
@@ -443,6 +547,7 @@ def main():
     print("Dataset created")
     print("Number of training examples: ", len(train_dataset))
     print("Number of validation examples: ", len(val_dataset))
+    print("Max map points (train/val): ", train_dataset.max_map_pts, val_dataset.max_map_pts)
 
     # Form iterators
     drop_last_train = True
@@ -451,19 +556,26 @@ def main():
         drop_last_train = False
     if params["num_val"] < params["batch_size_test"]:
         drop_last_test = False
-    training_iterator = DataLoader(train_dataset, batch_size=params["batch_size_train"], shuffle=params["shuffle"], num_workers=4, drop_last=drop_last_train)
-    validation_iterator = DataLoader(val_dataset, batch_size=params["batch_size_test"], shuffle=False, num_workers=4, drop_last=drop_last_test)
+    training_iterator = form_iterator(train_dataset, params, params["batch_size_train"], shuffle=params["shuffle"], drop_last=drop_last_train)
+    validation_iterator = form_iterator(val_dataset, params, params["batch_size_test"], shuffle=False, drop_last=drop_last_test)
     print("Dataloader created")
 
     # Initialize policy
     policy = LearnICPWeightPolicy(params = params)
     policy = policy.to(device=params["device"])
+    if params["normalize_stats"] == "dataset":
+        tic = time.time()
+        input_stats = policy.compute_normalization_stats(training_iterator)
+        print("Input normalization stats computed in ", time.time()-tic, " s: ", input_stats)
 
     if params["optimizer"] == "adam":
         opt = torch.optim.Adam(policy.parameters(), lr=params["learning_rate"])
     elif params["optimizer"] == "sgd":
         opt = torch.optim.SGD(policy.parameters(), lr=params["learning_rate"], nesterov=True, momentum=1.0)
 
+    # Loss scaling is only needed for fp16, bf16 has the same range as float32
+    scaler = torch.amp.GradScaler(params["device"].type, enabled=(params["mixed_precision"] == "fp16"))
+
     print("Policy and optimizer created")
 
     npt_logger = NeptuneLogger(
@@ -506,6 +618,11 @@ def main():
     best_norm = avg_norm[0, 0]
 
     print("Norm before training: ", avg_norm[0, 0])
+    # Stage timers are disabled, and cost nothing, unless stage_timing is set
+    train_timer = StageTimer(enabled=params["stage_timing"], device=params["device"])
+    val_timer = StageTimer(enabled=params["stage_timing"], device=params["device"])
+    train_icp_stats = [] if params["icp_stats"] else None
+    val_icp_stats = [] if params["icp_stats"] else None
     for epoch in range(params["num_epochs"]):
         tic_epoch = time.time()
         print ('EPOCH ', epoch)
@@ -515,9 +632,14 @@ def main():
             neptune_run = run
         else:
             neptune_run = None
+        profiler = None
+        if epoch == params["profile_epoch"]:
+            profiler = ProfilerWindow(osp.join("results", "profiles", osp.basename(checkpoint_dir), "trace_epoch_{}.json".format(epoch)),
+                                      start_batch=params["profile_start_batch"], num_batches=params["profile_num_batches"])
         tic = time.time()
-        mean_loss, mean_loss_comp = train_policy(policy, training_iterator, opt, loss_weights, device=params["device"],
-                                 epoch=epoch, icp_loss_only_iter=params["icp_loss_only_iter"], gt_eye=params["gt_eye"])
+        mean_loss, mean_loss_comp = train_policy(policy, training_iterator, opt, scaler, loss_weights, device=params["device"],
+                                 epoch=epoch, icp_loss_only_iter=params["icp_loss_only_iter"], gt_eye=params["gt_eye"],
+                                 timer=train_timer, profiler=profiler, icp_stats=train_icp_stats)
         toc = time.time()
         epoch_train_time = toc-tic
         avg_sample_train_time = epoch_train_time/len(train_dataset)
@@ -527,7 +649,8 @@ def main():
         print("Validating")
         tic = time.time()
         avg_norm, mean_num_pc, mean_w, max_w, min_w = validate_policy(policy, validation_iterator, neptune_run=neptune_run, epoch=epoch,
-                                   device=params["device"], binary=params["binary_inference"], gt_eye=params["gt_eye"])
+                                   device=params["device"], binary=params["binary_inference"], gt_eye=params["gt_eye"],
+                                   timer=val_timer, icp_stats=val_icp_stats)
         toc = time.time()
         epoch_val_time = toc-tic
         avg_sample_val_time = epoch_val_time/len(val_dataset)
@@ -567,6 +690,26 @@ def main():
         run[npt_logger.base_namespace]["epoch/epoch_val_time"].append(epoch_val_time)
         run[npt_logger.base_namespace]["epoch/epoch_time"].append(epoch_time)
 
+        # Log stage time percentiles
+        if params["stage_timing"]:
+            train_timer.print_summary("Training")
+            val_timer.print_summary("Validation")
+            train_timer.log(run, npt_logger.base_namespace + "/timing/train")
+            val_timer.log(run, npt_logger.base_namespace + "/timing/val")
+            train_timer.reset()
+            val_timer.reset()
+
+        # Log how hard ICP worked
+        if params["icp_stats"]:
+            for split, icp_stats in [("train", train_icp_stats), ("val", val_icp_stats)]:
+                if len(icp_stats) == 0:
+                    continue
+                for key, value in summarize_icp_stats(icp_stats).items():
+                    run[npt_logger.base_namespace]["epoch/icp_" + split + "/" + key].append(value)
+                if params["icp_stats_log"] is not None:
+                    write_icp_stats(osp.join(checkpoint_dir, params["icp_stats_log"]), epoch, split, icp_stats)
+                icp_stats.clear()
+
         # Save baseline for reference
         run[npt_logger.base_namespace]["epoch/train_init_baseline"].append(train_init_baseline)
         run[npt_logger.base_namespace]["epoch/train_ones_baseline"].append(train_ones_baseline)
@@ -580,9 +723,25 @@ def main():
 
     # Do final validation using the best policy
     policy.load_state_dict(torch.load(best_policy_path))
+    if params["mask_cache_dir"] is not None:
+        policy.enable_mask_cache(params["mask_cache_dir"], max_size_mb=params["mask_cache_max_mb"])
     avg_norm, _, _, _, _ = validate_policy(policy, validation_iterator, neptune_run=neptune_run, epoch=epoch,
                                    device=params["device"], binary=params["binary_inference"], gt_eye=params["gt_eye"])
     print("Best average norm: ", avg_norm[0,0])
+
+    # Robustness of the best policy to the initial guess
+    if params["num_hypotheses"] > 0:
+        hyp_acc = validate_hypotheses(policy, validation_iterator, params["num_hypotheses"], params["pos_std"], params["rot_std"],
+                                      gt_eye=params["gt_eye"], device=params["device"], binary=params["binary_inference"],
+                                      fail_trans=params["hypothesis_fail_trans"], fail_rot=params["hypothesis_fail_rot"])
+        print("Norm over initial guesses, mean/worst/std per scan: ", hyp_acc["mean"][0].item(),
+              hyp_acc["worst"][0].item(), hyp_acc["std"][0].item())
+        print("Fraction of initial guesses failed per scan: ", hyp_acc["fail_rate"].item())
+        for key in ["mean", "worst", "std"]:
+            run[npt_logger.base_namespace]["hypotheses/" + key + "_norm"] = hyp_acc[key][0].item()
+            run[npt_logger.base_namespace]["hypotheses/" + key + "_rot"] = hyp_acc[key][1].item()
+            run[npt_logger.base_namespace]["hypotheses/" + key + "_trans"] = hyp_acc[key][2].item()
+        run[npt_logger.base_namespace]["hypotheses/fail_rate"] = hyp_acc["fail_rate"].item()
     
     run.stop()
 
@@ -42,6 +42,12 @@ def extract_points_and_map(graph: Graph, v: Vertex, msg_prefix='', extract_raw_p
     else:
         curr_raw_pts = curr_filtered_pts
 
+    map_pts, maps_norms, loc_stamp, map_stamp = extract_map(graph, v)
+
+    return curr_raw_pts.T, curr_filtered_pts.T, map_pts, maps_norms, loc_stamp, map_stamp
+
+def extract_map(graph: Graph, v: Vertex):
+    # Only extract the teach map that the repeat vertex v was localized against
     teach_v = g_utils.get_closest_teach_vertex(v)
     map_ptr = teach_v.get_data("pointmap_ptr")
     teach_v = graph.get_vertex(map_ptr.map_vid)
@@ -51,4 +57,4 @@ def extract_points_and_map(graph: Graph, v: Vertex, msg_prefix='', extract_raw_p
     loc_stamp = int(v.stamp * 1e-3)
     map_stamp = int(teach_v.stamp * 1e-3)
 
-    return curr_raw_pts.T, curr_filtered_pts.T, map_pts.T, maps_norms.T, loc_stamp, map_stamp
\ No newline at end of file
+    return map_pts.T, maps_norms.T, loc_stamp, map_stamp
\ No newline at end of file
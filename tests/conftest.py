@@ -0,0 +1,5 @@
+import os.path as osp
+import sys
+
+# The mm_masking modules import each other by their flat names
+sys.path.insert(0, osp.join(osp.dirname(osp.abspath(__file__)), '..', 'mm_masking'))
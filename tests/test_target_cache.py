@@ -0,0 +1,74 @@
+import pytest
+import torch
+from icp_weight_dataset import ICPWeightDataset
+from params import default_params
+from radar_utils import get_num_range_bins, radar_polar_to_cartesian_diff, extract_bev_from_pts
+from synthetic_data import synthetic_sample, POLAR_RES
+from target_cache import TargetCache, cached_target_frames, unpack_target
+
+def target_dataset(params, cache_dir):
+    # Dataset with only the state that forming, caching and augmenting targets uses
+    dataset = ICPWeightDataset.__new__(ICPWeightDataset)
+    dataset.gt_eye = True
+    dataset.float_type = params["float_type"]
+    dataset.network_input_type = params["network_input_type"]
+    dataset.polar_res = POLAR_RES
+    dataset.cart_resolution = params["cart_resolution"]
+    dataset.cart_pixel_width = params["cart_pixel_width"]
+    dataset.target_frames = cached_target_frames(params, augment=True)
+    target_shapes = {}
+    for name, frame in dataset.target_frames.items():
+        if frame == 'cartesian':
+            target_shapes[name] = (params["cart_pixel_width"], params["cart_pixel_width"])
+        else:
+            target_shapes[name] = (400, get_num_range_bins(3360, max_range=params["max_range"], res=POLAR_RES))
+    dataset.target_cache = TargetCache(str(cache_dir), 'test', 1, target_shapes)
+    return dataset
+
+def loss_targets(params, targets, fft_data, azimuths, map_pc):
+    # Targets the mask losses train on, the cached ones if sent, as in eval_training_loss
+    shape = (params["cart_pixel_width"], params["cart_pixel_width"])
+    if params["network_input_type"] == 'cartesian':
+        fft_data = radar_polar_to_cartesian_diff(fft_data.unsqueeze(0), azimuths.unsqueeze(0), POLAR_RES,
+                                                 cart_resolution=params["cart_resolution"], cart_pixel_width=shape[0]).squeeze(0)
+    if 'fft_target' in targets:
+        fft_target = unpack_target(torch.from_numpy(targets['fft_target']).unsqueeze(0), fft_data.shape)[0]
+    else:
+        fft_target = (fft_data > 3.0*torch.mean(fft_data)).type(torch.float32)
+    if 'map_pts_target' in targets:
+        map_pts_target = unpack_target(torch.from_numpy(targets['map_pts_target']).unsqueeze(0), shape)[0]
+    else:
+        map_pts_target = extract_bev_from_pts(map_pc.unsqueeze(0), cart_resolution=params["cart_resolution"],
+                                              cart_pixel_width=shape[0]).squeeze(0).type(torch.float32)
+    return {'fft_target': fft_target, 'map_pts_target': map_pts_target}
+
+@pytest.mark.parametrize("network_input_type", ["polar", "cartesian"])
+@pytest.mark.parametrize("seed", range(4))
+def test_cached_targets_match_uncached_after_augmentation(tmp_path, network_input_type, seed):
+    params = default_params()
+    params["network_input_type"] = network_input_type
+    params["map_sensor"] = "lidar"
+    params["loc_sensor"] = "radar"
+    params["max_range"] = 40.0
+    params["cart_pixel_width"] = 256
+    params["loss_fft_mask_weight"] = 1.0
+    params["loss_map_pts_mask_weight"] = 1.0
+    dataset = target_dataset(params, tmp_path)
+
+    sample = synthetic_sample(params, generator=torch.Generator().manual_seed(seed))
+    loc_data = sample['loc_data']
+    fft_data, azimuths, az_timestamps = loc_data['fft_polar'], loc_data['azimuths'], loc_data['az_timestamps']
+    map_pc = sample['map_data']['pc']
+    targets = dataset.form_targets(0, map_pc, fft_data, azimuths)
+
+    # Random angle of the augmentation, drawn from the seed
+    torch.manual_seed(seed)
+    _, _, map_pc, azimuths, _, fft_data, _, angle = dataset.augment_data(None, None, map_pc, azimuths, az_timestamps,
+                                                                         fft_data, None, targets=targets)
+    assert torch.remainder(angle, torch.pi / 2).item() > 1e-3
+
+    cached = loss_targets(params, targets, fft_data, azimuths, map_pc)
+    uncached = loss_targets(params, {}, fft_data, azimuths, map_pc)
+    for name in uncached:
+        assert torch.sum(uncached[name]) > 0
+        assert torch.equal(cached[name], uncached[name]), name